@@ -0,0 +1,165 @@
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable
+import json
+import time
+import logging
+
+logger = logging.getLogger("uvicorn.error")
+if not logger.hasHandlers():
+    logging.basicConfig(level=logging.INFO, format='    %(levelname)s %(message)s')
+    logger = logging.getLogger(__name__)
+
+class CacheBackend(ABC):
+    """
+    Storage of a ResponseCache. Values are JSON-serializable responses.
+    """
+
+    @abstractmethod
+    async def get(self, key: str) -> Any | None:
+        ...
+
+    @abstractmethod
+    async def set(self, key: str, value: Any):
+        ...
+
+    @abstractmethod
+    async def clear(self):
+        ...
+
+    def stats(self) -> dict:
+        return {}
+
+
+class MemoryCacheBackend(CacheBackend):
+    """
+    In-process LRU cache with a time to live, bounded both by the number of
+    entries and by the approximate size of the cached responses.
+    """
+
+    def __init__(self, max_entries: int = 10000, max_bytes: int = 256 * 1024 * 1024, ttl: float = 3600):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.bytes = 0
+        # key -> (expires_at, size, value), least recently used first
+        self.entries = OrderedDict()
+
+    async def get(self, key: str) -> Any | None:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            self._remove(key)
+            return None
+        self.entries.move_to_end(key)
+        return entry[2]
+
+    async def set(self, key: str, value: Any):
+        size = len(json.dumps(value, default=str))
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self._remove(key)
+        self.entries[key] = (time.monotonic() + self.ttl, size, value)
+        self.bytes += size
+        while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+            self._remove(next(iter(self.entries)))
+
+    async def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
+    def _remove(self, key: str):
+        _, size, _ = self.entries.pop(key)
+        self.bytes -= size
+
+    def stats(self) -> dict:
+        return {"entries": len(self.entries), "bytes": self.bytes}
+
+
+class RedisCacheBackend(CacheBackend):
+    """
+    Cache shared by all API processes, stored in Redis.
+    Keys contain the index version, so entries of older versions simply expire.
+    """
+
+    def __init__(self, url: str, ttl: float = 3600, prefix: str = 'similarity:'):
+        import redis.asyncio as redis
+        self.redis = redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    async def get(self, key: str) -> Any | None:
+        value = await self.redis.get(self.prefix + key)
+        return None if value is None else json.loads(value)
+
+    async def set(self, key: str, value: Any):
+        await self.redis.set(self.prefix + key, json.dumps(value, default=str), ex=int(self.ttl))
+
+    async def clear(self):
+        pass
+
+
+class ResponseCache():
+    """
+    Caches similarity responses per index version.
+
+    The index version is polled from version_source at most every
+    check_interval seconds. When the indexer publishes a new version, the
+    cache is cleared and the new version becomes part of every key.
+    """
+
+    def __init__(self,
+                 backend: CacheBackend,
+                 version_source: Callable[[], Awaitable[str]] | None = None,
+                 check_interval: float = 30):
+        self.backend = backend
+        self.version_source = version_source
+        self.check_interval = check_interval
+        self.version = ''
+        self.checked_at = float('-inf')
+        self.hits = 0
+        self.misses = 0
+
+    async def current_version(self) -> str:
+        if self.version_source is None or time.monotonic() - self.checked_at < self.check_interval:
+            return self.version
+        self.checked_at = time.monotonic()
+        try:
+            version = await self.version_source()
+        except Exception as e:
+            logger.error(f"Could not read the index version: {e}")
+            return self.version
+        if version != self.version:
+            if self.version:
+                logger.info(f"Index version changed to {version}, clearing the response cache.")
+            await self.backend.clear()
+            self.version = version
+        return self.version
+
+    async def get_or_compute(self, key_parts: tuple, compute: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Returns the cached response for key_parts, or computes and caches it.
+        Empty responses (failed searches) are not cached.
+        """
+        key = json.dumps([await self.current_version(), *key_parts], default=str)
+        value = await self.backend.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+        self.misses += 1
+        value = await compute()
+        if value:
+            await self.backend.set(key, value)
+        return value
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "version": self.version,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            **self.backend.stats()
+        }
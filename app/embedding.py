@@ -0,0 +1,256 @@
+from app.helper import process_text
+from app.singleflight import SingleFlight
+from collections import OrderedDict
+import numpy as np
+import asyncio
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+
+logger = logging.getLogger("uvicorn.error")
+if not logger.hasHandlers():
+    logging.basicConfig(level=logging.INFO, format='    %(levelname)s %(message)s')
+    logger = logging.getLogger(__name__)
+
+class EmbeddingCache():
+    """
+    Persistent embedding cache in SQLite, keyed by a hash of the model name
+    and the embedded text, so unchanged companies are never encoded twice.
+    """
+
+    def __init__(self, db_path: str):
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        self.connection = sqlite3.connect(db_path)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB)')
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(model_name: str, text: str) -> str:
+        return hashlib.sha256(f'{model_name}\n{text}'.encode('utf-8')).hexdigest()
+
+    def get_many(self, keys: list[str]) -> dict:
+        found = {}
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            rows = self.connection.execute(
+                f'SELECT key, vector FROM embeddings WHERE key IN ({",".join("?" * len(chunk))})', chunk
+            )
+            for key, vector in rows:
+                found[key] = np.frombuffer(vector, dtype=np.float32)
+        self.hits += len(found)
+        self.misses += len(set(keys)) - len(found)
+        return found
+
+    def put_many(self, items: dict):
+        self.connection.executemany('INSERT OR REPLACE INTO embeddings VALUES (?, ?)',
+                                    [(k, np.asarray(v, dtype=np.float32).tobytes()) for k, v in items.items()])
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+
+class EmbeddingStage():
+    """
+    Encodes company descriptions in batches, optionally spreading the work
+    over a pool of worker processes.
+
+    Texts are sorted by length before encoding so that every batch holds
+    texts of similar length and padding stays minimal. Use it as a context
+    manager so the worker pool is stopped afterwards. The model (and pool)
+    is only loaded once there is something to encode that is not cached.
+    """
+
+    def __init__(self,
+                 model_name: str,
+                 batch_size: int = 32,
+                 num_workers: int = 0,
+                 block_size: int | None = None,
+                 cache: EmbeddingCache | None = None):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        # Number of texts handed to the model per call, progress is logged after each block
+        self.block_size = block_size or batch_size * max(1, num_workers) * 32
+        self.cache = cache
+        self.model = None
+        self.pool = None
+        self.encoded = 0
+        self.seconds = 0.0
+
+    def load(self):
+        if self.model is not None:
+            return
+        # Imported here, as importing sentence_transformers (and torch) alone takes seconds
+        from sentence_transformers import SentenceTransformer
+        logger.info(f"Loading embedding model: {self.model_name}...")
+        self.model = SentenceTransformer(self.model_name)
+        logger.info("Model loaded successfully.")
+        if self.num_workers > 1:
+            self.pool = self.model.start_multi_process_pool(target_devices=["cpu"] * self.num_workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if self.pool is not None:
+            self.model.stop_multi_process_pool(self.pool)
+            self.pool = None
+
+    @property
+    def dimensions(self) -> int:
+        self.load()
+        return int(self.model.get_sentence_embedding_dimension())
+
+    def encode(self, texts: list[str]) -> np.ndarray:
+        """
+        Encodes texts and returns a float32 matrix with one row per text,
+        in the same order as the input. Cached embeddings are reused and
+        new ones are added to the cache.
+        """
+        if self.cache is None:
+            return self.encode_uncached(texts)
+        keys = [EmbeddingCache.key(self.model_name, t) for t in texts]
+        found = self.cache.get_many(keys)
+        missing = list({k: i for i, k in enumerate(keys) if k not in found}.values())
+        if missing:
+            encoded = self.encode_uncached([texts[i] for i in missing])
+            new = {keys[i]: e for i, e in zip(missing, encoded)}
+            self.cache.put_many(new)
+            found.update(new)
+        if not texts:
+            return np.empty((0, 0), dtype=np.float32)
+        return np.stack([found[k] for k in keys]).astype(np.float32, copy=False)
+
+    def encode_uncached(self, texts: list[str]) -> np.ndarray:
+        self.load()
+        embeddings = np.empty((len(texts), self.dimensions), dtype=np.float32)
+        # Longest first, so the slowest batches show up early in the progress log
+        order = np.argsort([-len(t) for t in texts], kind='stable')
+        started = time.perf_counter()
+        for start in range(0, len(order), self.block_size):
+            block = order[start:start + self.block_size]
+            embeddings[block] = self.model.encode(
+                [texts[i] for i in block],
+                batch_size=self.batch_size,
+                pool=self.pool,
+                convert_to_numpy=True
+            )
+            done = min(start + self.block_size, len(order))
+            elapsed = time.perf_counter() - started
+            logger.info(f'vectorized {done}/{len(texts)} companies ({done/elapsed:.1f} companies/sec)')
+        self.encoded += len(texts)
+        self.seconds += time.perf_counter() - started
+        return embeddings
+
+    def report(self) -> dict:
+        """
+        Returns the overall throughput of this stage so far.
+        """
+        rate = self.encoded/self.seconds if self.seconds else 0.0
+        return {
+            "companies": self.encoded,
+            "seconds": round(self.seconds, 2),
+            "companies_per_sec": round(rate, 2),
+            "cached": self.cache.hits if self.cache else 0,
+            "batch_size": self.batch_size,
+            "num_workers": self.num_workers
+        }
+
+
+class QueryEncoder():
+    """
+    Embeds search queries on-line with the model the companies were embedded with.
+
+    Concurrent queries are collected into micro-batches of at most
+    max_batch_size, waiting at most max_wait seconds for a batch to fill,
+    and every batch is encoded in one model call in a worker thread. While a
+    batch is encoded the next one fills up, so under load batches grow
+    instead of queries queueing one by one. Identical queries in flight are
+    encoded once and the embeddings of recent queries are kept in an LRU.
+    The model is loaded on the first query, once per process.
+    """
+
+    def __init__(self, model_name: str, max_batch_size: int = 32, max_wait: float = 0.005, cache_size: int = 1024):
+        self.stage = EmbeddingStage(model_name, max_batch_size)
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.single_flight = SingleFlight()
+        self.queue = None
+        self.batcher = None
+        self.batches = 0
+        self.encoded = 0
+
+    async def encode(self, text: str) -> np.ndarray:
+        # Queries are normalized like the descriptions the index was built from
+        text = process_text(text).strip()
+        vector = self.cache.get(text)
+        if vector is not None:
+            self.cache.move_to_end(text)
+            return vector
+        vector = await self.single_flight.do(text, lambda: self._submit(text))
+        self.cache[text] = vector
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return vector
+
+    async def _submit(self, text: str) -> np.ndarray:
+        if self.batcher is None:
+            self.queue = asyncio.Queue()
+            self.batcher = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((text, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                if self.queue.empty():
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    batch.append(self.queue.get_nowait())
+            try:
+                vectors = await asyncio.to_thread(self._encode_batch, [text for text, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), vector in zip(batch, vectors):
+                if not future.done():
+                    future.set_result(vector)
+
+    def _encode_batch(self, texts: list[str]) -> np.ndarray:
+        self.stage.load()
+        self.batches += 1
+        self.encoded += len(texts)
+        return np.asarray(self.stage.model.encode(texts, batch_size=self.max_batch_size, convert_to_numpy=True),
+                          dtype=np.float32)
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.batches,
+            "encoded": self.encoded,
+            "mean_batch_size": self.encoded / self.batches if self.batches else 0.0,
+            "cached": len(self.cache),
+            "coalesced": self.single_flight.coalesced
+        }
+
+    async def close(self):
+        if self.batcher is not None:
+            self.batcher.cancel()
+            self.batcher = None
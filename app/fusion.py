@@ -0,0 +1,25 @@
+def reciprocal_rank_fusion(rankings: dict[str, list[dict]], weights: dict[str, float] | None = None, k: int = 60) -> list[dict]:
+    """
+    Fuses ranked lists of hits with weighted reciprocal rank fusion.
+
+    Every hit scores sum(weight / (k + rank)) over the lists it appears in,
+    with ranks starting at 1. Hits are matched by their _id and returned
+    best first, each with its fused _score and its rank per list in _ranks.
+
+    Args:
+        rankings (dict): Ranked hits (Elasticsearch hit dictionaries) per list name.
+        weights (dict): Weight per list name, lists without a weight count 1.
+        k (int): The rank constant, higher values flatten the contribution of top ranks.
+
+    Returns:
+        list: The fused hits.
+    """
+    weights = weights or {}
+    fused = {}
+    for name, hits in rankings.items():
+        weight = weights.get(name, 1.0)
+        for rank, hit in enumerate(hits, start=1):
+            entry = fused.setdefault(hit['_id'], {**hit, '_score': 0.0, '_ranks': {}})
+            entry['_score'] += weight / (k + rank)
+            entry['_ranks'][name] = rank
+    return sorted(fused.values(), key=lambda h: h['_score'], reverse=True)
@@ -1,7 +1,12 @@
+import asyncio
 import csv
 import re
 import json
-from typing import AsyncGenerator
+import os
+import sqlite3
+import tempfile
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import AsyncGenerator, Generator
 import logging
 
 logger = logging.getLogger("uvicorn.error")
@@ -77,6 +82,8 @@ def read_csv_to_dict_by_id(file_path: str, index_name: str) -> dict:
                 # The ID is the value of the first key in the row's dictionary
                 row_id = row.get(reader.fieldnames[0])
                 row['_index'] = index_name
+                # Key documents by company_id so they can be fetched with a realtime GET
+                row['_id'] = row_id
                 row['industries'] = []
                 row['specialities'] = []
                 row['full_description'] = process_field(row['description'])
@@ -92,6 +99,172 @@ def read_csv_to_dict_by_id(file_path: str, index_name: str) -> dict:
         
     return data_dict
 
+class AttributeIndex():
+    """
+    On-disk side index of a CSV file with "ID, attribute" format.
+
+    The file is streamed into an SQLite table once, after which the attributes
+    of a chunk of IDs can be looked up without holding the file in memory.
+    Attributes keep the order in which they appear in the file.
+    """
+
+    def __init__(self, file_path: str, db_path: str, batch_size: int = 10000):
+        self.connection = sqlite3.connect(db_path)
+        self.connection.execute('CREATE TABLE attributes (id TEXT, attribute TEXT)')
+        try:
+            with open(file_path, mode='r', newline='', encoding='utf-8') as csvfile:
+                reader = csv.reader(csvfile)
+
+                # Skip the header row
+                next(reader, None)
+
+                batch = []
+                for row in reader:
+                    if len(row) < 2:
+                        continue
+                    batch.append((row[0].strip(), row[1].strip()))
+                    if len(batch) == batch_size:
+                        self.connection.executemany('INSERT INTO attributes VALUES (?, ?)', batch)
+                        batch = []
+                self.connection.executemany('INSERT INTO attributes VALUES (?, ?)', batch)
+        except FileNotFoundError:
+            logger.error(f"Error: The file at '{file_path}' was not found.")
+        self.connection.execute('CREATE INDEX attributes_id ON attributes (id)')
+        self.connection.commit()
+
+    def __len__(self) -> int:
+        return self.connection.execute('SELECT COUNT(DISTINCT id) FROM attributes').fetchone()[0]
+
+    def lookup(self, ids: list[str]) -> dict:
+        """
+        Returns a dictionary where keys are the given IDs that have attributes
+        and values are lists of their attributes.
+        """
+        aggregated_data = {}
+        ids = list(dict.fromkeys(ids))
+        # Stay well below SQLite's limit on the number of bound parameters
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            rows = self.connection.execute(
+                f'SELECT id, attribute FROM attributes WHERE id IN ({",".join("?" * len(chunk))}) ORDER BY rowid',
+                chunk
+            )
+            for id_val, attribute in rows:
+                aggregated_data.setdefault(id_val, []).append(attribute)
+        return aggregated_data
+
+    def close(self):
+        self.connection.close()
+
+def stream_companies(file_path: str,
+                     index_name: str,
+                     industries_file_path: str,
+                     specialities_file_path: str,
+                     chunk_size: int = 5000,
+                     stats: dict | None = None,
+                     workers: int = 0) -> Generator[list[dict], None, None]:
+    """
+    Streams company documents joined with their industries and specialities,
+    in chunks of at most chunk_size companies.
+
+    Produces the same documents as read_csv_to_dict_by_id followed by the
+    industries/specialities join, but only one chunk of companies is held in
+    memory at a time. The attribute files are looked up through temporary
+    on-disk side indexes.
+
+    Args:
+        file_path (str): The path to the companies CSV file.
+        index_name (str): The index the documents are meant for.
+        industries_file_path (str): The path to the "ID, industry" CSV file.
+        specialities_file_path (str): The path to the "ID, speciality" CSV file.
+        chunk_size (int): The maximum number of companies per chunk.
+        stats (dict): Optional dictionary that gets the counts of companies,
+            industries and specialities seen so far.
+        workers (int): The number of processes descriptions are normalized
+            with, 0 or 1 normalizes them in-process.
+
+    Yields:
+        list: Chunks of company documents.
+    """
+    stats = stats if stats is not None else {}
+    stats.update(companies=0, industries=0, specialities=0)
+    pool = ProcessPoolExecutor(workers) if workers > 1 else None
+    with tempfile.TemporaryDirectory() as side_index_dir:
+        industries = AttributeIndex(industries_file_path, os.path.join(side_index_dir, 'industries.db'))
+        specialities = AttributeIndex(specialities_file_path, os.path.join(side_index_dir, 'specialities.db'))
+        stats['industries_total'] = len(industries)
+        stats['specialities_total'] = len(specialities)
+        try:
+            with open(file_path, mode='r', newline='', encoding='utf-8') as csvfile:
+                reader = csv.DictReader(csvfile)
+
+                if not reader.fieldnames:
+                    logger.error("Error: The CSV file must have 'ID' as the first column header.")
+                    return
+
+                chunk = []
+                for row in reader:
+                    if not row.get(reader.fieldnames[0]):
+                        continue
+                    chunk.append(row)
+                    if len(chunk) == chunk_size:
+                        yield _join_companies(chunk, reader.fieldnames[0], index_name, industries, specialities,
+                                              stats, pool)
+                        chunk = []
+                if chunk:
+                    yield _join_companies(chunk, reader.fieldnames[0], index_name, industries, specialities,
+                                          stats, pool)
+        except FileNotFoundError:
+            logger.error(f"Error: The file '{file_path}' was not found.")
+        finally:
+            industries.close()
+            specialities.close()
+            if pool is not None:
+                pool.shutdown()
+
+def count_rows(file_path: str) -> int:
+    """
+    Counts the records of a CSV file, whose quoted fields may span lines, without the header.
+    """
+    with open(file_path, mode='r', newline='', encoding='utf-8') as csvfile:
+        return max(sum(1 for _ in csv.reader(csvfile)) - 1, 0)
+
+def _join_companies(chunk: list[dict],
+                    id_field: str,
+                    index_name: str,
+                    industries: AttributeIndex,
+                    specialities: AttributeIndex,
+                    stats: dict,
+                    pool: Executor | None = None) -> list[dict]:
+    ids = [row[id_field] for row in chunk]
+    company_industries = industries.lookup(ids)
+    company_specialities = specialities.lookup(ids)
+    descriptions = process_texts([row['description'] for row in chunk], pool)
+    for row, description in zip(chunk, descriptions):
+        row['_index'] = index_name
+        row['_id'] = row[id_field]
+        row['industries'] = []
+        row['specialities'] = []
+        row['full_description'] = description
+        if row[id_field] in company_industries:
+            stats['industries'] += 1
+            row['industries'] = process_texts(company_industries[row[id_field]])
+            row['full_description'] = join_fields(row['industries']) + row['full_description']
+        if row[id_field] in company_specialities:
+            stats['specialities'] += 1
+            row['specialities'] = process_texts(company_specialities[row[id_field]])
+            row['full_description'] = join_fields(row['specialities']) + row['full_description']
+    stats['companies'] += len(chunk)
+    return chunk
+
+# URLs start with http://, https:// or www. and run until the next whitespace
+_URLS = re.compile(r'https?://\S+|www\.\S+')
+_SEPARATORS = re.compile(r'[^a-z0-9-]+')
+_SPACES = re.compile(' {2,}')
+# Byte translation table mapping everything but a-z, 0-9 and hyphens to a space
+_SEPARATOR_BYTES = bytes(c if c in b'abcdefghijklmnopqrstuvwxyz0123456789-' else 32 for c in range(256))
+_SPACE_BYTES = re.compile(b' {2,}')
+
 def remove_urls(text: str) -> str:
     """
     Removes URLs from a given string using a regular expression.
@@ -102,15 +275,9 @@ def remove_urls(text: str) -> str:
     Returns:
         str: The string with all identified URLs removed.
     """
-    # A regular expression pattern to match common URL formats.
-    # It looks for URLs starting with http://, https://, or www.
-    url_pattern = re.compile(r'https?://\S+|www\.\S+')
-    
-    # Use re.sub() to find all matches of the pattern and replace them with an empty string.
     # The \S+ part matches one or more non-whitespace characters, effectively capturing the
     # entire URL until a space is encountered.
-    cleaned_text = url_pattern.sub('', text)
-    return cleaned_text
+    return _URLS.sub('', text)
 
 def process_field(field):
     # Check if the input is a string
@@ -124,22 +291,44 @@ def process_field(field):
 
 
 def process_text(any_text: str) -> str:
-    # Convert to lowercase
-    processed_text = any_text.lower()
+    """
+    Lowercases the text, removes URLs and replaces every run of characters
+    other than a-z, 0-9 and hyphens with a single space.
 
-    # remove urls
-    processed_text = remove_urls(processed_text)
+    ASCII texts, i.e. almost all of them, go through one byte translation
+    table and then only runs of two or more spaces are collapsed, which is
+    much cheaper than substituting every single separator with a regex.
+    """
+    text = any_text.lower()
+    if '://' in text or 'www.' in text:
+        text = _URLS.sub('', text)
+    if text.isascii():
+        return _SPACE_BYTES.sub(b' ', text.encode('ascii').translate(_SEPARATOR_BYTES)).decode('ascii')
+    return _SEPARATORS.sub(' ', text)
 
-    # remove brackets
-    processed_text = processed_text.replace('[', ' ').replace(']', ' ')
+def process_texts(texts: list[str], pool: Executor | None = None, chunk_size: int = 1000) -> list[str]:
+    """
+    Normalizes a whole column of texts, like process_text does for one.
 
-    # Replace unwanted characters with a space.
-    # We use a regular expression to find characters that are not
-    # a-z, 0-9, or hyphens, and replace them with a single space.
-    # This also helps in handling "unwanted" characters by making them
-    # a word separator. You can adjust this regex based on your specific needs.
-    processed_text = re.sub(r'[^a-z0-9-]+', ' ', processed_text)
-    return processed_text
+    Args:
+        texts (list): The texts to normalize.
+        pool (Executor): Optional process pool the texts are spread over
+            in chunks of chunk_size texts, worth it for large columns only.
+        chunk_size (int): The number of texts sent to a worker at a time.
+
+    Returns:
+        list: The normalized texts, in the same order.
+    """
+    if pool is None:
+        return [process_text(t) for t in texts]
+    return list(pool.map(process_text, texts, chunksize=chunk_size))
+
+def join_fields(processed: list[str]) -> str:
+    """
+    Joins already processed values into one text, giving the same result as
+    process_field(str(processed)) without normalizing the values again.
+    """
+    return _SPACES.sub(' ', f" {' '.join(processed)} ")
 
 def pretty_search_response(response: dict):
     if len(response["hits"]["hits"]) == 0:
@@ -157,8 +346,8 @@ def pretty_search_response(response: dict):
 
 def get_company_ids_list_from_response(response: dict) -> list:
     company_ids_list = []
-    for hit in response["hits"]["hits"]:
-        company_ids_list.append(int(hit["_source"]["company_id"]))
+    for hit in response["hits"]:
+        company_ids_list.append(int(hit["company_id"]))
     return company_ids_list
 
 
@@ -168,15 +357,22 @@ async def yield_ground_truth(ground_truth_file_path: str) -> AsyncGenerator[str,
             yield line
 
 
-async def get_overlap_percentage(async_client, method) -> float:
-    count = 0
-    overlap_count = 0
-    async for ground_truth in yield_ground_truth('data/ground_truth.json'):
-        json_gt = json.loads(ground_truth)
-        response = await async_client.get(f'/v1/{method}/{json_gt['id']}?size=100')
+async def get_overlap_percentage(async_client, method, concurrency: int = 8) -> float:
+    """
+    Percentage of the ground truth similar companies found in the top 100 of
+    method, querying at most concurrency companies at a time.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def overlap(json_gt: dict) -> int:
+        async with semaphore:
+            response = await async_client.get(f'/v1/{method}/{json_gt['id']}?size=100')
         company_ids_list = get_company_ids_list_from_response(json.loads(response.text))
-        count += len(json_gt['similar_companies'])
-        overlap_count += sum(1 for x in company_ids_list if x in json_gt['similar_companies'])
+        return sum(1 for x in company_ids_list if x in json_gt['similar_companies'])
+
+    ground_truths = [json.loads(line) async for line in yield_ground_truth('data/ground_truth.json')]
+    overlap_count = sum(await asyncio.gather(*(overlap(gt) for gt in ground_truths)))
+    count = sum(len(gt['similar_companies']) for gt in ground_truths)
     hit_percent = (overlap_count/count)*100
-    logger.info(overlap_count, count, hit_percent)
+    logger.info(f"{method}: {overlap_count} of {count} similar companies found ({hit_percent:.1f}%)")
     return hit_percent
\ No newline at end of file
@@ -1,11 +1,21 @@
 import app.helper as helper
 import os
 from dotenv import load_dotenv
-from elasticsearch import Elasticsearch, exceptions
+from elasticsearch import Elasticsearch, OrjsonSerializer, exceptions
 from elasticsearch import helpers
-from sentence_transformers import SentenceTransformer
+from app.embedding import EmbeddingCache, EmbeddingStage
+from app.metrics import Progress
+from app.vectors import EmbeddingWriter, ExactVectorIndex, IVFIndex, decode_vector, encode_vectors
+import argparse
+import hashlib
+import itertools
 import json
+from typing import Callable, Generator, Iterable
 import logging
+import queue
+import re
+import sqlite3
+import threading
 import time
 
 logger = logging.getLogger("uvicorn.error")
@@ -13,25 +23,40 @@ if not logger.hasHandlers():
     logging.basicConfig(level=logging.INFO, format='    %(levelname)s %(message)s')
     logger = logging.getLogger(__name__)
 
-def index_if_needed():
+def create_client() -> Elasticsearch:
+    """
+    The client of the indexer, configured from the environment.
+    """
+    return Elasticsearch(
+        str(os.getenv("ELASTIC_HOST")),
+        ca_certs=str(os.getenv("CERT_PATH")),
+        basic_auth=("elastic", str(os.getenv("ELASTIC_PASSWORD"))),
+        request_timeout=600,
+        verify_certs=False,
+        # Writes the float32 embeddings of bulk documents without converting them to lists
+        serializer=OrjsonSerializer()
+    )
+
+def index_if_needed(mode: str | None = None):
     load_dotenv()
 
-    es_pass = os.getenv("ELASTIC_PASSWORD")
-    es_host = os.getenv("ELASTIC_HOST")
     es_index = os.getenv("ELASTIC_INDEX")
-    crt_path = os.getenv("CERT_PATH")
-    model_name = str(os.getenv("EMBEDDING_MODEL"))
+    # "auto" only builds a missing index, "delta" also refreshes an existing one
+    # and "rebuild" builds a new version and swaps the alias to it
+    index_mode = mode or os.getenv("INDEX_MODE", "auto")
+    index_replicas = int(os.getenv("INDEX_REPLICAS", 1))
+    warm_up_queries = int(os.getenv("INDEX_WARM_UP_QUERIES", 5))
+    retain_versions = int(os.getenv("INDEX_RETAIN_VERSIONS", 1))
+    # HNSW variant of the embeddings, e.g. "int8_hnsw" or "bbq_hnsw", unset keeps mappings/full.json
+    vector_index_type = os.getenv("VECTOR_INDEX_TYPE")
 
-    client = Elasticsearch(
-        str(es_host),
-        ca_certs=str(crt_path),
-        basic_auth=("elastic", str(es_pass)),
-        request_timeout=600,
-        verify_certs=False
-    )
+    client = create_client()
 
-    if client.indices.exists(index=str(es_index)):
+    # ELASTIC_INDEX is an alias to the latest complete version of the index
+    if index_mode != "rebuild" and client.indices.exists(index=str(es_index)):
         # client.indices.delete(index=str(es_index), ignore_unavailable=True)
+        if index_mode == "delta" and load_companies(client, str(es_index), delta=True):
+            bump_data_version(client, str(es_index))
         return
     
     try:
@@ -39,6 +64,9 @@ def index_if_needed():
     except exceptions.NotFoundError:
         # Inference endpoint does not exist
         pass
+    except exceptions.BadRequestError:
+        # Inference endpoint is still used by the live index, it is kept
+        pass
 
     try:
         client.options(
@@ -84,58 +112,392 @@ def index_if_needed():
 
     with open('mappings/full.json') as m:
         mappings = json.load(m)
+    if vector_index_type:
+        embedding = mappings['mappings']['properties']['full_description_embedding']
+        embedding['index_options'] = {**embedding.get('index_options', {}), "type": vector_index_type}
 
+    # Built without refreshes and replicas, neither is needed until the alias points to it
+    new_index = f'{es_index}-{time.strftime("%Y%m%d%H%M%S")}'
     client.indices.create(
-        index=str(es_index),
-        mappings=mappings['mappings']
+        index=new_index,
+        mappings=mappings['mappings'],
+        settings={"number_of_replicas": 0, "refresh_interval": "-1"}
     )
 
-    logger.info(f"Loading embedding model: {model_name}...")
-    model = SentenceTransformer(model_name)
-    logger.info("Model loaded successfully.")
-
-    companies = helper.read_csv_to_dict_by_id('data/companies.csv', str(es_index))
-    company_industries_aggregated = helper.aggregate_attributes_by_id('data/company_industries.csv')
-    company_specialities_aggregated = helper.aggregate_attributes_by_id('data/company_specialities.csv')
-
-    logger.info(f'Number of companies: {len(companies)}')
-    logger.info(f'Number of industries: {len(company_industries_aggregated)}')
-    logger.info(f'Number of specialities: {len(company_specialities_aggregated)}')
-
-    hits = 0
-    misses = 0
-    for c, l in company_industries_aggregated.items():
-        if c in companies:
-            hits += 1
-            companies[c]['industries'] = helper.process_field(l)
-            companies[c]['full_description'] = helper.process_field(str(companies[c]['industries'])) + \
-                                            companies[c]['full_description']
-        else:
-            misses += 1
-
-    logger.info(f'{(misses/hits)*100}% of industries are invalid and ignored')
-
-    hits = 0
-    misses = 0
-    for c, l in company_specialities_aggregated.items():
-        if c in companies:
-            hits += 1
-            companies[c]['specialities'] = helper.process_field(l)
-            companies[c]['full_description'] = helper.process_field(str(companies[c]['specialities'])) + \
-                                            companies[c]['full_description']
-        else:
-            misses += 1
+    load_companies(client, new_index)
+    optimize_index(client, new_index, index_replicas)
+    warm_up(client, new_index, warm_up_queries)
+    swap_alias(client, str(es_index), new_index, retain_versions)
+
+def optimize_index(client: Elasticsearch, index: str, replicas: int = 1):
+    """
+    Prepares a freshly loaded index for searching: refreshes it, merges it
+    into a single segment and restores the refresh interval and replicas.
+    """
+    client.indices.refresh(index=index)
+    logger.info(f"Force merging {index}...")
+    client.options(request_timeout=3600).indices.forcemerge(index=index, max_num_segments=1)
+    client.indices.put_settings(
+        index=index,
+        settings={"index": {"refresh_interval": None, "number_of_replicas": replicas}}
+    )
+    # Replicas that cannot be allocated (e.g. on a single node) do not block
+    client.options(request_timeout=3600).cluster.health(index=index, wait_for_no_initializing_shards=True,
+                                                        timeout='59m')
+
+def warm_up(client: Elasticsearch, index: str, queries: int = 5):
+    """
+    Runs the similarity queries of a few companies against index, so its
+    data structures are loaded before it receives traffic.
+    """
+    seeds = client.search(index=index, size=queries,
+                          source_includes=['full_description', 'full_description_embedding'])
+    for hit in seeds['hits']['hits']:
+        seed = hit['_source']
+        try:
+            client.search(index=index, size=10, query={
+                "more_like_this": {"fields": ["industries", "specialities", "description"],
+                                   "like": [{"_index": index, "_id": hit['_id']}], "min_term_freq": 1}
+            })
+            client.search(index=index, size=10, query={
+                "semantic": {"field": "full_description_semantic", "query": seed.get('full_description', '')}
+            })
+            client.search(index=index, size=10, knn={
+                "field": "full_description_embedding",
+                "query_vector": decode_vector(seed['full_description_embedding']),
+                "k": 10, "num_candidates": 100
+            })
+        except Exception as e:
+            logger.warning(f"Warm-up query failed: {e}")
+    logger.info(f"{index} warmed up with {len(seeds['hits']['hits'])} companies.")
 
-    logger.info(f'{(misses/hits)*100}% of specialities are invalid and ignored')
+def index_meta(client: Elasticsearch, index: str) -> dict[str, dict]:
+    """
+    The _meta of the mappings of every concrete index behind index (a name, alias or pattern).
+    """
+    return {name: mapping['mappings'].get('_meta', {})
+            for name, mapping in client.indices.get_mapping(index=index).body.items()}
 
-    counter = 0
-    for c, l in companies.items():
-        l['full_description_embedding'] = model.encode(l['full_description'], convert_to_numpy=True).tolist()
-        counter += 1
-        if counter % 100 == 0:
-            logger.info(f'vectorizing company_id: {c}. This is the #{counter} company vectorized so far.')
+def bump_data_version(client: Elasticsearch, index: str):
+    """
+    Increments the data_version in the _meta of the indices behind index.
+    A delta run changes documents in place, so the uuids the API identifies
+    the index version by stay the same and its response caches read this too.
+    """
+    for name, meta in index_meta(client, index).items():
+        client.indices.put_mapping(index=name, meta={**meta, "data_version": meta.get("data_version", 0) + 1})
+        logger.info(f"{name} is now at data version {meta.get('data_version', 0) + 1}.")
 
-    logger.warning('indexing... it might take hours!')
+def swap_alias(client: Elasticsearch, alias: str, index: str, retain: int = 1):
+    """
+    Points alias to index in a single atomic request and deletes all but the
+    retain most recent previous versions. A concrete index named like the
+    alias (from before indices were versioned) is removed in the same request.
+
+    Versions are marked as published in their _meta when they go behind the
+    alias, so only those count as previous versions. Builds older than index
+    that never got there were left by failed runs and are deleted, newer ones
+    may still be loading and are kept.
+    """
+    actions = [{"add": {"index": index, "alias": alias}}]
+    previous = []
+    if client.indices.exists_alias(name=alias):
+        previous = list(client.indices.get_alias(name=alias).body)
+        actions += [{"remove": {"index": i, "alias": alias}} for i in previous]
+    elif client.indices.exists(index=alias):
+        actions.append({"remove_index": {"index": alias}})
+    # The indices behind the alias may predate the mark
+    for name, meta in index_meta(client, ','.join([index, *previous])).items():
+        if not meta.get("published"):
+            client.indices.put_mapping(index=name, meta={**meta, "published": time.strftime('%Y-%m-%dT%H:%M:%S')})
+    client.indices.update_aliases(actions=actions)
+    logger.info(f"{alias} now points to {index}.")
+
+    versions = sorted(i for i in client.indices.get(index=f'{alias}-*').body
+                      if i != index and re.fullmatch(rf'{re.escape(alias)}-\d{{14}}', i))
+    metas = index_meta(client, f'{alias}-*') if versions else {}
+    published = [v for v in versions if metas.get(v, {}).get("published")]
+    for old in published[:max(0, len(published) - retain)]:
+        client.indices.delete(index=old)
+        logger.info(f"Deleted the previous version {old}.")
+    for leftover in (v for v in versions if v not in published and v < index):
+        client.indices.delete(index=leftover)
+        logger.info(f"Deleted {leftover}, a build that was never published.")
+
+def load_companies(client: Elasticsearch, es_index: str, delta: bool = False) -> int:
+    """
+    Streams, embeds and bulk indexes the companies of the CSV files into es_index,
+    then rebuilds the local vector store and IVF index. Returns the number of
+    documents indexed or deleted.
+
+    Embeddings are looked up in the persistent embedding cache first, so only
+    new or changed descriptions are encoded. With delta, only documents whose
+    content hash changed since the last run are sent to Elasticsearch and
+    companies that disappeared from the CSV files are deleted. Otherwise the
+    index is assumed to be empty and every document is sent.
+    """
+    model_name = str(os.getenv("EMBEDDING_MODEL"))
+    batch_size = int(os.getenv("EMBEDDING_BATCH_SIZE", 32))
+    num_workers = int(os.getenv("EMBEDDING_WORKERS", 0))
+    chunk_size = int(os.getenv("INGEST_CHUNK_SIZE", 5000))
+    normalize_workers = int(os.getenv("NORMALIZE_WORKERS", 0))
+    embedding_cache_path = os.getenv("EMBEDDING_CACHE_PATH", "data/embedding_cache.sqlite")
+    progress_interval = float(os.getenv("INDEX_PROGRESS_INTERVAL", 30))
+    encoding = vector_encoding(client, os.getenv("EMBEDDING_ENCODING", "auto"))
+    index_state_path = os.getenv("INDEX_STATE_PATH", "data/index_state.sqlite")
+    vector_store_path = os.getenv("VECTOR_STORE_PATH", "data/embeddings")
+    vector_store_dtype = os.getenv("VECTOR_STORE_DTYPE", "float32")
+    ivf_nlist = int(os.getenv("IVF_NLIST", 0))
+    vector_engine = os.getenv("VECTOR_ENGINE", "elasticsearch")
+    bulk_workers = int(os.getenv("BULK_WORKERS", 4))
+    bulk_queue_size = int(os.getenv("BULK_QUEUE_SIZE", chunk_size))
+    bulk_options = {
+        "chunk_size": int(os.getenv("BULK_CHUNK_SIZE", 500)),
+        "max_chunk_bytes": int(os.getenv("BULK_MAX_CHUNK_BYTES", 100 * 1024 * 1024)),
+        "max_retries": int(os.getenv("BULK_MAX_RETRIES", 5)),
+        "initial_backoff": float(os.getenv("BULK_INITIAL_BACKOFF", 2)),
+        "max_backoff": float(os.getenv("BULK_MAX_BACKOFF", 600)),
+    }
+
+    state = DocumentState(index_state_path, model_name)
+    if not delta:
+        state.reset()
+    cache = EmbeddingCache(embedding_cache_path)
+
+    stats = {}
+    chunks = helper.stream_companies('data/companies.csv',
+                                     es_index,
+                                     'data/company_industries.csv',
+                                     'data/company_specialities.csv',
+                                     chunk_size,
+                                     stats,
+                                     normalize_workers)
+
+    if delta:
+        logger.warning('updating the index with new, changed and removed companies...')
+    else:
+        logger.warning('indexing... it might take hours!')
     logger.warning('Visit /v1/status to check the progress.')
-    r = helpers.bulk(client, (c for c in companies.values()))
-    logger.warning('indexing done!')
\ No newline at end of file
+    progress = Progress('indexing', helper.count_rows('data/companies.csv'), progress_interval)
+    # Failed documents are forgotten, so the next delta run sends them again
+    failed_ids = []
+    try:
+        with EmbeddingStage(model_name, batch_size, num_workers, cache=cache) as stage, \
+             EmbeddingWriter(vector_store_path, vector_store_dtype) as writer:
+            documents = embed_documents(stage, chunks, writer, state, progress, encoding)
+            indexed, failed = bulk_index(client,
+                                         itertools.chain(documents, delete_stale(state, es_index)),
+                                         bulk_workers,
+                                         bulk_queue_size,
+                                         on_error=lambda item: failed_ids.append(next(iter(item.values())).get('_id')),
+                                         **bulk_options)
+        state.forget(failed_ids)
+        state.commit()
+    finally:
+        state.close()
+        cache.close()
+    progress.log()
+    logger.warning(f'indexing done! {indexed} companies indexed or deleted, {failed} failed.')
+    if vector_engine == "ivf":
+        # Only the API's ivf engine reads it, the exact engine and the neighbour job use the store itself
+        IVFIndex.build(ExactVectorIndex(vector_store_path), f'{vector_store_path}.ivf', ivf_nlist)
+
+    logger.info(f"Number of companies: {stats['companies']}")
+    logger.info(f"Number of industries: {stats['industries_total']}")
+    logger.info(f"Number of specialities: {stats['specialities_total']}")
+    for attribute in ['industries', 'specialities']:
+        misses = stats[f'{attribute}_total'] - stats[attribute]
+        logger.info(f'{(misses/max(stats[attribute], 1))*100}% of {attribute} are invalid and ignored')
+    report = stage.report()
+    logger.info(f"vectorized {report['companies']} companies in {report['seconds']}s "
+                f"({report['companies_per_sec']} companies/sec), {report['cached']} embeddings from the cache")
+    return indexed
+
+def vector_encoding(client: Elasticsearch, encoding: str = "auto") -> str:
+    """
+    Resolves "auto" to the most compact encoding of bulk embeddings the cluster
+    accepts: base64 from Elasticsearch 9.1 on, float32 decimals before.
+    """
+    if encoding != "auto":
+        return encoding
+    version = tuple(int(p) for p in re.findall(r'\d+', client.info()['version']['number'])[:2])
+    encoding = "base64" if version >= (9, 1) else "float"
+    logger.info(f"Sending embeddings as {encoding} vectors.")
+    return encoding
+
+class DocumentState():
+    """
+    Content hashes of the documents in the index, stored in SQLite, so a delta
+    run only sends new or changed documents and deletes removed ones.
+
+    Every run gets a number and every document seen in a run is stamped with
+    it, documents not stamped by the end of a run were removed from the data.
+    Changes are only committed after a successful run.
+    """
+
+    def __init__(self, db_path: str, model_name: str):
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        self.connection = sqlite3.connect(db_path)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS documents (company_id TEXT PRIMARY KEY, doc_hash TEXT, run INTEGER)'
+        )
+        self.model_name = model_name
+        self.run = self.connection.execute('SELECT COALESCE(MAX(run), 0) + 1 FROM documents').fetchone()[0]
+
+    def document_hash(self, document: dict) -> str:
+        content = {k: v for k, v in document.items() if k not in ('_index', 'full_description_embedding')}
+        return hashlib.sha256(f'{self.model_name}\n{json.dumps(content, sort_keys=True)}'.encode('utf-8')).hexdigest()
+
+    def changed(self, documents: list[dict]) -> list[dict]:
+        """
+        Stamps documents with the current run and returns the new or changed ones.
+        """
+        hashes = {str(d['_id']): self.document_hash(d) for d in documents}
+        known = {}
+        ids = list(hashes)
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            known.update(self.connection.execute(
+                f'SELECT company_id, doc_hash FROM documents WHERE company_id IN ({",".join("?" * len(chunk))})', chunk
+            ))
+        self.connection.executemany('INSERT OR REPLACE INTO documents VALUES (?, ?, ?)',
+                                    [(c, h, self.run) for c, h in hashes.items()])
+        return [d for d in documents if known.get(str(d['_id'])) != hashes[str(d['_id'])]]
+
+    def remove_stale(self) -> list[str]:
+        """
+        Removes and returns the ids of documents not seen in the current run.
+        """
+        stale = [r[0] for r in self.connection.execute('SELECT company_id FROM documents WHERE run < ?', (self.run,))]
+        self.connection.execute('DELETE FROM documents WHERE run < ?', (self.run,))
+        return stale
+
+    def forget(self, company_ids: Iterable[str]):
+        self.connection.executemany('DELETE FROM documents WHERE company_id = ?', [(str(c),) for c in company_ids])
+
+    def reset(self):
+        # Committed with the hashes of the new run, so a failed rebuild keeps the state of the last one
+        self.connection.execute('DELETE FROM documents')
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+def delete_stale(state: DocumentState, es_index: str) -> Generator[dict, None, None]:
+    """
+    Yields delete actions for the documents not seen in the current run.
+    Iterate it only after all documents of the run went through state.
+    """
+    for company_id in state.remove_stale():
+        yield {"_op_type": "delete", "_index": es_index, "_id": company_id}
+
+def embed_documents(stage: EmbeddingStage,
+                    chunks: Iterable[list[dict]],
+                    writer: EmbeddingWriter | None = None,
+                    state: DocumentState | None = None,
+                    progress: Progress | None = None,
+                    encoding: str = "list") -> Generator[dict, None, None]:
+    """
+    Adds the full_description embedding to every document of every chunk,
+    encoding one chunk at a time, and yields the documents one by one.
+    The embeddings are also appended to writer, if given. With state, only
+    new or changed documents are yielded, but all of them are embedded and
+    written, so the vector store stays complete. Progress, if given, counts
+    the documents and the embeddings actually encoded. The embeddings of a
+    chunk stay in one float32 matrix and reach the documents in the given
+    encoding, see app.vectors.encode_vectors.
+    """
+    for chunk in chunks:
+        encoded = stage.encoded
+        embeddings = stage.encode([c['full_description'] for c in chunk])
+        if progress is not None:
+            progress.update(len(chunk), stage.encoded - encoded)
+        if writer is not None:
+            writer.append([int(c['_id']) for c in chunk], embeddings)
+        for c, e in zip(chunk, encode_vectors(embeddings, encoding)):
+            c['full_description_embedding'] = e
+        yield from (chunk if state is None else state.changed(chunk))
+
+_DONE = object()
+
+def bulk_index(client: Elasticsearch,
+               documents: Iterable[dict],
+               workers: int = 4,
+               queue_size: int = 5000,
+               on_error: Callable[[dict], None] | None = None,
+               **bulk_options) -> tuple[int, int]:
+    """
+    Indexes documents with several streaming bulk workers fed from a bounded queue.
+
+    The calling thread iterates over documents, which is where the CPU-side
+    work (e.g. embedding) happens, while the worker threads send the queued
+    documents to Elasticsearch. The queue bound keeps both sides busy without
+    letting memory grow when one side is slower than the other.
+
+    Args:
+        client (Elasticsearch): The client used by all workers.
+        documents (Iterable): The documents (bulk actions) to index.
+        workers (int): The number of bulk worker threads.
+        queue_size (int): The maximum number of documents waiting to be indexed.
+        on_error (Callable): Called with the bulk response item of every failed document.
+        bulk_options: Passed to helpers.streaming_bulk, e.g. chunk_size,
+            max_chunk_bytes, max_retries, initial_backoff and max_backoff.
+            Documents rejected with a 429 are retried with exponential backoff.
+
+    Returns:
+        tuple: The number of indexed and failed documents.
+    """
+    pending = queue.Queue(maxsize=queue_size)
+    lock = threading.Lock()
+    counts = {"indexed": 0, "failed": 0}
+    errors = []
+
+    def consume():
+        try:
+            for ok, item in helpers.streaming_bulk(client,
+                                                   iter(pending.get, _DONE),
+                                                   raise_on_error=False,
+                                                   raise_on_exception=False,
+                                                   **bulk_options):
+                with lock:
+                    if ok:
+                        counts["indexed"] += 1
+                    else:
+                        counts["failed"] += 1
+                        if on_error is not None:
+                            on_error(item)
+                        if counts["failed"] <= 10:
+                            logger.error(f"Failed to index document: {item}")
+        except Exception as e:
+            errors.append(e)
+            # Keep draining so the producer never blocks on a dead worker
+            for _ in iter(pending.get, _DONE):
+                pass
+
+    threads = [threading.Thread(target=consume, daemon=True) for _ in range(max(1, workers))]
+    for t in threads:
+        t.start()
+    try:
+        for document in documents:
+            pending.put(document)
+    finally:
+        for _ in threads:
+            pending.put(_DONE)
+        for t in threads:
+            t.join()
+    if errors:
+        raise errors[0]
+    return counts["indexed"], counts["failed"]
+
+def main():
+    parser = argparse.ArgumentParser(description="Indexes the companies of the data directory into Elasticsearch.")
+    parser.add_argument('--mode', choices=["auto", "delta", "rebuild"],
+                        help='overrides INDEX_MODE: "auto" only builds a missing index, "delta" applies changes '
+                             'to an existing one and "rebuild" builds a new version and swaps the alias')
+    args = parser.parse_args()
+    index_if_needed(args.mode)
+
+if __name__ == '__main__':
+    main()
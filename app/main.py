@@ -1,28 +1,128 @@
-from fastapi import FastAPI, Depends, HTTPException
+from fastapi import FastAPI, Depends, HTTPException, Query, Request
+from fastapi.responses import ORJSONResponse, PlainTextResponse, StreamingResponse
 from starlette.status import HTTP_500_INTERNAL_SERVER_ERROR
-from typing import AsyncGenerator
-from app.searcher import AsyncSearchService
+from app.searcher import AsyncSearchService, create_async_client
+from app.vectors import ExactVectorIndex, IVFIndex
+from app.neighbours import load_neighbour_tables, neighbour_tables_stamp
+from app.cache import MemoryCacheBackend, RedisCacheBackend, ResponseCache
+from app.singleflight import SingleFlight
+from app.embedding import QueryEncoder
+from app.metrics import REQUEST_SECONDS, gauges, render, server_timing, start_request, timed
+from app.models import BatchRequest, CompanyFilters, HybridResponse, SearchMethod, SimilarityMethod, SimilarityResponse
 from dotenv import load_dotenv
+import asyncio
 import os
 from contextlib import asynccontextmanager
-import asyncio
-import app.indexer as indexer
+import orjson
+import time
 import logging
 
 load_dotenv()
 es_index = str(os.getenv("ELASTIC_INDEX"))
+vector_engine = os.getenv("VECTOR_ENGINE", "elasticsearch")
+vector_store_path = os.getenv("VECTOR_STORE_PATH", "data/embeddings")
+ivf_nprobe = int(os.getenv("IVF_NPROBE", 16))
+ivf_rerank = int(os.getenv("IVF_RERANK", 0))
+cache_backend = os.getenv("CACHE_BACKEND", "memory")
+cache_ttl = float(os.getenv("CACHE_TTL", 3600))
+batch_chunk_size = int(os.getenv("BATCH_CHUNK_SIZE", 100))
+batch_concurrency = int(os.getenv("BATCH_CONCURRENCY", 4))
+hybrid_timeout = float(os.getenv("HYBRID_TIMEOUT", 1.0))
+hybrid_rank_window = int(os.getenv("HYBRID_RANK_WINDOW", 50))
+cursor_window = int(os.getenv("CURSOR_WINDOW", 100))
+neighbour_tables_path = os.getenv("NEIGHBOUR_TABLES_PATH", "data/neighbours")
+index_version_check_interval = float(os.getenv("INDEX_VERSION_CHECK_INTERVAL", 30))
+embedding_model = str(os.getenv("EMBEDDING_MODEL"))
+query_batch_size = int(os.getenv("QUERY_BATCH_SIZE", 32))
+query_max_wait = float(os.getenv("QUERY_MAX_WAIT", 0.005))
+query_cache_size = int(os.getenv("QUERY_CACHE_SIZE", 1024))
+# Query knobs of AsyncSearchService that can be overridden from the environment, e.g. KNN_NUM_CANDIDATES="200"
+query_knobs = ["mlt_max_query_terms", "mlt_min_term_freq", "semantic_industries_boost", "semantic_description_boost",
+               "knn_k", "knn_num_candidates"]
 
 logger = logging.getLogger("uvicorn.error")
 if not logger.hasHandlers():
     logging.basicConfig(level=logging.INFO, format='    %(levelname)s %(message)s')
     logger = logging.getLogger(__name__)
 
-async def get_searcher() -> AsyncGenerator[AsyncSearchService, None]:
-    searcher = AsyncSearchService(es_index)
+def get_searcher(request: Request) -> AsyncSearchService:
+    # The searcher and its connection pool are created once in lifespan and shared by all requests
+    return request.app.state.searcher
+
+def parse_fields(fields: str | None) -> list | None:
+    # Comma separated source fields, e.g. fields=city,country
+    return sorted({f.strip() for f in fields.split(',') if f.strip()}) if fields else None
+
+def parse_filters(country: list[str] | None = Query(None),
+                  state: list[str] | None = Query(None),
+                  city: list[str] | None = Query(None),
+                  company_size: list[str] | None = Query(None),
+                  industries: list[str] | None = Query(None)) -> dict | None:
+    # Repeat a parameter for alternatives, e.g. country=Netherlands&country=Belgium
+    return CompanyFilters(country=country, state=state, city=city, company_size=company_size,
+                          industries=industries).normalized()
+
+def load_vector_index() -> ExactVectorIndex | IVFIndex | None:
+    if vector_engine not in ("exact", "ivf"):
+        return None
+    try:
+        vector_index = ExactVectorIndex(vector_store_path)
+        if vector_engine == "ivf":
+            # The exact vectors stay on disk and are only read for seeds and reranking
+            vector_index = IVFIndex(f'{vector_store_path}.ivf', ivf_nprobe, ivf_rerank, vector_index)
+        logger.info(f"Serving dense_vector_similarity from {len(vector_index)} local embeddings ({vector_engine}).")
+        return vector_index
+    except FileNotFoundError:
+        logger.warning(f"No embeddings at {vector_store_path}, dense_vector_similarity falls back to Elasticsearch.")
+        return None
+
+def create_cache(searcher: AsyncSearchService) -> ResponseCache | None:
+    if cache_backend == "memory":
+        backend = MemoryCacheBackend(int(os.getenv("CACHE_MAX_ENTRIES", 10000)),
+                                     int(os.getenv("CACHE_MAX_BYTES", 256 * 1024 * 1024)),
+                                     cache_ttl)
+    elif cache_backend == "redis":
+        backend = RedisCacheBackend(str(os.getenv("CACHE_REDIS_URL")), cache_ttl)
+    else:
+        return None
+    return ResponseCache(backend, searcher.index_version, float(os.getenv("CACHE_VERSION_CHECK_INTERVAL", 30)))
+
+async def read_index_version(searcher: AsyncSearchService) -> str | None:
     try:
-        yield searcher
-    finally:
-        await searcher.close()
+        return await searcher.index_version()
+    except Exception as e:
+        logger.error(f"Could not read the index version: {e}")
+        return None
+
+async def reload_local_engines(searcher: AsyncSearchService, version: str | None, interval: float):
+    """
+    Reopens the local vector index and reloads the precomputed neighbour
+    tables whenever the index version changes, polled every interval
+    seconds. The indexer replaces the vector store before it publishes a
+    version, so the open memory maps would keep serving the old embeddings.
+    Neighbour tables are also reloaded when they are rewritten.
+    """
+    stamp = neighbour_tables_stamp(neighbour_tables_path)
+    while True:
+        await asyncio.sleep(interval)
+        current = await read_index_version(searcher)
+        if current is None:
+            continue
+        current_stamp = neighbour_tables_stamp(neighbour_tables_path)
+        if current == version and current_stamp == stamp:
+            continue
+        if current != version:
+            logger.info(f"Index version changed to {current}, reopening the local vector index.")
+            searcher.vector_index = await asyncio.to_thread(load_vector_index)
+        logger.info(f"Index version {current}, reloading the neighbour tables.")
+        searcher.neighbour_tables = await asyncio.to_thread(load_neighbour_tables, neighbour_tables_path, current)
+        version, stamp = current, current_stamp
+
+class TimedORJSONResponse(ORJSONResponse):
+    # Serialization is the last stage of a request, timed like the others
+    def render(self, content) -> bytes:
+        with timed('serialize'):
+            return super().render(content)
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -30,14 +130,42 @@ async def lifespan(app: FastAPI):
     This runs on application startup and shutdown.
     """
     logger.info("Application startup initiated.")
-    # Run the indexer task in the background
-    asyncio.create_task(asyncio.to_thread(indexer.index_if_needed))
+    es_client = create_async_client()
+    query_encoder = QueryEncoder(embedding_model, query_batch_size, query_max_wait, query_cache_size)
+    app.state.searcher = AsyncSearchService(es_index, es_client, load_vector_index(), single_flight=SingleFlight(),
+                                            query_encoder=query_encoder)
+    index_version = await read_index_version(app.state.searcher)
+    app.state.searcher.neighbour_tables = load_neighbour_tables(neighbour_tables_path, index_version)
+    # Local engines follow new index versions without restarting the API
+    reloader = asyncio.create_task(reload_local_engines(app.state.searcher, index_version,
+                                                        index_version_check_interval))
+    app.state.searcher.cache = create_cache(app.state.searcher)
+    for knob in query_knobs:
+        if os.getenv(knob.upper()) is not None:
+            setattr(app.state.searcher, knob, type(getattr(AsyncSearchService, knob))(os.getenv(knob.upper())))
+    # Indexing runs separately with python -m app.indexer, so every worker starts fast
     logger.info("Application is now ready to receive requests.")
     yield
     logger.info("Application shutdown initiated.")
-    # Add any shutdown logic here if needed
+    reloader.cancel()
+    await query_encoder.close()
+    await es_client.close()
+
+app = FastAPI(root_path='/v1', lifespan=lifespan, default_response_class=TimedORJSONResponse)
 
-app = FastAPI(root_path='/v1', lifespan=lifespan)
+@app.middleware("http")
+async def instrument(request: Request, call_next):
+    """
+    Records the latency of every request per route and reports its stages in a Server-Timing header.
+    """
+    timings = start_request()
+    started = time.perf_counter()
+    response = await call_next(request)
+    elapsed = time.perf_counter() - started
+    route = request.scope.get("route")
+    REQUEST_SECONDS.observe(route.path if route else "unmatched", response.status_code, value=elapsed)
+    response.headers["Server-Timing"] = server_timing({**timings, "total": elapsed})
+    return response
 
 @app.get("/")
 def read_root():
@@ -56,13 +184,40 @@ async def status(searcher: AsyncSearchService = Depends(get_searcher)):
             detail="An unexpected server error occurred."
         )
 
-@app.get("/tf_idf_similarity/{company_id}")
+@app.get("/cache_stats")
+def cache_stats(searcher: AsyncSearchService = Depends(get_searcher)):
+    stats = {"single_flight": searcher.single_flight.stats() if searcher.single_flight else None,
+             "query_encoder": searcher.query_encoder.stats() if searcher.query_encoder else None}
+    if searcher.cache is None:
+        return {"message": "response cache is disabled", **stats}
+    return {**searcher.cache.stats(), **stats}
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics(searcher: AsyncSearchService = Depends(get_searcher)):
+    """
+    Request and stage latency histograms, Elasticsearch round-trips and cache counters in the Prometheus text format.
+    """
+    return render(
+        gauges("similarity_cache", "Response cache statistics.", searcher.cache.stats() if searcher.cache else {}),
+        gauges("similarity_single_flight", "Request coalescing statistics.",
+               searcher.single_flight.stats() if searcher.single_flight else {}),
+        gauges("similarity_query_encoder", "Query embedding statistics.",
+               searcher.query_encoder.stats() if searcher.query_encoder else {}),
+    )
+
+@app.get("/tf_idf_similarity/{company_id}", response_model=SimilarityResponse, response_model_exclude_none=True)
 async def tf_idf_similarity(company_id: int,
-                            size: int = 10, 
+                            size: int = Query(10, ge=1),
                             page: int = 1, 
+                            fields: str | None = None,
+                            filters: dict | None = Depends(parse_filters),
+                            cursor: str | None = None,
                             searcher: AsyncSearchService = Depends(get_searcher)):
     try:
-        return await searcher.tf_idf_similarity(company_id, size, page)
+        if cursor or page == 1:
+            return await searcher.similarity_page("tf_idf_similarity", company_id, size, cursor, parse_fields(fields),
+                                                  cursor_window, filters)
+        return await searcher.tf_idf_similarity(company_id, size, page, parse_fields(fields), filters)
     except HTTPException as http_e:
         raise http_e
     except Exception as e:
@@ -72,13 +227,19 @@ async def tf_idf_similarity(company_id: int,
             detail="An unexpected server error occurred."
         )
 
-@app.get("/semantic_similarity/{company_id}")
+@app.get("/semantic_similarity/{company_id}", response_model=SimilarityResponse, response_model_exclude_none=True)
 async def semantic_similarity(company_id: int, 
-                              size: int = 10, 
+                              size: int = Query(10, ge=1),
                               page: int = 1,
+                              fields: str | None = None,
+                              filters: dict | None = Depends(parse_filters),
+                              cursor: str | None = None,
                               searcher: AsyncSearchService = Depends(get_searcher)):
     try:
-        return await searcher.semantic_similarity(company_id, size, page)
+        if cursor or page == 1:
+            return await searcher.similarity_page("semantic_similarity", company_id, size, cursor, parse_fields(fields),
+                                                  cursor_window, filters)
+        return await searcher.semantic_similarity(company_id, size, page, parse_fields(fields), filters)
     except HTTPException as http_e:
         raise http_e
     except Exception as e:
@@ -88,13 +249,79 @@ async def semantic_similarity(company_id: int,
             detail="An unexpected server error occurred."
         )
 
-@app.get("/dense_vector_similarity/{company_id}")
+@app.get("/dense_vector_similarity/{company_id}", response_model=SimilarityResponse, response_model_exclude_none=True)
 async def dense_vector_similarity(company_id: int, 
-                                  size: int = 10, 
+                                  size: int = Query(10, ge=1),
                                   page: int = 1,
+                                  fields: str | None = None,
+                                  filters: dict | None = Depends(parse_filters),
+                                  cursor: str | None = None,
                                   searcher: AsyncSearchService = Depends(get_searcher)):
     try:
-        return await searcher.dense_vector_similarity(company_id, size, page)
+        if cursor or page == 1:
+            return await searcher.similarity_page("dense_vector_similarity", company_id, size, cursor, parse_fields(fields),
+                                                  cursor_window, filters)
+        return await searcher.dense_vector_similarity(company_id, size, page, parse_fields(fields), filters)
+    except HTTPException as http_e:
+        raise http_e
+    except Exception as e:
+        logger.error(e)
+        raise HTTPException(
+            status_code=HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="An unexpected server error occurred."
+        )
+
+@app.get("/hybrid_similarity/{company_id}", response_model=HybridResponse, response_model_exclude_none=True)
+async def hybrid_similarity(company_id: int,
+                            size: int = Query(10, ge=1),
+                            page: int = Query(1, ge=1),
+                            w_tf_idf: float = 1.0,
+                            w_semantic: float = 1.0,
+                            w_dense_vector: float = 1.0,
+                            rrf_k: int = 60,
+                            fields: str | None = None,
+                            filters: dict | None = Depends(parse_filters),
+                            searcher: AsyncSearchService = Depends(get_searcher)):
+    weights = {
+        "tf_idf_similarity": w_tf_idf,
+        "semantic_similarity": w_semantic,
+        "dense_vector_similarity": w_dense_vector,
+    }
+    try:
+        return await searcher.hybrid_similarity(company_id, size, page, weights, rrf_k,
+                                                hybrid_rank_window, hybrid_timeout, parse_fields(fields), filters)
+    except HTTPException as http_e:
+        raise http_e
+    except Exception as e:
+        logger.error(e)
+        raise HTTPException(
+            status_code=HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="An unexpected server error occurred."
+        )
+
+@app.get("/search", response_model=HybridResponse, response_model_exclude_none=True)
+async def search(q: str,
+                 size: int = Query(10, ge=1),
+                 page: int = Query(1, ge=1),
+                 method: SearchMethod = SearchMethod.hybrid,
+                 w_lexical: float = 1.0,
+                 w_semantic: float = 1.0,
+                 w_dense_vector: float = 1.0,
+                 rrf_k: int = 60,
+                 fields: str | None = None,
+                 filters: dict | None = Depends(parse_filters),
+                 searcher: AsyncSearchService = Depends(get_searcher)):
+    """
+    Searches companies by a free-text query, embedded on-line with the indexing model.
+    """
+    weights = {
+        "lexical": w_lexical,
+        "semantic": w_semantic,
+        "dense_vector": w_dense_vector,
+    }
+    try:
+        return await searcher.text_search(q, size, page, method.value, weights, rrf_k,
+                                          hybrid_rank_window, hybrid_timeout, parse_fields(fields), filters)
     except HTTPException as http_e:
         raise http_e
     except Exception as e:
@@ -102,4 +329,27 @@ async def dense_vector_similarity(company_id: int,
         raise HTTPException(
             status_code=HTTP_500_INTERNAL_SERVER_ERROR,
             detail="An unexpected server error occurred."
-        )
\ No newline at end of file
+        )
+
+@app.post("/{method}/batch")
+async def batch_similarity(method: SimilarityMethod,
+                           batch: BatchRequest,
+                           searcher: AsyncSearchService = Depends(get_searcher)):
+    """
+    Streams the similar companies of every requested company as NDJSON, one line per company.
+    """
+    async def lines():
+        try:
+            async for line in searcher.batch_similarity(method.value,
+                                                        batch.company_ids,
+                                                        batch.size,
+                                                        batch_chunk_size,
+                                                        batch_concurrency,
+                                                        batch.filters.normalized() if batch.filters else None):
+                yield orjson.dumps(line) + b"\n"
+        except Exception as e:
+            # The status code is already sent, report the failure in the stream itself
+            logger.error(e)
+            yield orjson.dumps({"error": "An unexpected server error occurred."}) + b"\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
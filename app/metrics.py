@@ -0,0 +1,186 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+import bisect
+import math
+import time
+import logging
+
+logger = logging.getLogger("uvicorn.error")
+if not logger.hasHandlers():
+    logging.basicConfig(level=logging.INFO, format='    %(levelname)s %(message)s')
+    logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds, from a local lookup to a slow ELSER query
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"') for v in values)
+    return '{' + ','.join(f'{n}="{v}"' for n, v in zip(names, escaped)) + '}'
+
+
+class Counter():
+    """
+    Monotonic counter per label values, rendered in the Prometheus text format.
+    """
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.values = {}
+
+    def inc(self, *label_values, amount: float = 1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        for label_values, value in sorted(self.values.items()):
+            lines.append(f'{self.name}{_labels(self.labels, label_values)} {value}')
+        return lines
+
+
+class Histogram():
+    """
+    Cumulative histogram of observations per label values, rendered in the
+    Prometheus text format.
+    """
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        # Per label values: a count per bucket (the last one is +Inf), the sum and the count
+        self.values = {}
+
+    def observe(self, *label_values, value: float):
+        counts, total = self.values.get(label_values, (None, None))
+        if counts is None:
+            counts, total = [0] * (len(self.buckets) + 1), [0.0, 0]
+            self.values[label_values] = (counts, total)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        total[0] += value
+        total[1] += 1
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        for label_values, (counts, (total, count)) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, math.inf), counts):
+                cumulative += bucket_count
+                le = '+Inf' if bound == math.inf else repr(bound)
+                lines.append(f'{self.name}_bucket{_labels((*self.labels, "le"), (*label_values, le))} {cumulative}')
+            lines.append(f'{self.name}_sum{_labels(self.labels, label_values)} {total}')
+            lines.append(f'{self.name}_count{_labels(self.labels, label_values)} {count}')
+        return lines
+
+
+REQUEST_SECONDS = Histogram('similarity_request_seconds', 'Latency of API requests by route.', ('route', 'status'))
+STAGE_SECONDS = Histogram('similarity_stage_seconds', 'Latency of the stages of a request.', ('stage',))
+ES_REQUESTS = Counter('similarity_es_requests_total', 'Elasticsearch round-trips by operation.', ('operation',))
+METRICS = [REQUEST_SECONDS, STAGE_SECONDS, ES_REQUESTS]
+
+# Stage durations of the current request, set by start_request
+_timings: ContextVar[dict | None] = ContextVar('timings', default=None)
+
+def start_request() -> dict:
+    """
+    Starts collecting the stage durations of the current request. Tasks
+    spawned by the request share the returned dictionary.
+    """
+    timings = {}
+    _timings.set(timings)
+    return timings
+
+@contextmanager
+def timed(stage: str):
+    """
+    Times a stage of the current request. Durations of a stage that runs
+    several times (or concurrently) within a request add up.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.observe(stage, value=elapsed)
+        timings = _timings.get()
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0.0) + elapsed
+
+def es_request(operation: str):
+    """
+    Times an Elasticsearch round-trip as stage es_<operation> and counts it.
+    """
+    ES_REQUESTS.inc(operation)
+    return timed(f'es_{operation}')
+
+def server_timing(timings: dict) -> str:
+    """
+    Formats stage durations as a Server-Timing header value, in milliseconds.
+    """
+    return ', '.join(f'{stage};dur={seconds * 1000:.2f}' for stage, seconds in timings.items())
+
+def gauges(name: str, documentation: str, values: dict) -> list[str]:
+    """
+    Renders the numeric values of a stats dictionary as gauges name_<key>.
+    """
+    lines = []
+    for key, value in values.items():
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            lines += [f'# HELP {name}_{key} {documentation}', f'# TYPE {name}_{key} gauge', f'{name}_{key} {value}']
+    return lines
+
+def render(*extra: list[str]) -> str:
+    """
+    All metrics in the Prometheus text exposition format.
+    """
+    lines = [line for metric in METRICS for line in metric.render()]
+    for more in extra:
+        lines += more
+    return '\n'.join(lines) + '\n'
+
+
+class Progress():
+    """
+    Logs the throughput and ETA of a long-running job every interval seconds.
+    """
+
+    def __init__(self, name: str, total: int | None = None, interval: float = 30.0):
+        self.name = name
+        self.total = total
+        self.interval = interval
+        self.started = time.perf_counter()
+        self.logged_at = self.started
+        self.done = 0
+        self.embedded = 0
+
+    def update(self, done: int, embedded: int = 0):
+        self.done += done
+        self.embedded += embedded
+        if time.perf_counter() - self.logged_at >= self.interval:
+            self.log()
+
+    def report(self) -> dict:
+        seconds = time.perf_counter() - self.started
+        rate = self.done / seconds if seconds else 0.0
+        eta = (self.total - self.done) / rate if self.total and rate and self.done < self.total else None
+        return {
+            "done": self.done,
+            "total": self.total,
+            "seconds": seconds,
+            "docs_per_sec": rate,
+            "embeddings_per_sec": self.embedded / seconds if seconds else 0.0,
+            "eta_seconds": eta
+        }
+
+    def log(self):
+        self.logged_at = time.perf_counter()
+        report = self.report()
+        done = f"{report['done']}/{report['total']}" if report['total'] else str(report['done'])
+        eta = report['eta_seconds']
+        eta = f'{int(eta // 3600)}h{int(eta % 3600 // 60):02d}m{int(eta % 60):02d}s' if eta is not None else 'unknown'
+        logger.info(f"{self.name}: {done} documents, {report['docs_per_sec']:.1f} docs/sec, "
+                    f"{report['embeddings_per_sec']:.1f} embeddings/sec, ETA {eta}")
@@ -0,0 +1,56 @@
+from enum import Enum
+from typing import Any
+from pydantic import BaseModel, Field
+
+class SimilarityMethod(str, Enum):
+    tf_idf_similarity = "tf_idf_similarity"
+    semantic_similarity = "semantic_similarity"
+    dense_vector_similarity = "dense_vector_similarity"
+
+
+class SearchMethod(str, Enum):
+    dense_vector = "dense_vector"
+    hybrid = "hybrid"
+
+
+class CompanyFilters(BaseModel):
+    # Companies have to match one of the values of every given attribute, exactly
+    country: list[str] | None = None
+    state: list[str] | None = None
+    city: list[str] | None = None
+    company_size: list[str] | None = None
+    industries: list[str] | None = None
+
+    def normalized(self) -> dict | None:
+        filters = {k: sorted(set(v)) for k, v in self.model_dump(exclude_none=True).items() if v}
+        return filters or None
+
+
+class BatchRequest(BaseModel):
+    company_ids: list[int]
+    # At most the default cursor window, deeper lists are paged through the similarity endpoints
+    size: int = Field(10, ge=1, le=100)
+    filters: CompanyFilters | None = None
+
+
+class SimilarCompany(BaseModel):
+    id: str
+    score: float | None = None
+    company_id: int
+    name: str | None = None
+    # Source fields requested with the fields query parameter
+    fields: dict[str, Any] | None = None
+    # Rank of the company per similarity method, hybrid_similarity only
+    ranks: dict[str, int] | None = None
+
+
+class SimilarityResponse(BaseModel):
+    total: int = 0
+    max_score: float | None = None
+    hits: list[SimilarCompany] = []
+    # Pass it as cursor to get the next page
+    next_cursor: str | None = None
+
+
+class HybridResponse(SimilarityResponse):
+    methods: dict[str, str] = {}
@@ -0,0 +1,242 @@
+"""
+Offline job that precomputes the top neighbours of every company per similarity method.
+
+    python -m app.neighbours --methods tf_idf_similarity semantic_similarity dense_vector_similarity --top-n 100
+
+Run it after the indexer. Tables record the index version they were computed
+from and the API only serves tables of the current version. dense_vector_similarity is scored locally from the
+vector store with blocked matrix products, the other methods are queried from
+Elasticsearch with one multi GET and one multi search per chunk of companies.
+"""
+from app.searcher import AsyncSearchService, create_async_client
+from app.vectors import ExactVectorIndex, IdRows
+from dotenv import load_dotenv
+import argparse
+import asyncio
+import json
+import numpy as np
+import os
+import shutil
+import time
+import logging
+
+logger = logging.getLogger("uvicorn.error")
+if not logger.hasHandlers():
+    logging.basicConfig(level=logging.INFO, format='    %(levelname)s %(message)s')
+    logger = logging.getLogger(__name__)
+
+class NeighbourTable():
+    """
+    Precomputed neighbours of one similarity method, memory-mapped.
+
+    Row i holds the top_n neighbours of company ids[i] as rows into ids,
+    best first and padded with -1, and their scores. A lookup is a binary
+    search for the company and a slice of its row.
+    """
+
+    FILES = ['ids', 'neighbours', 'scores']
+
+    def __init__(self, path: str):
+        with open(os.path.join(path, 'meta.json')) as meta:
+            self.meta = json.load(meta)
+        for name in self.FILES:
+            setattr(self, name, np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r'))
+        self.id_rows = IdRows(self.ids)
+        self.top_n = self.neighbours.shape[1]
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def row(self, company_id: int) -> int | None:
+        return self.id_rows.row(company_id)
+
+    def search(self, company_id: int, size: int = 10, from_: int = 0) -> tuple[np.ndarray, np.ndarray, int] | None:
+        """
+        Returns the company ids, scores and total number of the precomputed
+        hits from_ to from_ + size, or None if the table cannot answer it:
+        the company is unknown or the page goes deeper than top_n.
+        """
+        row = self.row(company_id)
+        if row is None:
+            return None
+        neighbours = self.neighbours[row]
+        total = int(np.count_nonzero(neighbours >= 0))
+        if total == 0 or (from_ + size > self.top_n and total == self.top_n):
+            return None
+        rows = neighbours[from_:min(from_ + size, total)]
+        return self.ids[rows], np.asarray(self.scores[row, from_:from_ + len(rows)]), total
+
+
+class NeighbourTableWriter():
+    """
+    Writes a NeighbourTable for the given company ids through memory-mapped
+    arrays, filled with set(). Files are written to a temporary directory
+    that close() moves into place, or that is removed when the context
+    manager is left with an exception, so a failed run keeps the old table.
+    index_version is the version of the index the neighbours come from.
+    """
+
+    def __init__(self, path: str, ids: np.ndarray, top_n: int, index_version: str | None = None):
+        self.path = path
+        self.index_version = index_version
+        self.tmp_path = f'{path}.tmp'
+        os.makedirs(self.tmp_path, exist_ok=True)
+        self.ids = np.asarray(ids, dtype=np.int64)
+        np.save(os.path.join(self.tmp_path, 'ids.npy'), self.ids)
+        self.neighbours = np.lib.format.open_memmap(os.path.join(self.tmp_path, 'neighbours.npy'), mode='w+',
+                                                    dtype=np.int32, shape=(len(self.ids), top_n))
+        self.neighbours[:] = -1
+        self.scores = np.lib.format.open_memmap(os.path.join(self.tmp_path, 'scores.npy'), mode='w+',
+                                                dtype=np.float32, shape=(len(self.ids), top_n))
+        self.scores[:] = 0
+        self.id_rows = IdRows(self.ids)
+
+    def rows(self, company_ids) -> np.ndarray:
+        """
+        Rows of the given company ids, -1 for unknown ones.
+        """
+        return self.id_rows.rows(company_ids)
+
+    def set(self, row: int, neighbour_rows: np.ndarray, scores: np.ndarray):
+        count = min(len(neighbour_rows), self.neighbours.shape[1])
+        self.neighbours[row, :count] = neighbour_rows[:count]
+        self.scores[row, :count] = scores[:count]
+
+    def close(self):
+        self.neighbours.flush()
+        self.scores.flush()
+        del self.neighbours, self.scores
+        with open(os.path.join(self.tmp_path, 'meta.json'), 'w') as meta:
+            json.dump({"count": len(self.ids), "built_at": time.strftime('%Y-%m-%dT%H:%M:%S'),
+                       "index_version": self.index_version}, meta)
+        if os.path.isdir(self.path):
+            for name in os.listdir(self.path):
+                os.remove(os.path.join(self.path, name))
+            os.rmdir(self.path)
+        os.replace(self.tmp_path, self.path)
+        logger.info(f'{len(self.ids)} neighbour lists written to {self.path}')
+
+    def __enter__(self):
+        return self
+
+    def abort(self):
+        del self.neighbours, self.scores
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+        logger.warning(f'Discarded the partly written neighbour lists of {self.path}')
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+METHODS = ["tf_idf_similarity", "semantic_similarity", "dense_vector_similarity"]
+
+def load_neighbour_tables(path: str, index_version: str | None = None) -> dict[str, NeighbourTable]:
+    """
+    Loads the neighbour table of every method found under path. Given an
+    index_version, tables computed from another version of the index are
+    skipped, so their methods are queried live until the tables are rebuilt.
+    """
+    tables = {}
+    for method in METHODS:
+        if os.path.isfile(os.path.join(path, method, 'meta.json')):
+            table = NeighbourTable(os.path.join(path, method))
+            if index_version is not None and table.meta.get('index_version') != index_version:
+                logger.warning(f"Neighbours of {method} were computed from another index version, rerun app.neighbours.")
+                continue
+            tables[method] = table
+            logger.info(f"Serving {method} of {len(table)} companies from precomputed neighbours.")
+    return tables
+
+def neighbour_tables_stamp(path: str) -> tuple:
+    """
+    Modification times of the tables under path, which change whenever a table is written.
+    """
+    meta_paths = [os.path.join(path, method, 'meta.json') for method in METHODS]
+    return tuple(os.path.getmtime(p) if os.path.isfile(p) else None for p in meta_paths)
+
+def dense_neighbours(vectors: ExactVectorIndex, path: str, top_n: int = 100, scratch_bytes: int = 256 * 2**20,
+                     index_version: str | None = None):
+    """
+    Exact top_n neighbours by dot product for every vector, scoring blocks
+    of queries against all vectors at once within scratch_bytes of scores.
+    """
+    count = len(vectors)
+    top_n = min(top_n, count)
+    block_size = max(1, scratch_bytes // (4 * count))
+    with NeighbourTableWriter(path, vectors.ids, top_n, index_version) as writer:
+        for start in range(0, count, block_size):
+            queries = np.asarray(vectors.matrix[start:start + block_size], dtype=np.float32)
+            scores = np.empty((len(queries), count), dtype=np.float32)
+            for column in range(0, count, vectors.block_size):
+                block = np.asarray(vectors.matrix[column:column + vectors.block_size], dtype=np.float32)
+                scores[:, column:column + len(block)] = queries @ block.T
+            top = np.argpartition(-scores, top_n - 1, axis=1)[:, :top_n]
+            top_scores = np.take_along_axis(scores, top, axis=1)
+            order = np.argsort(-top_scores, axis=1, kind='stable')
+            # Rows of the vector store are rows of the table, as it is written with the same ids
+            writer.neighbours[start:start + len(queries)] = np.take_along_axis(top, order, axis=1)
+            writer.scores[start:start + len(queries)] = (1 + np.take_along_axis(top_scores, order, axis=1)) / 2
+            logger.info(f'dense_vector_similarity: {min(start + block_size, count)}/{count} companies')
+
+async def search_neighbours(service: AsyncSearchService,
+                            method: str,
+                            ids: np.ndarray,
+                            path: str,
+                            top_n: int = 100,
+                            chunk_size: int = 100,
+                            concurrency: int = 4,
+                            index_version: str | None = None):
+    """
+    Top_n neighbours of every company as returned by the live method, queried in batches.
+    """
+    done = 0
+    failed = 0
+    with NeighbourTableWriter(path, ids, top_n, index_version) as writer:
+        async for line in service.batch_similarity(method, ids.tolist(), top_n, chunk_size, concurrency):
+            done += 1
+            if 'response' not in line:
+                failed += 1
+                continue
+            hits = line['response']['hits']
+            rows = writer.rows([h['company_id'] for h in hits])
+            known = rows >= 0
+            writer.set(int(writer.rows([line['company_id']])[0]), rows[known],
+                       np.asarray([h['score'] or 0 for h in hits], dtype=np.float32)[known])
+            if done % (chunk_size * 100) == 0:
+                logger.info(f'{method}: {done}/{len(ids)} companies')
+    logger.info(f'{method}: {done} companies, {failed} failed and left to the live query.')
+
+async def build(methods: list[str], path: str, top_n: int, chunk_size: int, concurrency: int):
+    vectors = ExactVectorIndex(os.getenv("VECTOR_STORE_PATH", "data/embeddings"))
+    service = AsyncSearchService(str(os.getenv("ELASTIC_INDEX")), create_async_client())
+    try:
+        # Read before querying, so a version published during the run leaves the tables stale rather than mixed
+        index_version = await service.index_version()
+        for method in methods:
+            started = time.perf_counter()
+            if method == "dense_vector_similarity":
+                await asyncio.to_thread(dense_neighbours, vectors, os.path.join(path, method), top_n,
+                                        index_version=index_version)
+            else:
+                await search_neighbours(service, method, vectors.ids, os.path.join(path, method),
+                                        top_n, chunk_size, concurrency, index_version)
+            logger.info(f'{method} neighbours computed in {time.perf_counter() - started:.1f}s')
+    finally:
+        await service.close()
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--methods', nargs='+', default=METHODS)
+    parser.add_argument('--path', default=os.getenv("NEIGHBOUR_TABLES_PATH", "data/neighbours"))
+    parser.add_argument('--top-n', type=int, default=int(os.getenv("NEIGHBOUR_TOP_N", 100)))
+    parser.add_argument('--chunk-size', type=int, default=int(os.getenv("BATCH_CHUNK_SIZE", 100)))
+    parser.add_argument('--concurrency', type=int, default=int(os.getenv("BATCH_CONCURRENCY", 4)))
+    args = parser.parse_args()
+    asyncio.run(build(args.methods, args.path, args.top_n, args.chunk_size, args.concurrency))
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,22 @@
 from fastapi import HTTPException
-from starlette.status import HTTP_404_NOT_FOUND
-from elasticsearch import AsyncElasticsearch
+from starlette.status import HTTP_400_BAD_REQUEST, HTTP_404_NOT_FOUND
+from elasticsearch import AsyncElasticsearch, NotFoundError
 from dotenv import load_dotenv
+from app.vectors import ExactVectorIndex, IVFIndex, decode_vector, hits_response
+from app.cache import ResponseCache
+from app.singleflight import SingleFlight
+from app.fusion import reciprocal_rank_fusion
+from app.embedding import QueryEncoder
+from app.metrics import es_request, timed
+from app.helper import process_texts
+from collections import deque
+from typing import AsyncGenerator
+import base64
+import binascii
+import functools
+import json
+import math
+import asyncio
 import os
 import logging
 
@@ -10,154 +25,725 @@ if not logger.hasHandlers():
     logging.basicConfig(level=logging.INFO, format='    %(levelname)s %(message)s')
     logger = logging.getLogger(__name__)
 
-class AsyncSearcher():
+# Source fields returned for every hit, fields requested on top of them are
+# returned under "fields", embeddings and inference output never are
+DEFAULT_FIELDS = ['company_id', 'name']
+EXCLUDED_FIELDS = ['full_description_embedding', '*_semantic']
+
+def source_filter(fields: list | None = None) -> dict:
+    return {"includes": sorted(set(DEFAULT_FIELDS).union(fields or [])), "excludes": EXCLUDED_FIELDS}
+
+def project_response(response: dict) -> dict:
+    """
+    Slims a search response down to the id, score, company_id and name of its
+    hits (see models.SimilarityResponse). Failed searches stay empty.
+    """
+    response = getattr(response, 'body', response)
+    if not response:
+        return {}
+    hits = []
+    for hit in response['hits']['hits']:
+        source = dict(hit.get('_source', {}))
+        projected = {
+            "id": hit['_id'],
+            "score": hit.get('_score'),
+            "company_id": int(source.pop('company_id', hit['_id'])),
+            "name": source.pop('name', None)
+        }
+        if source:
+            projected['fields'] = source
+        if '_ranks' in hit:
+            projected['ranks'] = hit['_ranks']
+        hits.append(projected)
+    return {
+        "total": response['hits']['total']['value'],
+        "max_score": response['hits'].get('max_score'),
+        "hits": hits
+    }
+
+# Attribute filters and the keyword fields they match exactly, values of one
+# attribute are alternatives and all attributes have to match
+FILTER_FIELDS = {
+    "country": "country.keyword",
+    "state": "state.keyword",
+    "city": "city.keyword",
+    "company_size": "company_size.keyword",
+    "industries": "industries.keyword",
+}
+
+def filter_clauses(filters: dict | None) -> list[dict]:
+    """
+    Compiles attribute filters into filter context clauses, which Elasticsearch
+    applies while collecting candidates and caches across queries.
+    """
+    clauses = []
+    for attribute, values in sorted((filters or {}).items()):
+        if not values:
+            continue
+        if attribute == "industries":
+            # Industries are indexed normalized, see helper.process_texts
+            values = process_texts(values)
+        clauses.append({"terms": {FILTER_FIELDS[attribute]: sorted(values)}})
+    return clauses
+
+# Deepest hit Elasticsearch returns by default (index.max_result_window)
+MAX_RESULT_WINDOW = 10000
+
+def encode_cursor(state: dict) -> str:
+    return base64.urlsafe_b64encode(json.dumps(state, separators=(',', ':')).encode()).decode()
+
+def is_string_list(value) -> bool:
+    return isinstance(value, list) and all(isinstance(v, str) for v in value)
 
-    def __init__(self, index_name):
-        load_dotenv()
-        es_host = os.getenv("ELASTIC_HOST")
-        es_pass = os.getenv("ELASTIC_PASSWORD")
-        crt_path = os.getenv("CERT_PATH")
-        self.client = AsyncElasticsearch(
-            str(es_host),
-            ca_certs=str(crt_path),
-            basic_auth=("elastic", str(es_pass)),
-            request_timeout=600,
-            verify_certs=False
+def decode_cursor(cursor: str) -> dict:
+    try:
+        state = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, UnicodeError, ValueError):
+        state = None
+    # A cursor that decodes is still client input, a page needs a position and a positive size, and fields and
+    # filters go into the query, so they must have the shapes the query parameters would have given them
+    if not isinstance(state, dict) or not all(isinstance(state.get(k), int) for k in ('offset', 'size')) \
+            or state['offset'] < 0 or state['size'] < 1 \
+            or not (state.get('fields') is None or is_string_list(state['fields'])) \
+            or not (state.get('filters') is None or isinstance(state['filters'], dict) and all(
+                k in FILTER_FIELDS and is_string_list(v) for k, v in state['filters'].items())):
+        raise HTTPException(
+            status_code=HTTP_400_BAD_REQUEST,
+            detail="Invalid cursor"
         )
+    return state
+
+def create_async_client() -> AsyncElasticsearch:
+    """
+    Creates the Elasticsearch client that is meant to be shared by all
+    requests of the process, sized by the ES_* environment variables.
+    """
+    load_dotenv()
+    es_host = os.getenv("ELASTIC_HOST")
+    es_pass = os.getenv("ELASTIC_PASSWORD")
+    crt_path = os.getenv("CERT_PATH")
+    return AsyncElasticsearch(
+        str(es_host),
+        ca_certs=str(crt_path),
+        basic_auth=("elastic", str(es_pass)),
+        connections_per_node=int(os.getenv("ES_CONNECTIONS_PER_NODE", 50)),
+        request_timeout=float(os.getenv("ES_REQUEST_TIMEOUT", 600)),
+        max_retries=int(os.getenv("ES_MAX_RETRIES", 3)),
+        retry_on_timeout=True,
+        verify_certs=False
+    )
+
+
+class AsyncSearcher():
+
+    def __init__(self, index_name, client: AsyncElasticsearch | None = None):
+        # A searcher that creates its own client also closes it, a shared client is closed by its owner
+        self.owns_client = client is None
+        self.client = client if client is not None else create_async_client()
         self.index_name = index_name
 
     async def status(self):
         # return await self.client.indices.get(index=self.index_name)
         try:
-            return await self.client.indices.stats(index=self.index_name)
+            # Also covers the versions behind the alias, including one still being built
+            with es_request('stats'):
+                return await self.client.indices.stats(index=f'{self.index_name},{self.index_name}-*')
         except Exception as e:
             logger.error(f"An error occurred: {e}")
             return {"message": "please wait for the index to be ready"}
 
     async def search_index(self, query: dict, size: int = 10, from_: int = 0, fields: list|None = None):
         """
-        Searches a given index with a specified query asynchronously.
+        Searches a given index with a specified query asynchronously,
+        returning only the default and the requested source fields.
         """
         try:
-            response = await self.client.search(index=self.index_name, query=query, size=size, from_=from_)
+            with es_request('search'):
+                response = await self.client.search(index=self.index_name, query=query, size=size, from_=from_,
+                                                    source=source_filter(fields))
             return response
         except Exception as e:
             logger.error(f"An error occurred during the search: {e}")
             return {}
         
-    async def knn_index(self, knn: dict, size: int = 10, from_: int = 0):
+    async def get_document(self, doc_id: str, source_includes: list|None = None):
+        """
+        Fetches a single document by id with a realtime GET, returns None if it does not exist.
+        """
+        try:
+            with es_request('get'):
+                return await self.client.get(index=self.index_name, id=doc_id, source_includes=source_includes)
+        except NotFoundError:
+            return None
+        except Exception as e:
+            logger.error(f"An error occurred during the get: {e}")
+            return None
+
+    async def knn_index(self, knn: dict, size: int = 10, from_: int = 0, fields: list|None = None):
         """
-        Searches a given index with a specified query asynchronously.
+        Searches a given index with a specified query asynchronously,
+        returning only the default and the requested source fields.
         """
         try:
-            response = await self.client.search(index=self.index_name, knn=knn, size=size, from_=from_)
+            with es_request('knn'):
+                response = await self.client.search(index=self.index_name, knn=knn, size=size, from_=from_,
+                                                    source=source_filter(fields))
             return response
         except Exception as e:
             logger.error(f"An error occurred during the search: {e}")
             return {}
 
+    async def get_documents(self, doc_ids: list[str], source_includes: list|None = None,
+                            source_excludes: list|None = None) -> dict:
+        """
+        Fetches many documents by id with a single realtime multi GET.
+        Returns a dictionary of the sources of the documents that exist.
+        """
+        try:
+            with es_request('mget'):
+                response = await self.client.mget(index=self.index_name, ids=doc_ids, source_includes=source_includes,
+                                                  source_excludes=source_excludes)
+            return {d['_id']: d.get('_source', {}) for d in response['docs'] if d.get('found')}
+        except Exception as e:
+            logger.error(f"An error occurred during the multi get: {e}")
+            return {}
+
+    async def msearch_index(self, bodies: list[dict]) -> list[dict]:
+        """
+        Runs many searches in a single round-trip, returns one response (or error) per body.
+        """
+        searches = []
+        for body in bodies:
+            searches.extend([{"index": self.index_name}, body])
+        try:
+            with es_request('msearch'):
+                response = await self.client.msearch(searches=searches)
+            return response['responses']
+        except Exception as e:
+            logger.error(f"An error occurred during the multi search: {e}")
+            return [{"error": str(e)} for _ in bodies]
+
+    async def index_version(self) -> str:
+        """
+        Identifies the data behind index_name by the uuids of its concrete
+        indices and the data_version a delta run of the indexer bumps in their _meta.
+        """
+        settings = await self.client.indices.get_settings(index=self.index_name, name='index.uuid')
+        mappings = await self.client.indices.get_mapping(index=self.index_name, filter_path='*.mappings._meta')
+        # Indices without a _meta are left out of the filtered response
+        versions = {i: m['mappings']['_meta'].get('data_version', 0) for i, m in (mappings.body or {}).items()}
+        return ','.join(sorted(f"{s['settings']['index']['uuid']}:{versions.get(i, 0)}"
+                               for i, s in settings.body.items()))
+
     async def close(self):
         """
-        Closes the Elasticsearch client connection.
+        Closes the Elasticsearch client connection, unless it is shared.
         """
-        await self.client.close()
+        if self.owns_client:
+            await self.client.close()
+
+
+def shared(method):
+    """
+    Serves a similarity method from the service's response cache and
+    coalesces identical concurrent calls into one, if the service has them.
+    """
+    @functools.wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        key = (method.__name__, *args, sorted(kwargs.items()))
+
+        async def compute():
+            response = await method(self, *args, **kwargs)
+            # Share the plain body rather than the client's response wrapper
+            return getattr(response, 'body', response)
+
+        if self.single_flight is not None:
+            compute = functools.partial(self.single_flight.do, json.dumps(key, default=str), compute)
+        if self.cache is not None:
+            return await self.cache.get_or_compute(key, compute)
+        return await compute()
+    return wrapper
 
 
 class AsyncSearchService(AsyncSearcher):
 
-    def __init__(self, index_name):
-        super().__init__(index_name)
+    def __init__(self,
+                 index_name,
+                 client: AsyncElasticsearch | None = None,
+                 vector_index: ExactVectorIndex | IVFIndex | None = None,
+                 cache: ResponseCache | None = None,
+                 single_flight: SingleFlight | None = None,
+                 neighbour_tables: dict | None = None,
+                 query_encoder: QueryEncoder | None = None):
+        super().__init__(index_name, client)
+        # Optional in-process engine that answers dense_vector_similarity without Elasticsearch
+        self.vector_index = vector_index
+        self.cache = cache
+        self.single_flight = single_flight
+        # Precomputed neighbours per method (see app.neighbours), the live queries are the fallback
+        self.neighbour_tables = neighbour_tables or {}
+        # Embeds free-text queries for text_search, the model is only loaded on the first query
+        self.query_encoder = query_encoder
 
-    async def tf_idf_similarity(self, company_id: int, size: int = 10, page: int = 1):
-        from_ = page*size - size
-        match_query = {
-            "terms": {
-                "company_id.keyword": [company_id]
-            }
-        }
-        match_result = await super().search_index(match_query)
-        try:
-            match_id = match_result['hits']['hits'][0]['_id']
-        except Exception as e:
+    # Tuning knobs of the queries, see bench.evaluate for their recall/latency trade-off
+    mlt_max_query_terms = 12
+    mlt_min_term_freq = 1
+    semantic_industries_boost = 2.0
+    semantic_description_boost = 1.5
+    knn_k = 0
+    knn_num_candidates = 100
+
+    # Source fields of the seed company each method builds its query from
+    SEED_FIELDS = {
+        "tf_idf_similarity": None,
+        "semantic_similarity": ['full_description', 'industries'],
+        "dense_vector_similarity": ['full_description_embedding'],
+    }
+
+    async def seed_source(self, company_id: int, fields: list) -> dict:
+        """
+        Returns the requested source fields of a company, documents are keyed by company_id.
+        """
+        seed = await super().get_document(str(company_id), source_includes=fields)
+        if seed is None:
             raise HTTPException(
             status_code=HTTP_404_NOT_FOUND,
             detail="Company not found"
         )
-        mlt_query = {
+        return seed['_source']
+
+    def tf_idf_query(self, company_id: int, filters: dict | None = None) -> dict:
+        # The seed is referenced by id, so Elasticsearch fetches it itself and one search is enough
+        query = {
             "more_like_this": {
                 "fields": ["industries", "specialities", "description"],
                 "like": [
                     {
                         "_index": self.index_name,
-                        "_id": match_id
+                        "_id": str(company_id)
                     }
                 ],
-                "min_term_freq": 1,
-                "max_query_terms": 12,
+                "min_term_freq": self.mlt_min_term_freq,
+                "max_query_terms": self.mlt_max_query_terms,
                 "include": True
             }
         }
-        mlt_result = await super().search_index(mlt_query, size, from_)
-        return mlt_result
-    
-    async def semantic_similarity(self, company_id: int, size: int = 10, page: int = 1):
-        from_ = page*size - size
-        match_query = {
-            "terms": {
-                "company_id.keyword": [company_id]
-            }
-        }
-        match_result = await super().search_index(match_query)
-        try:
-            full_description = match_result['hits']['hits'][0]['_source']['full_description']
-            industries = match_result['hits']['hits'][0]['_source']['industries']
-        except Exception as e:
-            raise HTTPException(
-            status_code=HTTP_404_NOT_FOUND,
-            detail="Company not found"
-        )
-        semantic_query = {
+        clauses = filter_clauses(filters)
+        return {"bool": {"must": query, "filter": clauses}} if clauses else query
+
+    def semantic_query(self, seed: dict, filters: dict | None = None) -> dict:
+        return {
             "bool": {
+                "filter": filter_clauses(filters),
                 "must": {
                     "multi_match": {
                         "fields": ["industries"],
-                        "query": str(industries),
-                        "boost": 2,
+                        "query": str(seed.get('industries', [])),
+                        "boost": self.semantic_industries_boost,
                     }
                 },
                 "should": {
                     "semantic": {
                         "field": "full_description_semantic",
-                        "query": full_description,
-                        "boost": 1.5,
+                        "query": seed.get('full_description', ''),
+                        "boost": self.semantic_description_boost,
                     }
                 },
             }
         }
-        semantic_result = await super().search_index(semantic_query, size, from_)
-        return semantic_result
+
+    def knn_query(self, seed: dict, k: int, filters: dict | None = None) -> dict:
+        # k has to cover from + size, hits beyond k are never returned
+        k = max(k, self.knn_k)
+        knn = {
+            "field": 'full_description_embedding',
+            # Indexed with EMBEDDING_ENCODING=base64, the seed's source holds a base64 string
+            "query_vector": decode_vector(seed['full_description_embedding']),
+            "k": k,
+            "num_candidates": max(self.knn_num_candidates, k)
+        }
+        clauses = filter_clauses(filters)
+        if clauses:
+            # Filtered during the graph search, so the k hits all match without raising num_candidates
+            knn["filter"] = clauses
+        return knn
+
+    def search_body(self, method: str, company_id: int, seed: dict, size: int = 10, from_: int = 0,
+                    filters: dict | None = None) -> dict:
+        """
+        Builds the search request body of a similarity method, as sent in a multi search.
+        """
+        body = {"size": size, "from": from_, "_source": source_filter()}
+        if method == "tf_idf_similarity":
+            return {"query": self.tf_idf_query(company_id, filters), **body}
+        if method == "semantic_similarity":
+            return {"query": self.semantic_query(seed, filters), **body}
+        return {"knn": self.knn_query(seed, from_ + size, filters), **body}
+
+    @shared
+    async def tf_idf_similarity(self, company_id: int, size: int = 10, page: int = 1, fields: list | None = None,
+                                filters: dict | None = None):
+        from_ = page*size - size
+        precomputed = self.precomputed("tf_idf_similarity", company_id, size, from_, filters)
+        if precomputed is not None:
+            return await self.local_response(precomputed, fields)
+        mlt_result = await super().search_index(self.tf_idf_query(company_id, filters), size, from_, fields)
+        # No hits at all can also mean the seed has no terms to match on or the filters left everything out,
+        # so only a seed that does not exist is not found
+        if mlt_result and mlt_result['hits']['total']['value'] == 0 and \
+                await super().get_document(str(company_id), []) is None:
+            raise HTTPException(
+            status_code=HTTP_404_NOT_FOUND,
+            detail="Company not found"
+        )
+        return project_response(mlt_result)
     
-    async def dense_vector_similarity(self, company_id: int, size: int = 10, page: int = 1):
+    @shared
+    async def semantic_similarity(self, company_id: int, size: int = 10, page: int = 1, fields: list | None = None,
+                                  filters: dict | None = None):
         from_ = page*size - size
-        match_query = {
-            "terms": {
-                "company_id.keyword": [company_id]
-            }
-        }
-        try:
-            match_result = await super().search_index(match_query, fields=['full_description_embedding'])
-            full_description_embedding = match_result['hits']['hits'][0]['_source']['full_description_embedding']
-        except Exception as e:
+        precomputed = self.precomputed("semantic_similarity", company_id, size, from_, filters)
+        if precomputed is not None:
+            return await self.local_response(precomputed, fields)
+        seed = await self.seed_source(company_id, self.SEED_FIELDS["semantic_similarity"])
+        semantic_result = await super().search_index(self.semantic_query(seed, filters), size, from_, fields)
+        return project_response(semantic_result)
+    
+    async def local_knn(self, company_id: int, size: int = 10, from_: int = 0) -> dict | None:
+        """
+        Answers a dense vector query from the in-process vector engine, if there is one and it knows the company.
+        """
+        # One reference for the whole request, the API swaps in a reopened index when a new version is published
+        vector_index = self.vector_index
+        if vector_index is None:
+            return None
+        query_vector = vector_index.vector(company_id)
+        if query_vector is None:
+            return None
+        with timed('local_vector'):
+            ids, scores = await asyncio.to_thread(vector_index.search, query_vector, size, from_)
+        return hits_response(self.index_name, ids, scores, len(vector_index))
+
+    def precomputed(self, method: str, company_id: int, size: int = 10, from_: int = 0,
+                    filters: dict | None = None) -> dict | None:
+        """
+        Answers a similarity query from the precomputed neighbours of the method, if it can.
+        Filtered queries always go to Elasticsearch, the tables only hold unfiltered neighbours.
+        """
+        table = self.neighbour_tables.get(method)
+        if table is None or filter_clauses(filters):
+            return None
+        with timed('precomputed'):
+            found = table.search(company_id, size, from_)
+        if found is None:
+            return None
+        ids, scores, total = found
+        return hits_response(self.index_name, ids, scores, total)
+
+    async def fill_sources(self, hits: list[dict], fields: list | None = None) -> list[dict]:
+        """
+        Fills in the default and requested source fields of the hits computed
+        without Elasticsearch (precomputed or by the local vector engine),
+        which carry the company_id only, with one multi GET.
+        """
+        local = [h for h in hits if set(h.get('_source', {})) <= {'company_id'}]
+        if local:
+            # The same source filter as the searches, so embeddings are never returned
+            source = source_filter(fields)
+            sources = await super().get_documents(list(dict.fromkeys(h['_id'] for h in local)),
+                                                  source['includes'], source['excludes'])
+            for hit in local:
+                hit['_source'] = sources.get(hit['_id'], hit.get('_source', {}))
+        return hits
+
+    async def fetch_sources(self, response: dict, fields: list | None = None) -> dict:
+        """
+        Fills in the source fields of the hits of a response, see fill_sources.
+        """
+        await self.fill_sources(response['hits']['hits'], fields)
+        return response
+
+    async def local_response(self, response: dict, fields: list | None = None) -> dict:
+        """
+        Projects a response computed without Elasticsearch, see fetch_sources.
+        """
+        return project_response(await self.fetch_sources(response, fields))
+
+    @shared
+    async def dense_vector_similarity(self, company_id: int, size: int = 10, page: int = 1,
+                                      fields: list | None = None, filters: dict | None = None):
+        from_ = page*size - size
+        precomputed = self.precomputed("dense_vector_similarity", company_id, size, from_, filters)
+        if precomputed is not None:
+            return await self.local_response(precomputed, fields)
+        # The local engines hold no attributes, filtered queries go to Elasticsearch
+        local_result = await self.local_knn(company_id, size, from_) if not filter_clauses(filters) else None
+        if local_result is not None:
+            return await self.local_response(local_result, fields)
+        seed = await self.seed_source(company_id, self.SEED_FIELDS["dense_vector_similarity"])
+        if 'full_description_embedding' not in seed:
             raise HTTPException(
             status_code=HTTP_404_NOT_FOUND,
             detail="Company not found"
         )
-        knn_query = {
-            "field": 'full_description_embedding',
-            "query_vector": full_description_embedding,
-            "k": size,
-            "num_candidates": 100
+        knn_result = await super().knn_index(self.knn_query(seed, from_ + size, filters), size, from_, fields)
+        return project_response(knn_result)
+
+    async def similarity_page(self,
+                              method: str,
+                              company_id: int,
+                              size: int = 10,
+                              cursor: str | None = None,
+                              fields: list | None = None,
+                              window: int = 100,
+                              filters: dict | None = None) -> dict:
+        """
+        Returns a page of similar companies and the opaque cursor of the next page.
+
+        The method ranks a candidate list of a multiple of window hits once,
+        which the response cache keeps per company, method, fields and filters, and
+        every page is a slice of it. So page N costs about the same as page
+        1, a deeper candidate list is only ranked when paging past the end
+        of the current one.
+        """
+        offset = 0
+        if cursor:
+            state = decode_cursor(cursor)
+            if state.get('method') != method or state.get('company_id') != company_id:
+                raise HTTPException(
+                    status_code=HTTP_400_BAD_REQUEST,
+                    detail="Invalid cursor"
+                )
+            offset, size, fields, filters = state['offset'], state['size'], state.get('fields'), state.get('filters')
+        candidates = min(window * math.ceil((offset + size) / window), MAX_RESULT_WINDOW)
+        response = await getattr(self, method)(company_id, candidates, 1, fields, filters)
+        if not response:
+            return response
+        page = {**response, "hits": response['hits'][offset:offset + size]}
+        end = offset + size
+        # A full candidate list may go on, a shorter one is everything there is
+        if end < MAX_RESULT_WINDOW and (end < len(response['hits']) or len(response['hits']) == candidates):
+            page['next_cursor'] = encode_cursor({"method": method, "company_id": company_id, "offset": end,
+                                                 "size": size, "fields": fields, "filters": filters})
+        return page
+
+    @shared
+    async def hybrid_similarity(self,
+                                company_id: int,
+                                size: int = 10,
+                                page: int = 1,
+                                weights: dict | None = None,
+                                rrf_k: int = 60,
+                                rank_window: int = 50,
+                                timeout: float = 1.0,
+                                fields: list | None = None,
+                                filters: dict | None = None):
+        """
+        Runs the three similarity methods concurrently from one shared seed
+        fetch and fuses their rankings with reciprocal rank fusion.
+
+        Every method retrieves its top max(rank_window, page * size) hits and
+        gets at most timeout seconds, a method that is slower or fails is left
+        out of the fusion and reported in "methods".
+        """
+        from_ = page*size - size
+        window = max(rank_window, from_ + size)
+        seed_fields = sorted({f for fs in self.SEED_FIELDS.values() if fs for f in fs})
+        seed = await self.seed_source(company_id, seed_fields)
+
+        async def dense_vector():
+            local_result = await self.local_knn(company_id, window) if not filter_clauses(filters) else None
+            if local_result is not None:
+                return local_result
+            return await self.knn_index(self.knn_query(seed, window, filters), window, 0, fields)
+
+        async def ranking(method: str, search) -> dict:
+            # Precomputed neighbours answer without a round-trip
+            precomputed = self.precomputed(method, company_id, window, 0, filters)
+            return precomputed if precomputed is not None else await search()
+
+        searches = {
+            "tf_idf_similarity": ranking("tf_idf_similarity", lambda: self.search_index(
+                self.tf_idf_query(company_id, filters), window, 0, fields)),
+            "semantic_similarity": ranking("semantic_similarity", lambda: self.search_index(
+                self.semantic_query(seed, filters), window, 0, fields)),
+            "dense_vector_similarity": ranking("dense_vector_similarity", dense_vector),
         }
-        knn_result = await super().knn_index(knn_query, size, from_)
-        return knn_result
+        return await self.fuse(f"hybrid_similarity of {company_id}", searches, weights, rrf_k, timeout, from_, size,
+                               fields)
+
+    async def fuse(self, label: str, searches: dict, weights: dict | None, rrf_k: int, timeout: float,
+                   from_: int, size: int, fields: list | None = None) -> dict:
+        """
+        Awaits the rankings concurrently, each within timeout seconds, and fuses
+        the ones that succeeded with reciprocal rank fusion. The outcome of
+        every ranking is reported in "methods". Hits of the page that only
+        locally computed rankings returned get their sources from one multi GET.
+        """
+        responses = await asyncio.gather(*(asyncio.wait_for(s, timeout) for s in searches.values()),
+                                         return_exceptions=True)
+        rankings = {}
+        methods = {}
+        for method, response in zip(searches, responses):
+            if isinstance(response, asyncio.TimeoutError):
+                methods[method] = "timeout"
+            elif isinstance(response, Exception) or not response:
+                methods[method] = "error"
+            else:
+                methods[method] = "ok"
+                rankings[method] = response['hits']['hits']
+        if "timeout" in methods.values():
+            logger.warning(f"{label}: {methods}")
+
+        hits = reciprocal_rank_fusion(rankings, weights, rrf_k)
+        return {
+            "methods": methods,
+            **project_response({
+                "hits": {
+                    "total": {"value": len(hits), "relation": "eq"},
+                    "max_score": hits[0]['_score'] if hits else None,
+                    "hits": await self.fill_sources(hits[from_:from_ + size], fields)
+                }
+            })
+        }
+
+    def text_query(self, q: str, filters: dict | None = None) -> dict:
+        return {
+            "bool": {
+                "must": {
+                    "multi_match": {
+                        "query": q,
+                        "fields": ["name^3", "industries^2", "specialities^2", "full_description"],
+                    }
+                },
+                "filter": filter_clauses(filters),
+            }
+        }
+
+    async def query_knn(self, q: str, size: int = 10, from_: int = 0, fields: list | None = None,
+                        filters: dict | None = None) -> dict:
+        """
+        Dense vector search for a free-text query, embedded on-line by the query encoder.
+        Returns the search response, not projected, hits of the local vector
+        engine carry the company_id only (see fill_sources).
+        """
+        if self.query_encoder is None:
+            raise HTTPException(
+                status_code=HTTP_400_BAD_REQUEST,
+                detail="Query embedding is disabled"
+            )
+        with timed('query_encode'):
+            query_vector = await self.query_encoder.encode(q)
+        vector_index = self.vector_index
+        if vector_index is not None and not filter_clauses(filters):
+            with timed('local_vector'):
+                ids, scores = await asyncio.to_thread(vector_index.search, query_vector, size, from_)
+            return hits_response(self.index_name, ids, scores, len(vector_index))
+        knn = self.knn_query({"full_description_embedding": query_vector.tolist()}, from_ + size, filters)
+        return await super().knn_index(knn, size, from_, fields)
+
+    @shared
+    async def text_search(self,
+                          q: str,
+                          size: int = 10,
+                          page: int = 1,
+                          method: str = "hybrid",
+                          weights: dict | None = None,
+                          rrf_k: int = 60,
+                          rank_window: int = 50,
+                          timeout: float = 1.0,
+                          fields: list | None = None,
+                          filters: dict | None = None):
+        """
+        Searches companies by a free-text query.
+
+        "dense_vector" ranks by the embedding of the query alone, "hybrid"
+        fuses it with a lexical match on the names, industries, specialities
+        and descriptions and a semantic_text match on the descriptions, like
+        hybrid_similarity.
+        """
+        from_ = page*size - size
+        if method == "dense_vector":
+            return await self.local_response(await self.query_knn(q, size, from_, fields, filters), fields)
+        window = max(rank_window, from_ + size)
+        semantic = {"semantic": {"field": "full_description_semantic", "query": q}}
+        searches = {
+            "lexical": self.search_index(self.text_query(q, filters), window, 0, fields),
+            "semantic": self.search_index({"bool": {"must": semantic, "filter": filter_clauses(filters)}},
+                                          window, 0, fields),
+        }
+        if self.query_encoder is not None:
+            searches["dense_vector"] = self.query_knn(q, window, 0, fields, filters)
+        return await self.fuse(f"text_search of {q!r}", searches, weights, rrf_k, timeout, from_, size, fields)
+
+    async def batch_similarity(self,
+                               method: str,
+                               company_ids: list[int],
+                               size: int = 10,
+                               chunk_size: int = 100,
+                               concurrency: int = 4,
+                               filters: dict | None = None) -> AsyncGenerator[dict, None]:
+        """
+        Yields {"company_id", "response"} (or {"company_id", "error"}) for every
+        company, in order.
+
+        Companies are processed in chunks of chunk_size, each chunk costs one
+        multi GET for the seeds and one multi search for the queries. At most
+        concurrency chunks are in flight, so memory stays bounded no matter
+        how many companies are requested.
+        """
+        pending = deque()
+        chunks = (company_ids[i:i + chunk_size] for i in range(0, len(company_ids), chunk_size))
+        try:
+            for chunk in chunks:
+                pending.append(asyncio.ensure_future(self._batch_chunk(method, chunk, size, filters)))
+                if len(pending) >= concurrency:
+                    for line in await pending.popleft():
+                        yield line
+            while pending:
+                for line in await pending.popleft():
+                    yield line
+        finally:
+            # The client may stop reading early, do not leave chunks running
+            for task in pending:
+                task.cancel()
+
+    async def _batch_chunk(self, method: str, company_ids: list[int], size: int,
+                           filters: dict | None = None) -> list[dict]:
+        results = {}
+        if method == "dense_vector_similarity" and not filter_clauses(filters):
+            local_results = {}
+            for company_id in company_ids:
+                local_result = await self.local_knn(company_id, size)
+                if local_result is not None:
+                    local_results[company_id] = local_result
+            # One multi GET for the names of the hits of all of them
+            await self.fill_sources([h for r in local_results.values() for h in r['hits']['hits']])
+            results = {c: {"response": project_response(r)} for c, r in local_results.items()}
+
+        remaining = [c for c in company_ids if c not in results]
+        seeds = {}
+        if self.SEED_FIELDS[method] is not None and remaining:
+            sources = await super().get_documents([str(c) for c in remaining], self.SEED_FIELDS[method])
+            seeds = {c: sources[str(c)] for c in remaining if str(c) in sources}
+            for c in remaining:
+                if c not in seeds:
+                    results[c] = {"error": "Company not found"}
+            remaining = [c for c in remaining if c in seeds]
 
+        if remaining:
+            responses = await super().msearch_index(
+                [self.search_body(method, c, seeds.get(c, {}), size, 0, filters) for c in remaining]
+            )
+            # more_like_this has no seed to fetch, the seeds of empty results are looked up with one multi GET
+            empty = [str(c) for c, response in zip(remaining, responses) if method == "tf_idf_similarity"
+                     and "error" not in response and response['hits']['total']['value'] == 0]
+            existing = await super().get_documents(empty, []) if empty else {}
+            for c, response in zip(remaining, responses):
+                if "error" in response:
+                    results[c] = {"error": str(response["error"])}
+                elif str(c) in empty and str(c) not in existing:
+                    results[c] = {"error": "Company not found"}
+                else:
+                    results[c] = {"response": project_response(response)}
+        return [{"company_id": c, **results[c]} for c in company_ids]
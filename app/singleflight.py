@@ -0,0 +1,31 @@
+from typing import Any, Awaitable, Callable
+import asyncio
+
+class SingleFlight():
+    """
+    Coalesces concurrent calls with the same key: the first call runs,
+    every identical call that arrives while it is in flight awaits the same
+    result (or exception) instead of repeating the work.
+
+    The work runs in its own task, so a cancelled caller (e.g. a client that
+    disconnected) does not cancel it for the others.
+    """
+
+    def __init__(self):
+        self.calls = {}
+        self.executed = 0
+        self.coalesced = 0
+
+    async def do(self, key: str, compute: Callable[[], Awaitable[Any]]) -> Any:
+        task = self.calls.get(key)
+        if task is None:
+            self.executed += 1
+            task = asyncio.ensure_future(compute())
+            self.calls[key] = task
+            task.add_done_callback(lambda _: self.calls.pop(key, None))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    def stats(self) -> dict:
+        return {"in_flight": len(self.calls), "executed": self.executed, "coalesced": self.coalesced}
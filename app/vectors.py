@@ -0,0 +1,339 @@
+import numpy as np
+import base64
+import json
+import os
+import logging
+
+logger = logging.getLogger("uvicorn.error")
+if not logger.hasHandlers():
+    logging.basicConfig(level=logging.INFO, format='    %(levelname)s %(message)s')
+    logger = logging.getLogger(__name__)
+
+# Ways embeddings are written into bulk documents, see encode_vectors
+VECTOR_ENCODINGS = ("list", "float", "base64")
+
+def encode_vectors(embeddings: np.ndarray, encoding: str = "list") -> list:
+    """
+    Encodes the rows of an embedding matrix as the values of a dense_vector
+    field in bulk documents.
+
+    "list" gives Python lists of floats, which any JSON serializer writes as
+    float64 decimals. "float" gives float32 row views of the matrix, written
+    as the shortest float32 decimals by an orjson serializer (and nothing is
+    copied until then). "base64" gives the big-endian float32 bytes of every
+    row as a base64 string, a quarter of the JSON text of the lists, which
+    Elasticsearch accepts from 9.1 on (bench.vector_encoding measures them).
+    """
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    if encoding == "list":
+        return embeddings.tolist()
+    if encoding == "float":
+        return list(embeddings)
+    if encoding == "base64":
+        packed = embeddings.astype('>f4')
+        return [base64.b64encode(row).decode('ascii') for row in packed]
+    raise ValueError(f'unknown vector encoding {encoding}, expected one of {VECTOR_ENCODINGS}')
+
+def decode_vector(value: str | list) -> list[float]:
+    """
+    The floats of a dense_vector value from a document source, which is
+    either a list of floats or the base64 string written by encode_vectors.
+    """
+    if isinstance(value, str):
+        return np.frombuffer(base64.b64decode(value), dtype='>f4').tolist()
+    return value
+
+
+class EmbeddingWriter():
+    """
+    Writes embeddings to disk as one contiguous matrix plus an array of
+    company ids, chunk by chunk, so the API can memory-map them later.
+
+    Files are written next to path_prefix with a temporary suffix and only
+    moved into place by close(), so readers never see a half-written store.
+    Leaving the context manager with an exception discards them instead.
+    """
+
+    def __init__(self, path_prefix: str, dtype: str = 'float32'):
+        self.path_prefix = path_prefix
+        self.dtype = np.dtype(dtype)
+        self.ids = []
+        self.dimensions = None
+        os.makedirs(os.path.dirname(path_prefix) or '.', exist_ok=True)
+        self.vectors_file = open(f'{path_prefix}.vectors.tmp', 'wb')
+
+    def append(self, company_ids: list[int], embeddings: np.ndarray):
+        self.dimensions = embeddings.shape[1]
+        self.vectors_file.write(np.ascontiguousarray(embeddings, dtype=self.dtype).tobytes())
+        self.ids.extend(company_ids)
+
+    def close(self):
+        self.vectors_file.close()
+        np.save(f'{self.path_prefix}.ids.tmp.npy', np.asarray(self.ids, dtype=np.int64))
+        with open(f'{self.path_prefix}.json.tmp', 'w') as meta:
+            json.dump({"count": len(self.ids), "dimensions": self.dimensions, "dtype": self.dtype.name}, meta)
+        os.replace(f'{self.path_prefix}.vectors.tmp', f'{self.path_prefix}.vectors')
+        os.replace(f'{self.path_prefix}.ids.tmp.npy', f'{self.path_prefix}.ids.npy')
+        os.replace(f'{self.path_prefix}.json.tmp', f'{self.path_prefix}.json')
+        logger.info(f'{len(self.ids)} embeddings written to {self.path_prefix}.vectors')
+
+    def abort(self):
+        """
+        Removes the temporary files, leaving the published store untouched.
+        """
+        self.vectors_file.close()
+        for suffix in ['.vectors.tmp', '.ids.tmp.npy', '.json.tmp']:
+            if os.path.exists(f'{self.path_prefix}{suffix}'):
+                os.remove(f'{self.path_prefix}{suffix}')
+        logger.warning(f'Discarded the embeddings written to {self.path_prefix}.vectors.tmp')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class IdRows():
+    """
+    Rows of company ids in an unsorted array of ids, found with a binary
+    search over a sorted copy.
+    """
+
+    def __init__(self, ids: np.ndarray):
+        self.rows_by_id = np.argsort(ids, kind='stable')
+        self.sorted_ids = np.asarray(ids)[self.rows_by_id]
+
+    def row(self, company_id: int) -> int | None:
+        position = np.searchsorted(self.sorted_ids, company_id)
+        if position < len(self.sorted_ids) and self.sorted_ids[position] == company_id:
+            return int(self.rows_by_id[position])
+        return None
+
+    def rows(self, company_ids) -> np.ndarray:
+        """
+        Rows of the given company ids, -1 for unknown ones.
+        """
+        company_ids = np.asarray(company_ids, dtype=np.int64)
+        if len(self.sorted_ids) == 0:
+            return np.full(company_ids.shape, -1, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.sorted_ids, company_ids), len(self.sorted_ids) - 1)
+        return np.where(self.sorted_ids[positions] == company_ids, self.rows_by_id[positions], -1)
+
+
+class ExactVectorIndex():
+    """
+    Exact top-k search over a memory-mapped embedding matrix written by EmbeddingWriter.
+
+    Scores are dot products mapped to (1 + dot) / 2, the same scale
+    Elasticsearch uses for dot_product similarity, so results of both
+    engines are comparable.
+    """
+
+    def __init__(self, path_prefix: str, block_size: int = 65536):
+        with open(f'{path_prefix}.json') as meta:
+            self.meta = json.load(meta)
+        self.ids = np.load(f'{path_prefix}.ids.npy')
+        if self.meta['count']:
+            self.matrix = np.memmap(f'{path_prefix}.vectors', dtype=self.meta['dtype'], mode='r',
+                                    shape=(self.meta['count'], self.meta['dimensions']))
+        else:
+            # An empty file cannot be memory-mapped
+            self.matrix = np.empty((0, self.meta['dimensions'] or 0), dtype=self.meta['dtype'])
+        self.id_rows = IdRows(self.ids)
+        self.block_size = block_size
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def row(self, company_id: int) -> int | None:
+        return self.id_rows.row(company_id)
+
+    def vector(self, company_id: int) -> np.ndarray | None:
+        row = self.row(company_id)
+        return None if row is None else np.asarray(self.matrix[row], dtype=np.float32)
+
+    def scores(self, query_vector: np.ndarray) -> np.ndarray:
+        """
+        Dot products of the query with every row, computed block by block in float32.
+        """
+        query_vector = np.asarray(query_vector, dtype=np.float32)
+        if self.matrix.dtype == np.float32 and len(self) <= self.block_size:
+            return self.matrix @ query_vector
+        scores = np.empty(len(self), dtype=np.float32)
+        for start in range(0, len(self), self.block_size):
+            block = np.asarray(self.matrix[start:start + self.block_size], dtype=np.float32)
+            scores[start:start + len(block)] = block @ query_vector
+        return scores
+
+    def search(self, query_vector: np.ndarray, size: int = 10, from_: int = 0) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the company ids and scores of hits from_ to from_ + size, best first.
+        """
+        scores = self.scores(query_vector)
+        k = min(from_ + size, len(scores))
+        if k <= 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind='stable')][from_:]
+        return self.ids[top], (1 + scores[top]) / 2
+
+
+def hits_response(index_name: str, company_ids: np.ndarray, scores: np.ndarray, total: int) -> dict:
+    """
+    Wraps locally computed hits in the shape of an Elasticsearch search response.
+    """
+    hits = [
+        {
+            "_index": index_name,
+            "_id": str(c),
+            "_score": float(s),
+            "_source": {"company_id": str(c)}
+        }
+        for c, s in zip(company_ids.tolist(), scores.tolist())
+    ]
+    return {
+        "hits": {
+            "total": {"value": total, "relation": "eq"},
+            "max_score": hits[0]["_score"] if hits else None,
+            "hits": hits
+        }
+    }
+
+
+class IVFIndex():
+    """
+    Approximate nearest neighbour index: an inverted file (IVF) over k-means
+    cells with int8 scalar quantized vectors.
+
+    Every vector takes one byte per dimension instead of four. A query only
+    scans the nprobe cells whose centroids are closest to it, and can
+    optionally rerank the best rerank * k candidates with the exact vectors.
+    The files are memory-mapped, so only the scanned cells are paged in.
+    """
+
+    FILES = ['centroids', 'offsets', 'codes', 'ids', 'minimum', 'scale']
+
+    def __init__(self, path: str, nprobe: int = 16, rerank: int = 0, exact: ExactVectorIndex | None = None):
+        for name in self.FILES:
+            setattr(self, name, np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r'))
+        self.id_rows = IdRows(self.ids)
+        self.nprobe = nprobe
+        self.rerank = rerank
+        self.exact = exact
+
+    @classmethod
+    def build(cls,
+              vectors: ExactVectorIndex,
+              path: str,
+              nlist: int = 0,
+              iterations: int = 10,
+              sample_size: int = 100000,
+              block_size: int = 65536):
+        """
+        Trains the cells with spherical k-means on a sample of the vectors,
+        quantizes every vector and writes the index files to path.
+        nlist defaults to 4 * sqrt(number of vectors). Assignments and codes
+        are written through memory-mapped files, block by block.
+        """
+        count = len(vectors)
+        if count == 0:
+            logger.warning(f'No vectors to build an IVF index from, {path} is left as it is')
+            return
+        nlist = nlist or int(np.clip(4 * np.sqrt(count), 1, 65536))
+        rng = np.random.default_rng(0)
+        sample = np.asarray(vectors.matrix[np.sort(rng.choice(count, size=min(sample_size, count), replace=False))],
+                            dtype=np.float32)
+        nlist = min(nlist, len(sample))
+        centroids = sample[rng.choice(len(sample), size=nlist, replace=False)]
+        for _ in range(iterations):
+            assignments = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, sample)
+            empty = ~np.bincount(assignments, minlength=nlist).astype(bool)
+            sums[empty] = centroids[empty]
+            centroids = sums / np.maximum(np.linalg.norm(sums, axis=1, keepdims=True), 1e-12)
+
+        tmp_path = f'{path}.tmp'
+        os.makedirs(tmp_path, exist_ok=True)
+        minimum = np.full(sample.shape[1], np.inf, dtype=np.float32)
+        maximum = np.full(sample.shape[1], -np.inf, dtype=np.float32)
+        assignments = np.lib.format.open_memmap(os.path.join(tmp_path, 'assignments.npy'), mode='w+',
+                                                dtype=np.int32, shape=(count,))
+        for start in range(0, count, block_size):
+            block = np.asarray(vectors.matrix[start:start + block_size], dtype=np.float32)
+            assignments[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+            minimum = np.minimum(minimum, block.min(axis=0))
+            maximum = np.maximum(maximum, block.max(axis=0))
+        scale = np.maximum(maximum - minimum, 1e-12) / 255
+
+        order = np.argsort(assignments, kind='stable')
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=nlist))])
+        del assignments
+        os.remove(os.path.join(tmp_path, 'assignments.npy'))
+        codes = np.lib.format.open_memmap(os.path.join(tmp_path, 'codes.npy'), mode='w+',
+                                          dtype=np.int8, shape=(count, sample.shape[1]))
+        for start in range(0, count, block_size):
+            rows = order[start:start + block_size]
+            block = np.asarray(vectors.matrix[rows], dtype=np.float32)
+            codes[start:start + len(rows)] = np.round((block - minimum) / scale - 128).astype(np.int8)
+        codes.flush()
+        del codes
+
+        arrays = {"centroids": centroids.astype(np.float32), "offsets": offsets.astype(np.int64),
+                  "ids": vectors.ids[order], "minimum": minimum, "scale": scale.astype(np.float32)}
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_path, f'{name}.npy'), array)
+        if os.path.isdir(path):
+            for name in cls.FILES:
+                os.remove(os.path.join(path, f'{name}.npy'))
+            os.rmdir(path)
+        os.replace(tmp_path, path)
+        logger.info(f'IVF index with {nlist} cells over {count} vectors written to {path}')
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(getattr(self, name).nbytes for name in self.FILES)
+
+    def row(self, company_id: int) -> int | None:
+        return self.id_rows.row(company_id)
+
+    def vector(self, company_id: int) -> np.ndarray | None:
+        if self.exact is not None:
+            return self.exact.vector(company_id)
+        row = self.row(company_id)
+        if row is None:
+            return None
+        return self.minimum + self.scale * (self.codes[row].astype(np.float32) + 128)
+
+    def search(self, query_vector: np.ndarray, size: int = 10, from_: int = 0) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the company ids and approximate scores of hits from_ to from_ + size, best first.
+        """
+        query_vector = np.asarray(query_vector, dtype=np.float32)
+        nprobe = min(self.nprobe, len(self.centroids))
+        cells = np.argpartition(-(self.centroids @ query_vector), nprobe - 1)[:nprobe]
+        rows = np.concatenate([np.arange(self.offsets[c], self.offsets[c + 1]) for c in cells])
+        # q . x = q . minimum + (q * scale) . (code + 128)
+        weighted = query_vector * self.scale
+        scores = self.codes[rows].astype(np.float32) @ weighted + query_vector @ self.minimum + 128 * weighted.sum()
+
+        k = min(from_ + size, len(scores))
+        if k <= 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        if self.rerank and self.exact is not None:
+            candidates = min(len(scores), k * self.rerank)
+            top = np.argpartition(-scores, candidates - 1)[:candidates]
+            exact_rows = self.exact.id_rows.rows(self.ids[rows[top]])
+            # Both indices are built from the same store, so every candidate has an exact row
+            scores = np.asarray(self.exact.matrix[exact_rows], dtype=np.float32) @ query_vector
+            rows = rows[top]
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind='stable')][from_:]
+        return self.ids[rows[top]], (1 + scores[top]) / 2
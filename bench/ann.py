@@ -0,0 +1,64 @@
+"""
+Recall, memory and throughput of the IVF index against exact search.
+
+Builds an IVF index over the embeddings written by the indexer (or a synthetic
+clustered store of --synthetic rows), then reports recall@k against the exact
+engine, queries/sec and the memory footprint of the index for every
+combination of --nprobe and --rerank.
+
+    python -m bench.ann --nlist 0 --nprobe 4 8 16 32 --rerank 0 4
+    python -m bench.ann --synthetic 200000 --dims 1024
+"""
+from app.vectors import ExactVectorIndex, IVFIndex
+from bench.synthetic import synthetic_store
+from dotenv import load_dotenv
+import argparse
+import numpy as np
+import os
+import tempfile
+import time
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--path', default=os.getenv("VECTOR_STORE_PATH", "data/embeddings"))
+    parser.add_argument('--synthetic', type=int, default=0)
+    parser.add_argument('--dims', type=int, default=1024)
+    parser.add_argument('--nlist', type=int, default=0)
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[4, 8, 16, 32])
+    parser.add_argument('--rerank', type=int, nargs='+', default=[0, 4])
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--k', type=int, default=10)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = args.path
+        if args.synthetic:
+            path = os.path.join(directory, 'embeddings')
+            synthetic_store(path, args.synthetic, args.dims, clustered=True)
+        exact = ExactVectorIndex(path)
+        ivf_path = os.path.join(directory, 'embeddings.ivf')
+        started = time.perf_counter()
+        IVFIndex.build(exact, ivf_path, args.nlist)
+        print(f'built in {time.perf_counter() - started:.1f}s')
+
+        rng = np.random.default_rng(1)
+        query_ids = rng.choice(exact.ids, size=min(args.queries, len(exact)), replace=False).tolist()
+        queries = [exact.vector(c) for c in query_ids]
+        started = time.perf_counter()
+        expected = [set(exact.search(q, args.k)[0].tolist()) for q in queries]
+        exact_qps = len(queries) / (time.perf_counter() - started)
+        print(f'exact: {exact.matrix.nbytes / 2**20:.1f} MiB, {exact_qps:.0f} queries/sec')
+
+        print(f"{'nprobe':>7} {'rerank':>7} {'recall@' + str(args.k):>10} {'queries/s':>10} {'MiB':>8}")
+        for rerank in args.rerank:
+            for nprobe in args.nprobe:
+                ivf = IVFIndex(ivf_path, nprobe, rerank, exact)
+                started = time.perf_counter()
+                found = [ivf.search(q, args.k)[0].tolist() for q in queries]
+                qps = len(queries) / (time.perf_counter() - started)
+                recall = sum(len(e.intersection(f)) for e, f in zip(expected, found)) / (args.k * len(queries))
+                print(f'{nprobe:>7} {rerank:>7} {recall:>10.3f} {qps:>10.0f} {ivf.nbytes / 2**20:>8.1f}')
+
+if __name__ == '__main__':
+    main()
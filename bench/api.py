@@ -0,0 +1,107 @@
+"""
+Offline load test of the API against a local Elasticsearch stand-in.
+
+Drives app.main.app with a mix of requests across the similarity endpoints,
+either in-process through httpx.ASGITransport or over a real uvicorn socket,
+for every --concurrency level, and reports requests/sec and p50/p95/p99
+latency. The searcher runs on bench.fake_es.FixtureElasticsearch, which
+serves the fixture data after --latency ms per search (--semantic-latency
+for semantic queries, --get-latency for lookups), so changes to app.searcher
+and app.main can be measured on any machine without network access.
+
+    python -m bench.api --requests 2000 --concurrency 1 16 64 --mix tf_idf_similarity=1 semantic_similarity=1 dense_vector_similarity=2
+    python -m bench.api --transport uvicorn --cache --latency 10
+"""
+from app.main import app
+from app.cache import MemoryCacheBackend, ResponseCache
+from app.searcher import AsyncSearchService
+from app.singleflight import SingleFlight
+from bench.fake_es import FixtureElasticsearch, fixture_documents
+from bench.load import HEADER, format_row, run_load
+import argparse
+import asyncio
+import random
+import socket
+import httpx
+import logging
+import uvicorn
+
+ENDPOINTS = ["tf_idf_similarity", "semantic_similarity", "dense_vector_similarity", "hybrid_similarity"]
+
+def request_mix(mix: list[str], company_ids: list[str], requests: int, size: int) -> list[str]:
+    """
+    Paths of requests to endpoints drawn by weight (endpoint=weight) for random companies.
+    """
+    weights = dict((m.split('=') + ['1'])[:2] for m in mix)
+    unknown = set(weights) - set(ENDPOINTS)
+    if unknown:
+        raise SystemExit(f'unknown endpoints {sorted(unknown)}, expected some of {ENDPOINTS}')
+    random.seed(requests)
+    endpoints = random.choices(list(weights), [float(w) for w in weights.values()], k=requests)
+    return [f'/v1/{endpoint}/{random.choice(company_ids)}?size={size}' for endpoint in endpoints]
+
+def create_service(client: FixtureElasticsearch, cache: bool) -> AsyncSearchService:
+    searcher = AsyncSearchService('companies', client, single_flight=SingleFlight())
+    if cache:
+        searcher.cache = ResponseCache(MemoryCacheBackend(), searcher.index_version)
+    return searcher
+
+async def over_asgi(paths: list[str], concurrency: int) -> dict:
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url='http://bench') as client:
+        return await run_load(client, paths, concurrency)
+
+async def over_uvicorn(paths: list[str], concurrency: int) -> dict:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    # The service is injected below, so the lifespan that connects to Elasticsearch is skipped
+    server = uvicorn.Server(uvicorn.Config(app, host='127.0.0.1', port=port, lifespan='off',
+                                           log_level='warning', access_log=False))
+    serving = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+    try:
+        limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+        async with httpx.AsyncClient(base_url=f'http://127.0.0.1:{port}', limits=limits) as client:
+            return await run_load(client, paths, concurrency)
+    finally:
+        server.should_exit = True
+        await serving
+
+async def bench(args, documents: dict, similar: dict, paths: list[str], concurrency: int) -> tuple[dict, dict]:
+    client = FixtureElasticsearch(documents, similar, args.latency / 1000, args.get_latency / 1000,
+                                  args.semantic_latency / 1000, args.jitter)
+    app.state.searcher = create_service(client, args.cache)
+    run = over_uvicorn if args.transport == 'uvicorn' else over_asgi
+    return await run(paths, concurrency), client.calls
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--transport', choices=['asgi', 'uvicorn'], default='asgi')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 16, 64])
+    parser.add_argument('--mix', nargs='+', default=["tf_idf_similarity=1", "semantic_similarity=1",
+                                                     "dense_vector_similarity=1"],
+                        help='endpoint=weight of the requests, e.g. hybrid_similarity=1')
+    parser.add_argument('--size', type=int, default=10)
+    parser.add_argument('--companies', type=int, default=0, help='fixture companies, 0 loads all of them')
+    parser.add_argument('--dims', type=int, default=64)
+    parser.add_argument('--latency', type=float, default=5, help='milliseconds per search')
+    parser.add_argument('--get-latency', type=float, default=1, help='milliseconds per (multi) get')
+    parser.add_argument('--semantic-latency', type=float, default=20, help='milliseconds per semantic search')
+    parser.add_argument('--jitter', type=float, default=0.3, help='sigma of the log-normal latency factor')
+    parser.add_argument('--cache', action='store_true', help='enable the in-memory response cache')
+    args = parser.parse_args()
+    # A log line per request would be measured too
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+
+    documents, similar = fixture_documents(companies=args.companies, dims=args.dims)
+    paths = request_mix(args.mix, list(similar), args.requests, args.size)
+    print(f'{len(documents)} fixture companies, {args.requests} requests over {args.transport}')
+    print(HEADER)
+    for concurrency in args.concurrency:
+        stats, calls = asyncio.run(bench(args, documents, similar, paths, concurrency))
+        print(f"{format_row(f'concurrency={concurrency}', stats)}  ES calls {calls}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+"""
+Latency benchmark of the shared Elasticsearch client against one client per request.
+
+Drives the API in-process over httpx.ASGITransport against the Elasticsearch
+cluster configured in .env, first creating a client for every request (the
+old behaviour), then with the client created once in lifespan. Both runs go
+without the response cache, request coalescing, the local vector engine and
+the precomputed neighbours, so every request queries Elasticsearch and only
+the connection handling differs.
+
+    python -m bench.client_pool --method tf_idf_similarity --requests 500 --concurrency 32
+"""
+from app.searcher import AsyncSearchService
+from bench.load import HEADER, format_row, ground_truth_ids, run_load
+import app.main as api
+import argparse
+import asyncio
+import httpx
+
+async def per_request_searcher():
+    searcher = AsyncSearchService(api.es_index)
+    try:
+        yield searcher
+    finally:
+        await searcher.close()
+
+async def bench(method: str, requests: int, concurrency: int):
+    ids = ground_truth_ids()
+    paths = [f'/v1/{method}/{ids[i % len(ids)]}' for i in range(requests)]
+    transport = httpx.ASGITransport(app=api.app)
+    print(HEADER)
+    async with api.app.router.lifespan_context(api.app):
+        shared = api.app.state.searcher
+        shared.cache, shared.single_flight, shared.vector_index, shared.neighbour_tables = None, None, None, {}
+        async with httpx.AsyncClient(transport=transport, base_url='http://127.0.0.1:8000') as client:
+            api.app.dependency_overrides[api.get_searcher] = per_request_searcher
+            print(format_row('client per request', await run_load(client, paths, concurrency)))
+            api.app.dependency_overrides.clear()
+            # Warm up the pool so the first handshakes are not measured
+            await run_load(client, paths[:concurrency], concurrency)
+            print(format_row('shared client', await run_load(client, paths, concurrency)))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--method', default='tf_idf_similarity')
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=32)
+    args = parser.parse_args()
+    asyncio.run(bench(args.method, args.requests, args.concurrency))
+
+if __name__ == '__main__':
+    main()
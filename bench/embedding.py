@@ -0,0 +1,51 @@
+"""
+Throughput benchmark of the embedding stage.
+
+Encodes a sample of company descriptions with every combination of the given
+batch sizes and worker counts, then reports companies/sec, wall time and the
+projected wall time of a full rebuild.
+
+    python -m bench.embedding --rows 2000 --batch-sizes 16 32 64 --workers 0 4
+"""
+from app.embedding import EmbeddingStage
+from dotenv import load_dotenv
+import app.helper as helper
+import argparse
+import os
+import random
+
+def sample_texts(rows: int) -> list[str]:
+    companies = helper.read_csv_to_dict_by_id('data/companies.csv', 'bench')
+    texts = [c['full_description'] for c in companies.values()]
+    if not texts:
+        # No company dump available, fall back to synthetic descriptions of realistic lengths
+        with open('data/company_industries.csv') as f:
+            words = helper.process_text(f.read()).split()
+        texts = [' '.join(random.choices(words, k=random.randint(10, 300))) for _ in range(rows)]
+    return texts[:rows]
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', default=os.getenv("EMBEDDING_MODEL"))
+    parser.add_argument('--rows', type=int, default=1000)
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[32])
+    parser.add_argument('--workers', type=int, nargs='+', default=[0])
+    parser.add_argument('--target-rows', type=int, nargs='+', default=[24473, 1000000])
+    args = parser.parse_args()
+
+    texts = sample_texts(args.rows)
+    print(f'{len(texts)} texts, model {args.model}')
+    print(f"{'batch':>6} {'workers':>8} {'wall s':>9} {'comp/s':>9} " +
+          ' '.join(f'{"eta " + str(t):>14}' for t in args.target_rows))
+    for num_workers in args.workers:
+        for batch_size in args.batch_sizes:
+            with EmbeddingStage(args.model, batch_size, num_workers) as stage:
+                stage.encode(texts)
+            report = stage.report()
+            rate = report['companies_per_sec']
+            etas = ' '.join(f'{t/rate/60:>12.1f}m' for t in args.target_rows)
+            print(f"{batch_size:>6} {num_workers:>8} {report['seconds']:>9.2f} {rate:>9.1f} {etas}")
+
+if __name__ == '__main__':
+    main()
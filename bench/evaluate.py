@@ -0,0 +1,165 @@
+"""
+Quality and latency of the similarity methods against the ground truth, with parameter sweeps.
+
+Queries every company of data/ground_truth.json through the API in-process,
+at most --concurrency at a time, and reports recall@k and precision@k (the
+queried company itself left out) with latency percentiles per method.
+
+--sweep knob=v1,v2 evaluates every combination of the values of the query
+knobs of a method, which are AsyncSearchService attributes: mlt_* tune
+tf_idf_similarity, semantic_* semantic_similarity and knn_*
+dense_vector_similarity. The recall versus p95 latency Pareto frontier of
+every swept method is printed last. The response cache and the precomputed
+neighbours are left out, so every setting runs its live queries.
+
+    python -m bench.evaluate --k 10 100
+    python -m bench.evaluate --sweep knn_num_candidates=50,100,500 knn_k=0,200 mlt_max_query_terms=8,12,25
+    python -m bench.evaluate --fake --latency 5 --sweep semantic_industries_boost=1,2,4
+"""
+from app.main import app
+from app.searcher import AsyncSearchService, create_async_client
+from bench.fake_es import FixtureElasticsearch, fixture_documents
+from bench.load import percentile
+from dotenv import load_dotenv
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import time
+import httpx
+
+KNOB_METHODS = {"mlt_": "tf_idf_similarity", "semantic_": "semantic_similarity", "knn_": "dense_vector_similarity"}
+
+def load_ground_truth(path: str = 'data/ground_truth.json') -> dict[int, set[int]]:
+    with open(path) as gt:
+        return {entry['id']: set(entry['similar_companies']) for entry in map(json.loads, gt)}
+
+async def evaluate(client: httpx.AsyncClient,
+                   method: str,
+                   ground_truth: dict[int, set[int]],
+                   k_values: list[int],
+                   concurrency: int = 8) -> dict:
+    """
+    Queries method for every ground truth company, at most concurrency at a
+    time, and returns the mean recall@k and precision@k for every k and the
+    latency percentiles in milliseconds.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    found = {}
+    errors = 0
+
+    async def one(company_id: int):
+        nonlocal errors
+        async with semaphore:
+            started = time.perf_counter()
+            response = await client.get(f'/v1/{method}/{company_id}', params={'size': max(k_values)})
+            latencies.append((time.perf_counter() - started) * 1000)
+        if response.status_code != 200:
+            errors += 1
+            found[company_id] = []
+            return
+        found[company_id] = [h['company_id'] for h in response.json().get('hits', [])
+                             if h['company_id'] != company_id]
+
+    await asyncio.gather(*(one(c) for c in ground_truth))
+    report = {"errors": errors, "p50": percentile(latencies, 50), "p95": percentile(latencies, 95),
+              "p99": percentile(latencies, 99)}
+    for k in k_values:
+        hits = {c: len(expected.intersection(found[c][:k])) for c, expected in ground_truth.items()}
+        report[f"recall@{k}"] = sum(hits[c] / len(e) for c, e in ground_truth.items() if e) / len(ground_truth)
+        report[f"precision@{k}"] = sum(hits.values()) / (k * len(ground_truth))
+    return report
+
+def pareto_frontier(points: list[tuple[str, float, float]]) -> list[tuple[str, float, float]]:
+    """
+    The (label, recall, latency) points that no other point beats on both
+    recall and latency, fastest first.
+    """
+    frontier = []
+    for point in sorted(points, key=lambda p: (p[2], -p[1])):
+        if not frontier or point[1] > frontier[-1][1]:
+            frontier.append(point)
+    return frontier
+
+def parse_sweep(sweep: list[str]) -> dict[str, dict[str, list[float]]]:
+    """
+    Groups knob=v1,v2 specs by the method they tune.
+    """
+    grid = {}
+    for spec in sweep:
+        knob, values = spec.split('=')
+        method = next((m for prefix, m in KNOB_METHODS.items() if knob.startswith(prefix)), None)
+        if method is None or not hasattr(AsyncSearchService, knob):
+            raise SystemExit(f'unknown knob {knob}')
+        cast = type(getattr(AsyncSearchService, knob))
+        grid.setdefault(method, {})[knob] = [cast(v) for v in values.split(',')]
+    return grid
+
+def format_row(label: str, report: dict, k_values: list[int]) -> str:
+    scores = ' '.join(f"{report[f'recall@{k}']:>10.3f} {report[f'precision@{k}']:>10.3f}" for k in k_values)
+    return f"{label:<48} {scores} {report['p50']:>8.1f} {report['p95']:>8.1f} {report['p99']:>8.1f} {report['errors']:>6}"
+
+async def run(args) -> None:
+    ground_truth = load_ground_truth(args.ground_truth)
+    if args.fake:
+        documents, similar = fixture_documents(args.ground_truth, dims=args.dims)
+        es_client = FixtureElasticsearch(documents, similar, args.latency / 1000, args.latency / 5000,
+                                         args.latency * 4 / 1000)
+    else:
+        es_client = create_async_client()
+    searcher = AsyncSearchService(str(os.getenv("ELASTIC_INDEX")), es_client)
+    app.state.searcher = searcher
+    scores = ' '.join(f"{f'recall@{k}':>10} {f'precision@{k}':>10}" for k in args.k)
+    print(f"{len(ground_truth)} ground truth companies, {args.concurrency} queries in flight")
+    print(f"{'':<48} {scores} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>6}")
+    try:
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url='http://evaluate',
+                                     timeout=None) as client:
+            for method in args.methods:
+                report = await evaluate(client, method, ground_truth, args.k, args.concurrency)
+                print(format_row(method, report, args.k))
+
+            frontiers = {}
+            for method, knobs in parse_sweep(args.sweep).items():
+                points = []
+                for values in itertools.product(*knobs.values()):
+                    setting = dict(zip(knobs, values))
+                    for knob, value in setting.items():
+                        setattr(searcher, knob, value)
+                    report = await evaluate(client, method, ground_truth, args.k, args.concurrency)
+                    label = ' '.join(f'{knob}={value}' for knob, value in setting.items())
+                    print(format_row(f"{method.removesuffix('_similarity')} {label}", report, args.k))
+                    points.append((label, report[f'recall@{args.k[0]}'], report['p95']))
+                for knob in knobs:
+                    # Back to the defaults for the next method
+                    delattr(searcher, knob)
+                frontiers[method] = pareto_frontier(points)
+    finally:
+        await es_client.close()
+
+    for method, frontier in frontiers.items():
+        print(f"\nPareto frontier of {method}, recall@{args.k[0]} versus p95 latency:")
+        for label, recall, latency in frontier:
+            print(f"  {label:<46} {recall:>10.3f} {latency:>8.1f} ms")
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--methods', nargs='*', default=["tf_idf_similarity", "semantic_similarity",
+                                                         "dense_vector_similarity", "hybrid_similarity"])
+    parser.add_argument('--k', type=int, nargs='+', default=[10, 100])
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--sweep', nargs='*', default=[], help='knob=v1,v2 of AsyncSearchService, e.g. knn_k=0,100')
+    parser.add_argument('--ground-truth', default='data/ground_truth.json')
+    parser.add_argument('--fake', action='store_true', help='use the local Elasticsearch stand-in of bench.fake_es')
+    parser.add_argument('--latency', type=float, default=5, help='milliseconds per search of the stand-in')
+    parser.add_argument('--dims', type=int, default=64)
+    args = parser.parse_args()
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+    asyncio.run(run(args))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+"""
+Local stand-in for the Elasticsearch client, serving the fixture data.
+
+Implements the calls the API makes (get, mget, search with a query or knn,
+msearch, index settings and stats) over in-memory documents built from
+data/ground_truth.json and data/company_industries.csv, with random unit
+embeddings. Every call sleeps for an injectable, log-normally jittered
+latency, so benchmarks of app.searcher and app.main run without a cluster.
+"""
+from app.helper import aggregate_attributes_by_id
+from fnmatch import fnmatch
+from types import SimpleNamespace
+import asyncio
+import functools
+import json
+import numpy as np
+import zlib
+from elasticsearch import NotFoundError
+
+def fixture_documents(ground_truth_path: str = 'data/ground_truth.json',
+                      industries_path: str = 'data/company_industries.csv',
+                      companies: int = 0,
+                      dims: int = 64) -> tuple[dict, dict]:
+    """
+    Returns the documents by id, for the companies of the ground truth and
+    the first companies (or all with 0) of the industries file, and the
+    similar companies of the ground truth by id.
+    """
+    similar = {}
+    with open(ground_truth_path) as gt:
+        for line in gt:
+            entry = json.loads(line)
+            similar[str(entry['id'])] = [str(c) for c in entry['similar_companies']]
+    industries = aggregate_attributes_by_id(industries_path)
+    ids = list(dict.fromkeys([*similar, *(c for cs in similar.values() for c in cs),
+                              *list(industries)[:companies or None]]))
+    rng = np.random.default_rng(0)
+    embeddings = rng.normal(size=(len(ids), dims)).astype(np.float32)
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+    documents = {}
+    for company_id, embedding in zip(ids, embeddings):
+        documents[company_id] = {
+            "company_id": company_id,
+            "name": f"Company {company_id}",
+            "industries": industries.get(company_id, []),
+            "full_description": f"company {company_id} " + ' '.join(industries.get(company_id, [])).lower(),
+            "full_description_embedding": embedding.tolist(),
+        }
+    return documents, similar
+
+
+class FixtureElasticsearch():
+    """
+    Answers the client calls of the API from in-memory documents after a latency.
+
+    more_like_this ranks the ground truth neighbours of the liked company
+    first, text and semantic queries rank the companies of the industries
+    they mention, knn is an exact dot product over the embeddings.
+    """
+
+    def __init__(self,
+                 documents: dict,
+                 similar: dict | None = None,
+                 latency: float = 0.005,
+                 get_latency: float = 0.001,
+                 semantic_latency: float = 0.02,
+                 jitter: float = 0.3):
+        self.documents = documents
+        self.similar = similar or {}
+        self.latency = latency
+        self.get_latency = get_latency
+        self.semantic_latency = semantic_latency
+        self.jitter = jitter
+        self.rng = np.random.default_rng(1)
+        self.calls = {}
+        self.ids = list(documents)
+        self.matrix = np.array([d['full_description_embedding'] for d in documents.values()], dtype=np.float32)
+        self.by_industry = {}
+        for company_id, document in documents.items():
+            for industry in document['industries']:
+                self.by_industry.setdefault(industry, []).append(company_id)
+        self.indices = SimpleNamespace(get_settings=self.get_settings, get_mapping=self.get_mapping, stats=self.stats)
+
+    async def wait(self, operation: str, latency: float):
+        self.calls[operation] = self.calls.get(operation, 0) + 1
+        if latency > 0:
+            await asyncio.sleep(latency * self.rng.lognormal(0, self.jitter))
+
+    @functools.lru_cache(maxsize=None)
+    def fields(self, includes: tuple | None, excludes: tuple) -> list[str]:
+        # The stand-in should not be what the benchmark measures, so patterns are matched once
+        fields = next(iter(self.documents.values()))
+        return [k for k in fields if (includes is None or any(fnmatch(k, p) for p in includes))
+                and not any(fnmatch(k, p) for p in excludes)]
+
+    def source(self, company_id: str, includes: list | None = None, excludes: list | None = None) -> dict:
+        document = self.documents[company_id]
+        return {k: document[k] for k in self.fields(tuple(includes) if includes is not None else None,
+                                                    tuple(excludes or ()))}
+
+    async def get(self, index, id, source_includes=None):
+        await self.wait('get', self.get_latency)
+        if id not in self.documents:
+            raise NotFoundError('not found', SimpleNamespace(status=404), {})
+        return {'_id': id, 'found': True, '_source': self.source(id, source_includes)}
+
+    async def mget(self, index, ids, source_includes=None, source_excludes=None):
+        await self.wait('mget', self.get_latency)
+        return {'docs': [{'_id': i, 'found': i in self.documents,
+                          **({'_source': self.source(i, source_includes, source_excludes)}
+                             if i in self.documents else {})}
+                         for i in ids]}
+
+    def ranking(self, query: dict | None, knn: dict | None) -> tuple[list[str], list[float]]:
+        if knn is not None:
+            scores = self.matrix @ np.asarray(knn['query_vector'], dtype=np.float32)
+            k = min(knn['k'], len(scores))
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top], kind='stable')]
+            return [self.ids[i] for i in top], [float((1 + scores[i]) / 2) for i in top]
+        text = json.dumps(query)
+        if 'more_like_this' in query:
+            liked = query['more_like_this']['like'][0]['_id']
+            if liked not in self.documents:
+                return [], []
+            ranked = [liked, *self.similar.get(liked, [])]
+            industries = self.documents[liked]['industries']
+        else:
+            ranked = []
+            industries = [i for i in self.by_industry if i in text or i.lower() in text]
+        for industry in industries:
+            ranked.extend(self.by_industry[industry])
+        ranked = [c for c in dict.fromkeys(ranked) if c in self.documents]
+        # Deterministic but query dependent order of the rest of a short ranking
+        if len(ranked) < 10:
+            offset = zlib.crc32(text.encode()) % len(self.ids)
+            ranked = list(dict.fromkeys(ranked + (self.ids[offset:] + self.ids[:offset])[:100]))
+        return ranked, [1.0 / (rank + 1) for rank in range(len(ranked))]
+
+    async def search(self, index, size=10, from_=0, source=None, query=None, knn=None, **_):
+        semantic = 'semantic' in json.dumps(query) if query is not None else False
+        await self.wait('knn' if knn is not None else 'search', self.semantic_latency if semantic else self.latency)
+        ids, scores = self.ranking(query, knn)
+        source = source if isinstance(source, dict) else {}
+        hits = [{'_index': index, '_id': i, '_score': s,
+                 '_source': self.source(i, source.get('includes'), source.get('excludes'))}
+                for i, s in zip(ids[from_:from_ + size], scores[from_:from_ + size])]
+        return {'took': 1, 'hits': {'total': {'value': len(ids), 'relation': 'eq'},
+                                    'max_score': scores[0] if scores else None, 'hits': hits}}
+
+    async def msearch(self, searches):
+        await self.wait('msearch', self.latency)
+        responses = []
+        for body in searches[1::2]:
+            body = dict(body)
+            size, from_, source = body.pop('size', 10), body.pop('from', 0), body.pop('_source', None)
+            ids, scores = self.ranking(body.get('query'), body.get('knn'))
+            source = source or {}
+            hits = [{'_id': i, '_score': s, '_source': self.source(i, source.get('includes'), source.get('excludes'))}
+                    for i, s in zip(ids[from_:from_ + size], scores[from_:from_ + size])]
+            responses.append({'hits': {'total': {'value': len(ids), 'relation': 'eq'},
+                                       'max_score': scores[0] if scores else None, 'hits': hits}})
+        return {'responses': responses}
+
+    async def get_settings(self, index, name=None):
+        await self.wait('get_settings', self.get_latency)
+        return SimpleNamespace(body={f'{index}-fixture': {'settings': {'index': {'uuid': 'fixture'}}}})
+
+    async def get_mapping(self, index, **_):
+        await self.wait('get_mapping', self.get_latency)
+        return SimpleNamespace(body={})
+
+    async def stats(self, index=None, **_):
+        await self.wait('stats', self.get_latency)
+        return {'_all': {'primaries': {'docs': {'count': len(self.documents)}}}}
+
+    async def close(self):
+        pass
@@ -0,0 +1,88 @@
+"""
+Memory and throughput benchmark of the CSV ingestion pipeline.
+
+Generates synthetic companies.csv, company_industries.csv and
+company_specialities.csv files of the given sizes, then joins them with the
+dictionary based readers and with the streaming pipeline, attaching a dummy
+embedding to every document as the indexer does. Reports peak Python memory
+and companies/sec of both.
+
+    python -m bench.ingestion --rows 10000 100000 --dims 1024
+"""
+import app.helper as helper
+import argparse
+import csv
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+WORDS = ['software', 'consulting', 'health', 'care', 'retail', 'logistics', 'marketing', 'finance',
+         'energy', 'construction', 'education', 'media', 'security', 'cloud', 'data', 'design']
+
+def write_fixture(directory: str, rows: int):
+    random.seed(rows)
+    with open(os.path.join(directory, 'companies.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['company_id', 'name', 'description', 'city', 'country', 'company_size'])
+        for i in range(rows):
+            description = ' '.join(random.choices(WORDS, k=random.randint(20, 120)))
+            writer.writerow([i, f'company {i}', description, 'amsterdam', 'nl', '11-50'])
+    for attribute in ['industries', 'specialities']:
+        with open(os.path.join(directory, f'company_{attribute}.csv'), 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['company_id', attribute])
+            for i in range(rows):
+                for word in random.sample(WORDS, k=random.randint(0, 4)):
+                    writer.writerow([i, word.title()])
+
+def legacy(directory: str, dims: int) -> int:
+    companies = helper.read_csv_to_dict_by_id(os.path.join(directory, 'companies.csv'), 'bench')
+    for attribute in ['industries', 'specialities']:
+        aggregated = helper.aggregate_attributes_by_id(os.path.join(directory, f'company_{attribute}.csv'))
+        for c, l in aggregated.items():
+            if c in companies:
+                companies[c][attribute] = helper.process_field(l)
+                companies[c]['full_description'] = helper.process_field(str(companies[c][attribute])) + \
+                                                companies[c]['full_description']
+    for c in companies.values():
+        c['full_description_embedding'] = [0.0] * dims
+    return len(companies)
+
+def streaming(directory: str, dims: int) -> int:
+    count = 0
+    for chunk in helper.stream_companies(os.path.join(directory, 'companies.csv'),
+                                         'bench',
+                                         os.path.join(directory, 'company_industries.csv'),
+                                         os.path.join(directory, 'company_specialities.csv')):
+        for c in chunk:
+            c['full_description_embedding'] = [0.0] * dims
+        count += len(chunk)
+    return count
+
+def measure(pipeline, directory: str, dims: int) -> tuple[int, float, float]:
+    tracemalloc.start()
+    started = time.perf_counter()
+    count = pipeline(directory, dims)
+    seconds = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return count, seconds, peak / 2**20
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000, 50000])
+    parser.add_argument('--dims', type=int, default=1024)
+    args = parser.parse_args()
+
+    print(f"{'rows':>9} {'pipeline':>10} {'peak MiB':>10} {'comp/s':>10}")
+    for rows in args.rows:
+        with tempfile.TemporaryDirectory() as directory:
+            write_fixture(directory, rows)
+            for pipeline in [legacy, streaming]:
+                count, seconds, peak = measure(pipeline, directory, args.dims)
+                print(f'{count:>9} {pipeline.__name__:>10} {peak:>10.1f} {count/seconds:>10.0f}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""
+Shared load generation helpers for the benchmark scripts.
+"""
+import asyncio
+import json
+import time
+import httpx
+
+def ground_truth_ids(path: str = 'data/ground_truth.json') -> list[int]:
+    with open(path) as gt:
+        return [json.loads(line)['id'] for line in gt]
+
+def percentile(values: list[float], p: float) -> float:
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+async def run_load(client: httpx.AsyncClient, paths: list[str], concurrency: int) -> dict:
+    """
+    Requests every path once, keeping at most concurrency requests in flight,
+    and returns requests/sec and latency percentiles in milliseconds.
+    """
+    latencies = []
+    errors = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(path):
+        nonlocal errors
+        async with semaphore:
+            started = time.perf_counter()
+            response = await client.get(path)
+            latencies.append((time.perf_counter() - started) * 1000)
+            if response.status_code >= 400:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(p) for p in paths))
+    wall = time.perf_counter() - started
+    return {
+        "requests": len(paths),
+        "errors": errors,
+        "rps": len(paths) / wall,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+    }
+
+def format_row(label: str, stats: dict) -> str:
+    return (f"{label:<24} {stats['requests']:>7} {stats['errors']:>6} {stats['rps']:>9.1f} "
+            f"{stats['p50']:>8.1f} {stats['p95']:>8.1f} {stats['p99']:>8.1f}")
+
+HEADER = f"{'':<24} {'reqs':>7} {'errors':>6} {'req/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}"
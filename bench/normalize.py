@@ -0,0 +1,87 @@
+"""
+Micro-benchmarks of the text normalization in the ingestion hot path.
+
+Times the previous process_text against the current one on synthetic
+descriptions (sentences with punctuation, mixed case, some URLs and non-ASCII
+words), the batch API with and without a process pool, and the
+industries/specialities join. Checks that all of them produce identical output
+and exits with an error if process_text is slower than the previous one.
+
+    python -m bench.normalize --rows 100000 --workers 0 4
+"""
+import app.helper as helper
+import argparse
+import random
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+WORDS = ['We', 'provide', 'software', 'consulting', 'for', 'the', 'HEALTH-care', 'retail', 'and', 'logistics',
+         'industry', 'Our', 'team', 'of', 'experts', 'helps', 'clients', 'grow', 'in', 'Amsterdam', 'since', '2005',
+         'end-to-end', 'B2B', '(data)', '[cloud]', '100%', '&']
+RARE_WORDS = ['https://example.com/about', 'www.example.org', 'café', "l'oréal", '\t', '\n']
+
+def legacy_process_text(any_text: str) -> str:
+    """
+    The multi-pass normalizer that process_text replaced, kept as the reference.
+    """
+    processed_text = any_text.lower()
+    processed_text = re.compile(r'https?://\S+|www\.\S+').sub('', processed_text)
+    processed_text = processed_text.replace('[', ' ').replace(']', ' ')
+    return re.sub(r'[^a-z0-9-]+', ' ', processed_text)
+
+def sentence() -> str:
+    words = random.choices(WORDS, k=random.randint(5, 20))
+    if random.random() < 0.05:
+        words.append(random.choice(RARE_WORDS))
+    return ', '.join(' '.join(words[i:i + 6]) for i in range(0, len(words), 6)) + '.'
+
+def synthetic_texts(rows: int) -> list[str]:
+    random.seed(rows)
+    return [' '.join(sentence() for _ in range(random.randint(2, 8))) for _ in range(rows)]
+
+def timed(function, *args) -> tuple[object, float]:
+    started = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - started
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 4])
+    args = parser.parse_args()
+
+    texts = synthetic_texts(args.rows)
+    expected, legacy_seconds = timed(lambda: [legacy_process_text(t) for t in texts])
+    print(f"{'case':>28} {'texts/s':>12} {'speedup':>8}")
+    print(f"{'legacy process_text':>28} {args.rows/legacy_seconds:>12.0f} {1:>8.2f}")
+
+    single, seconds = timed(lambda: [helper.process_text(t) for t in texts])
+    assert single == expected, 'process_text output differs from the legacy normalizer'
+    print(f"{'process_text':>28} {args.rows/seconds:>12.0f} {legacy_seconds/seconds:>8.2f}")
+    regression = seconds > legacy_seconds
+
+    for workers in args.workers:
+        pool = ProcessPoolExecutor(workers) if workers > 1 else None
+        try:
+            batch, seconds = timed(helper.process_texts, texts, pool)
+        finally:
+            if pool is not None:
+                pool.shutdown()
+        assert batch == expected, 'process_texts output differs from the legacy normalizer'
+        print(f"{f'process_texts workers={workers}':>28} {args.rows/seconds:>12.0f} {legacy_seconds/seconds:>8.2f}")
+
+    fields = [helper.process_texts(random.choices(WORDS + RARE_WORDS, k=random.randint(1, 5)))
+              for _ in range(args.rows)]
+    expected, legacy_seconds = timed(lambda: [legacy_process_text(str(f)) for f in fields])
+    joined, seconds = timed(lambda: [helper.join_fields(f) for f in fields])
+    assert joined == expected, 'join_fields output differs from the legacy normalizer'
+    print(f"{'legacy process_field(str)':>28} {args.rows/legacy_seconds:>12.0f} {1:>8.2f}")
+    print(f"{'join_fields':>28} {args.rows/seconds:>12.0f} {legacy_seconds/seconds:>8.2f}")
+
+    if regression:
+        sys.exit('process_text is slower than the legacy normalizer')
+
+if __name__ == '__main__':
+    main()
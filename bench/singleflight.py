@@ -0,0 +1,71 @@
+"""
+Load test of request coalescing on a traffic spike.
+
+Fires --requests concurrent dense_vector_similarity calls whose company ids
+follow a Zipf distribution (a few very popular companies) at a service backed
+by a stand-in Elasticsearch client with --latency ms per call, with and
+without single-flight coalescing, and reports backend calls and latencies.
+
+    python -m bench.singleflight --requests 2000 --companies 500 --latency 20
+"""
+from app.searcher import AsyncSearchService
+from app.singleflight import SingleFlight
+from bench.load import percentile
+import argparse
+import asyncio
+import numpy as np
+import time
+
+class LatencyElasticsearch():
+    """
+    Answers every call after a fixed latency and counts the calls.
+    """
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls = 0
+
+    async def get(self, index, id, source_includes=None):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        return {'_id': id, '_source': {'full_description_embedding': [0.0] * 8}}
+
+    async def search(self, index, size=10, from_=0, **body):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        return {'hits': {'total': {'value': 0}, 'hits': []}}
+
+async def spike(company_ids: list[int], latency: float, single_flight: SingleFlight | None) -> dict:
+    client = LatencyElasticsearch(latency)
+    searcher = AsyncSearchService('companies', client, single_flight=single_flight)
+    latencies = []
+
+    async def one(company_id):
+        started = time.perf_counter()
+        await searcher.dense_vector_similarity(company_id)
+        latencies.append((time.perf_counter() - started) * 1000)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(c) for c in company_ids))
+    wall = time.perf_counter() - started
+    return {"calls": client.calls, "rps": len(company_ids) / wall,
+            "p50": percentile(latencies, 50), "p99": percentile(latencies, 99)}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--companies', type=int, default=500)
+    parser.add_argument('--zipf', type=float, default=1.3)
+    parser.add_argument('--latency', type=float, default=20, help='milliseconds per backend call')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    company_ids = (rng.zipf(args.zipf, size=args.requests) % args.companies).tolist()
+    print(f'{args.requests} requests over {len(set(company_ids))} distinct companies')
+    print(f"{'':<16} {'ES calls':>9} {'req/s':>9} {'p50 ms':>8} {'p99 ms':>8}")
+    for label, single_flight in [('no coalescing', None), ('single-flight', SingleFlight())]:
+        stats = asyncio.run(spike(company_ids, args.latency / 1000, single_flight))
+        print(f"{label:<16} {stats['calls']:>9} {stats['rps']:>9.0f} {stats['p50']:>8.1f} {stats['p99']:>8.1f}")
+
+if __name__ == '__main__':
+    main()
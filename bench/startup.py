@@ -0,0 +1,56 @@
+"""
+Import time and memory of the API process, the cost every uvicorn worker pays on startup.
+
+Imports the given modules in fresh interpreters and reports the wall time and
+peak RSS of each. Exits with an error if app.main imports the ingestion stack
+(the indexer, sentence_transformers or torch) or takes longer than --budget
+seconds to import.
+
+    python -m bench.startup --modules app.main app.indexer --runs 5 --budget 2
+"""
+from bench.load import percentile
+import argparse
+import json
+import subprocess
+import sys
+
+HEAVY_MODULES = ["app.indexer", "sentence_transformers", "torch"]
+
+PROBE = '''
+import json, resource, sys, time
+started = time.perf_counter()
+__import__(sys.argv[1])
+print(json.dumps({"seconds": time.perf_counter() - started,
+                  "max_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                  "heavy": sorted(set(sys.argv[2:]) & set(sys.modules))}))
+'''
+
+def measure(module: str) -> dict:
+    output = subprocess.run([sys.executable, '-c', PROBE, module, *HEAVY_MODULES],
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--modules', nargs='+', default=['app.main', 'app.indexer'])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--budget', type=float, default=2.0)
+    args = parser.parse_args()
+
+    failures = []
+    print(f"{'module':>15} {'p50 s':>8} {'max s':>8} {'peak MiB':>9}  heavy modules")
+    for module in args.modules:
+        runs = [measure(module) for _ in range(args.runs)]
+        seconds = [r['seconds'] for r in runs]
+        print(f"{module:>15} {percentile(seconds, 50):>8.2f} {max(seconds):>8.2f} "
+              f"{max(r['max_rss'] for r in runs) / 1024:>9.0f}  {', '.join(runs[0]['heavy']) or '-'}")
+        if module == 'app.main' and runs[0]['heavy']:
+            failures.append(f"app.main imports {', '.join(runs[0]['heavy'])}")
+        if module == 'app.main' and percentile(seconds, 50) > args.budget:
+            failures.append(f"app.main takes {percentile(seconds, 50):.2f}s to import, over the {args.budget}s budget")
+
+    if failures:
+        sys.exit('\n'.join(failures))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,23 @@
+"""
+Synthetic embedding stores for the vector benchmarks.
+"""
+from app.vectors import EmbeddingWriter
+import numpy as np
+
+def synthetic_store(path_prefix: str, rows: int, dims: int, dtype: str = 'float32', clustered: bool = False):
+    """
+    Writes rows random unit vectors with company ids 0..rows - 1. Clustered
+    vectors lie around rows / 200 centers, like real embeddings do, which
+    IVF cells depend on; otherwise they are spread uniformly.
+    """
+    rng = np.random.default_rng(0)
+    centers = rng.normal(size=(max(1, rows // 200), dims)).astype(np.float32) if clustered else None
+    with EmbeddingWriter(path_prefix, dtype) as writer:
+        for start in range(0, rows, 10000):
+            count = min(10000, rows - start)
+            if clustered:
+                block = centers[rng.integers(len(centers), size=count)] + 0.5 * rng.normal(size=(count, dims))
+            else:
+                block = rng.normal(size=(count, dims))
+            block /= np.linalg.norm(block, axis=1, keepdims=True)
+            writer.append(list(range(start, start + count)), block.astype(np.float32))
@@ -0,0 +1,111 @@
+"""
+Memory, bulk bytes and throughput of the encodings of embeddings in bulk documents.
+
+Encodes --docs synthetic unit vectors of --dims dimensions chunk by chunk, as
+app.indexer.embed_documents does, and serializes them into bulk action lines
+with the client serializer, for every EMBEDDING_ENCODING: lists through the
+stdlib json serializer (the previous behaviour), lists, float32 views and
+base64 strings through the orjson serializer. Reports peak Python memory of
+a chunk of encoded documents, serialized bytes per document and documents/sec
+of encoding plus serialization. With --es it also bulk indexes the documents
+into a scratch index per --index-types mapping (hnsw, int8_hnsw, bbq_hnsw...)
+and reports the indexing throughput (needs a running cluster, base64 needs
+Elasticsearch 9.1 or later).
+
+    python -m bench.vector_encoding --docs 20000 --dims 1024
+    python -m bench.vector_encoding --docs 50000 --es --index-types hnsw int8_hnsw bbq_hnsw
+"""
+from app.indexer import bulk_index, create_client
+from app.vectors import encode_vectors
+from dotenv import load_dotenv
+from elasticsearch import JsonSerializer, OrjsonSerializer
+import argparse
+import numpy as np
+import time
+import tracemalloc
+
+VARIANTS = [("list", JsonSerializer()), ("list", OrjsonSerializer()),
+            ("float", OrjsonSerializer()), ("base64", OrjsonSerializer())]
+
+def chunks(docs: int, dims: int, chunk_size: int):
+    rng = np.random.default_rng(0)
+    for start in range(0, docs, chunk_size):
+        embeddings = rng.normal(size=(min(chunk_size, docs - start), dims)).astype(np.float32)
+        embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+        yield start, embeddings
+
+def documents(start: int, embeddings: np.ndarray, encoding: str, index: str = 'bench') -> list[dict]:
+    return [{"_index": index, "_id": str(start + i), "company_id": start + i, "full_description_embedding": e}
+            for i, e in enumerate(encode_vectors(embeddings, encoding))]
+
+def measure(encoding: str, serializer, docs: int, dims: int, chunk_size: int) -> tuple[float, float, float]:
+    # Memory of one chunk of encoded documents on top of its embedding matrix
+    _, embeddings = next(chunks(chunk_size, dims, chunk_size))
+    tracemalloc.start()
+    chunk = documents(0, embeddings, encoding)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del chunk
+
+    size = 0
+    seconds = 0.0
+    for start, embeddings in chunks(docs, dims, chunk_size):
+        started = time.perf_counter()
+        for document in documents(start, embeddings, encoding):
+            # The action and source lines the bulk helpers write
+            action = {"index": {"_index": document.pop("_index"), "_id": document.pop("_id")}}
+            size += len(serializer.dumps(action)) + len(serializer.dumps(document)) + 2
+        seconds += time.perf_counter() - started
+    return peak / 2**20, size / docs, docs / seconds
+
+def index_throughput(client, index_type: str, encoding: str, args) -> float:
+    index = f'bench-vectors-{index_type.replace("_", "-")}-{encoding}'
+    client.indices.delete(index=index, ignore_unavailable=True)
+    client.indices.create(index=index, settings={"number_of_replicas": 0, "refresh_interval": "-1"}, mappings={
+        "properties": {"company_id": {"type": "long"}, "full_description_embedding": {
+            "type": "dense_vector", "dims": args.dims, "index": True, "similarity": "dot_product",
+            "index_options": {"type": index_type}}}})
+    try:
+        started = time.perf_counter()
+        actions = (d for start, e in chunks(args.docs, args.dims, args.chunk_size)
+                   for d in documents(start, e, encoding, index))
+        indexed, failed = bulk_index(client, actions, args.bulk_workers, chunk_size=args.bulk_chunk_size)
+        client.indices.refresh(index=index)
+        seconds = time.perf_counter() - started
+        if failed:
+            print(f'  {failed} documents failed')
+        return indexed / seconds
+    finally:
+        client.indices.delete(index=index, ignore_unavailable=True)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--docs', type=int, default=20000)
+    parser.add_argument('--dims', type=int, default=1024)
+    parser.add_argument('--chunk-size', type=int, default=5000, help='documents embedded at a time')
+    parser.add_argument('--es', action='store_true', help='also bulk index into a running cluster')
+    parser.add_argument('--index-types', nargs='+', default=['hnsw', 'int8_hnsw', 'bbq_hnsw'])
+    parser.add_argument('--bulk-workers', type=int, default=4)
+    parser.add_argument('--bulk-chunk-size', type=int, default=500)
+    args = parser.parse_args()
+
+    print(f"{args.docs} documents of {args.dims} dimensions, {args.chunk_size} per chunk")
+    print(f"{'encoding':>8} {'serializer':>18} {'chunk MiB':>10} {'bytes/doc':>10} {'docs/s':>10}")
+    for encoding, serializer in VARIANTS:
+        peak, size, rate = measure(encoding, serializer, args.docs, args.dims, args.chunk_size)
+        print(f'{encoding:>8} {type(serializer).__name__:>18} {peak:>10.1f} {size:>10.0f} {rate:>10.0f}')
+
+    if args.es:
+        load_dotenv()
+        client = create_client()
+        print(f"\n{'index type':>10} {'encoding':>8} {'indexed docs/s':>15}")
+        for index_type in args.index_types:
+            for encoding in ['float', 'base64']:
+                try:
+                    rate = index_throughput(client, index_type, encoding, args)
+                    print(f'{index_type:>10} {encoding:>8} {rate:>15.0f}')
+                except Exception as e:
+                    print(f'{index_type:>10} {encoding:>8} failed: {e}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""
+Latency of the local exact vector engine and recall of Elasticsearch knn against it.
+
+Measures exact top-k latency over the embeddings written by the indexer (or a
+synthetic store of --synthetic rows). With --es it also runs the same queries
+as Elasticsearch knn for every --num-candidates value and reports recall@k
+against the exact results.
+
+    python -m bench.vector_recall --queries 200 --k 10 --es --num-candidates 50 100 500
+    python -m bench.vector_recall --synthetic 1000000 --dims 1024
+"""
+from app.vectors import ExactVectorIndex
+from app.searcher import create_async_client
+from bench.load import percentile
+from bench.synthetic import synthetic_store
+from dotenv import load_dotenv
+import argparse
+import asyncio
+import numpy as np
+import os
+import tempfile
+import time
+
+def exact_latency(index: ExactVectorIndex, query_ids: list[int], k: int) -> dict:
+    latencies = []
+    results = {}
+    for company_id in query_ids:
+        started = time.perf_counter()
+        ids, _ = index.search(index.vector(company_id), k)
+        latencies.append((time.perf_counter() - started) * 1000)
+        results[company_id] = ids.tolist()
+    return {"p50": percentile(latencies, 50), "p99": percentile(latencies, 99),
+            "qps": len(latencies) / (sum(latencies) / 1000), "results": results}
+
+async def knn_recall(index: ExactVectorIndex, exact: dict, k: int, num_candidates: int) -> tuple[float, float]:
+    client = create_async_client()
+    found = 0
+    latencies = []
+    try:
+        for company_id, expected in exact.items():
+            started = time.perf_counter()
+            response = await client.search(
+                index=str(os.getenv("ELASTIC_INDEX")),
+                knn={"field": "full_description_embedding",
+                     "query_vector": index.vector(company_id).tolist(),
+                     "k": k,
+                     "num_candidates": max(k, num_candidates)},
+                size=k,
+                source=False
+            )
+            latencies.append((time.perf_counter() - started) * 1000)
+            returned = {int(hit["_id"]) for hit in response["hits"]["hits"]}
+            found += len(returned.intersection(expected))
+    finally:
+        await client.close()
+    return found / (k * len(exact)), percentile(latencies, 50)
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--path', default=os.getenv("VECTOR_STORE_PATH", "data/embeddings"))
+    parser.add_argument('--synthetic', type=int, default=0)
+    parser.add_argument('--dims', type=int, default=1024)
+    parser.add_argument('--dtype', default='float32')
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--es', action='store_true')
+    parser.add_argument('--num-candidates', type=int, nargs='+', default=[100])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = args.path
+        if args.synthetic:
+            path = os.path.join(directory, 'embeddings')
+            synthetic_store(path, args.synthetic, args.dims, args.dtype)
+        index = ExactVectorIndex(path)
+        rng = np.random.default_rng(1)
+        query_ids = rng.choice(index.ids, size=min(args.queries, len(index)), replace=False).tolist()
+
+        exact = exact_latency(index, query_ids, args.k)
+        print(f"exact top-{args.k} over {len(index)} x {index.meta['dimensions']} {index.meta['dtype']}: "
+              f"p50 {exact['p50']:.2f} ms, p99 {exact['p99']:.2f} ms, {exact['qps']:.0f} queries/sec")
+
+        if args.es:
+            print(f"{'num_candidates':>15} {'recall@' + str(args.k):>10} {'es p50 ms':>10}")
+            for num_candidates in args.num_candidates:
+                recall, p50 = asyncio.run(knn_recall(index, exact['results'], args.k, num_candidates))
+                print(f'{num_candidates:>15} {recall:>10.3f} {p50:>10.1f}')
+
+if __name__ == '__main__':
+    main()
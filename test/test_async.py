@@ -7,8 +7,9 @@ from app import helper
 @pytest_asyncio.fixture
 async def async_client():
     transport = httpx.ASGITransport(app=app)
-    async with httpx.AsyncClient(transport=transport, base_url='http://127.0.0.1:8000') as client:
-        yield client
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=transport, base_url='http://127.0.0.1:8000') as client:
+            yield client
 
 @pytest.mark.asyncio
 async def test_service_is_up(async_client):
@@ -28,4 +29,9 @@ async def test_semantic_against_ground_truth(async_client):
 @pytest.mark.asyncio
 async def test_dense_vector_against_ground_truth(async_client):
     hit_percent = await helper.get_overlap_percentage(async_client, 'dense_vector_similarity')
-    assert hit_percent > 29
\ No newline at end of file
+    assert hit_percent > 29
+
+@pytest.mark.asyncio
+async def test_hybrid_against_ground_truth(async_client):
+    hit_percent = await helper.get_overlap_percentage(async_client, 'hybrid_similarity')
+    assert hit_percent > 25
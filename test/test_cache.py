@@ -0,0 +1,67 @@
+import pytest
+from app.cache import CacheBackend, MemoryCacheBackend, ResponseCache
+
+@pytest.mark.asyncio
+async def test_memory_backend_evicts_least_recently_used():
+    backend = MemoryCacheBackend(max_entries=2)
+    await backend.set('a', {'v': 1})
+    await backend.set('b', {'v': 2})
+    assert await backend.get('a') == {'v': 1}
+    await backend.set('c', {'v': 3})
+    assert await backend.get('b') is None
+    assert await backend.get('a') == {'v': 1}
+    assert backend.stats()['entries'] == 2
+
+@pytest.mark.asyncio
+async def test_memory_backend_respects_ttl_and_byte_cap():
+    backend = MemoryCacheBackend(ttl=-1)
+    await backend.set('a', {'v': 1})
+    assert await backend.get('a') is None
+
+    backend = MemoryCacheBackend(max_bytes=30)
+    await backend.set('a', {'v': 'x' * 10})
+    await backend.set('b', {'v': 'y' * 10})
+    assert await backend.get('a') is None
+    assert await backend.get('b') is not None
+    assert backend.bytes <= 30
+
+@pytest.mark.asyncio
+async def test_cache_is_invalidated_by_a_new_index_version():
+    version = 'v1'
+    computed = []
+
+    async def version_source():
+        return version
+
+    async def compute():
+        computed.append(version)
+        return {'version': version}
+
+    cache = ResponseCache(MemoryCacheBackend(), version_source, check_interval=0)
+    assert await cache.get_or_compute(('m', 1), compute) == {'version': 'v1'}
+    assert await cache.get_or_compute(('m', 1), compute) == {'version': 'v1'}
+    version = 'v2'
+    assert await cache.get_or_compute(('m', 1), compute) == {'version': 'v2'}
+    assert computed == ['v1', 'v2']
+    assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 2
+
+@pytest.mark.asyncio
+async def test_empty_responses_are_not_cached():
+    cache = ResponseCache(MemoryCacheBackend())
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        return {}
+
+    await cache.get_or_compute(('m', 1), compute)
+    await cache.get_or_compute(('m', 1), compute)
+    assert len(calls) == 2
+
+def test_backends_implement_the_whole_interface():
+    class GetOnlyBackend(CacheBackend):
+        async def get(self, key):
+            return None
+
+    with pytest.raises(TypeError):
+        GetOnlyBackend()
@@ -0,0 +1,15 @@
+from app.fusion import reciprocal_rank_fusion
+
+def hits(*ids):
+    return [{'_id': i, '_source': {'company_id': i}} for i in ids]
+
+def test_rrf_rewards_agreement():
+    fused = reciprocal_rank_fusion({'a': hits('1', '2', '3'), 'b': hits('3', '2', '4')}, k=60)
+    assert [h['_id'] for h in fused] == ['3', '2', '1', '4']
+    assert fused[1]['_ranks'] == {'a': 2, 'b': 2}
+    assert abs(fused[1]['_score'] - 2 / 62) < 1e-12
+
+def test_rrf_weights():
+    fused = reciprocal_rank_fusion({'a': hits('1'), 'b': hits('2')}, weights={'a': 0.5}, k=1)
+    assert [h['_id'] for h in fused] == ['2', '1']
+    assert fused[1]['_score'] == 0.25
@@ -0,0 +1,65 @@
+import csv
+import random
+import re
+from app import helper
+
+def legacy_process_text(any_text: str) -> str:
+    # The multi-pass normalizer that process_text replaced, the reference it has to match
+    processed_text = any_text.lower()
+    processed_text = re.compile(r'https?://\S+|www\.\S+').sub('', processed_text)
+    processed_text = processed_text.replace('[', ' ').replace(']', ' ')
+    return re.sub(r'[^a-z0-9-]+', ' ', processed_text)
+
+def write_csv(path, rows):
+    with open(path, 'w', newline='') as f:
+        csv.writer(f).writerows(rows)
+
+def test_stream_companies_matches_dict_join(tmp_path):
+    write_csv(tmp_path / 'companies.csv', [
+        ['company_id', 'name', 'description'],
+        ['1', 'Acme', 'We build [rockets] at https://acme.example!'],
+        ['2', 'Globex', 'Consulting & Data'],
+        ['3', 'Initech', 'TPS reports'],
+    ])
+    write_csv(tmp_path / 'industries.csv', [
+        ['company_id', 'industry'],
+        ['1', 'Aviation & Aerospace'],
+        ['3', 'Software'],
+        ['1', 'Defense'],
+        ['99', 'Ignored'],
+    ])
+    write_csv(tmp_path / 'specialities.csv', [
+        ['company_id', 'speciality'],
+        [' 2 ', 'Big-Data'],
+    ])
+
+    expected = helper.read_csv_to_dict_by_id(str(tmp_path / 'companies.csv'), 'companies')
+    for attribute, file_name in [('industries', 'industries.csv'), ('specialities', 'specialities.csv')]:
+        for c, l in helper.aggregate_attributes_by_id(str(tmp_path / file_name)).items():
+            if c in expected:
+                expected[c][attribute] = helper.process_field(l)
+                expected[c]['full_description'] = helper.process_field(str(expected[c][attribute])) + \
+                                                expected[c]['full_description']
+
+    stats = {}
+    chunks = list(helper.stream_companies(str(tmp_path / 'companies.csv'),
+                                          'companies',
+                                          str(tmp_path / 'industries.csv'),
+                                          str(tmp_path / 'specialities.csv'),
+                                          chunk_size=2,
+                                          stats=stats))
+
+    assert [len(c) for c in chunks] == [2, 1]
+    assert [c for chunk in chunks for c in chunk] == list(expected.values())
+    assert stats == {'companies': 3, 'industries': 2, 'specialities': 1,
+                     'industries_total': 3, 'specialities_total': 1}
+
+def test_process_text_matches_legacy_normalizer():
+    random.seed(0)
+    alphabet = list('aZz09-_ .,;:/[]()\t\n\'"%&') + ['http://', 'https://', 'www.', 'HTTPS://', 'WWW.',
+                                                    'é', 'İ', 'ß', 'K', ' ']
+    texts = [''.join(random.choices(alphabet, k=random.randint(0, 40))) for _ in range(20000)]
+    assert helper.process_texts(texts) == [legacy_process_text(t) for t in texts]
+
+    fields = [helper.process_texts(random.sample(texts, k=random.randint(1, 4))) for _ in range(2000)]
+    assert [helper.join_fields(f) for f in fields] == [legacy_process_text(str(f)) for f in fields]
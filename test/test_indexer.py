@@ -0,0 +1,173 @@
+import threading
+import numpy as np
+import pytest
+from app import indexer
+from app.embedding import EmbeddingCache, EmbeddingStage
+
+def test_bulk_index_spreads_documents_over_workers(monkeypatch):
+    seen = []
+    threads = set()
+
+    def streaming_bulk(client, actions, **kwargs):
+        assert kwargs['chunk_size'] == 7
+        for action in actions:
+            threads.add(threading.get_ident())
+            seen.append(action['company_id'])
+            yield action['company_id'] % 10 != 0, {'index': {'_id': action['company_id']}}
+
+    monkeypatch.setattr(indexer.helpers, 'streaming_bulk', streaming_bulk)
+    documents = ({'company_id': i} for i in range(1, 101))
+    indexed, failed = indexer.bulk_index(None, documents, workers=3, queue_size=5, chunk_size=7)
+
+    assert sorted(seen) == list(range(1, 101))
+    assert (indexed, failed) == (90, 10)
+    assert threading.get_ident() not in threads
+
+def test_bulk_index_does_not_hang_when_a_worker_dies(monkeypatch):
+    def streaming_bulk(client, actions, **kwargs):
+        next(actions)
+        raise ConnectionError('cluster is gone')
+        yield
+
+    monkeypatch.setattr(indexer.helpers, 'streaming_bulk', streaming_bulk)
+    documents = ({'company_id': i} for i in range(100))
+    with pytest.raises(ConnectionError):
+        indexer.bulk_index(None, documents, workers=2, queue_size=1)
+
+class FakeModel():
+    def __init__(self):
+        self.encoded = []
+
+    def get_sentence_embedding_dimension(self):
+        return 2
+
+    def encode(self, texts, **kwargs):
+        self.encoded.extend(texts)
+        return np.array([[len(t), 1.0] for t in texts], dtype=np.float32)
+
+    def stop_multi_process_pool(self, pool):
+        pool['stopped'] = True
+
+def delta_run(tmp_path, companies, model):
+    stage = EmbeddingStage('fake-model', cache=EmbeddingCache(str(tmp_path / 'cache.sqlite')))
+    stage.model = model
+    state = indexer.DocumentState(str(tmp_path / 'state.sqlite'), 'fake-model')
+    chunks = [[{'_index': 'companies', '_id': c, 'full_description': d} for c, d in companies.items()]]
+    actions = list(indexer.embed_documents(stage, chunks, state=state)) + \
+        list(indexer.delete_stale(state, 'companies'))
+    state.commit()
+    state.close()
+    stage.cache.close()
+    return actions
+
+def test_reset_is_rolled_back_without_a_commit(tmp_path):
+    delta_run(tmp_path, {'1': 'rockets'}, FakeModel())
+    state = indexer.DocumentState(str(tmp_path / 'state.sqlite'), 'fake-model')
+    state.reset()
+    state.close()
+    model = FakeModel()
+    assert delta_run(tmp_path, {'1': 'rockets'}, model) == [] and model.encoded == []
+
+def test_leaving_the_stage_stops_the_pool():
+    pool = {'stopped': False}
+    with EmbeddingStage('fake-model', num_workers=2) as stage:
+        stage.model, stage.pool = FakeModel(), pool
+    assert pool['stopped'] and stage.pool is None
+
+def test_delta_run_only_sends_changes(tmp_path):
+    model = FakeModel()
+    first = delta_run(tmp_path, {'1': 'rockets', '2': 'consulting', '3': 'reports'}, model)
+    assert [a['_id'] for a in first] == ['1', '2', '3']
+    assert first[0]['full_description_embedding'] == [7.0, 1.0]
+
+    model.encoded.clear()
+    second = delta_run(tmp_path, {'1': 'rockets', '2': 'data consulting', '4': 'paper'}, model)
+    assert model.encoded == ['data consulting', 'paper']
+    assert [(a.get('_op_type', 'index'), a['_id']) for a in second] == \
+        [('index', '2'), ('index', '4'), ('delete', '3')]
+
+    assert delta_run(tmp_path, {'1': 'rockets', '2': 'data consulting', '4': 'paper'}, model) == []
+
+class FakeResponse():
+    def __init__(self, body):
+        self.body = body
+
+class FakeIndices():
+    def __init__(self, indices, aliases):
+        self.indices = indices
+        self.aliases = aliases
+        self.actions = []
+        self.deleted = []
+        self.meta = {}
+
+    def exists_alias(self, name):
+        return name in self.aliases
+
+    def exists(self, index):
+        return index in self.indices or index in self.aliases
+
+    def get_alias(self, name):
+        return FakeResponse({i: {} for i in self.aliases[name]})
+
+    def get(self, index):
+        prefix = index.rstrip('*')
+        return FakeResponse({i: {} for i in self.indices if i.startswith(prefix)})
+
+    def update_aliases(self, actions):
+        self.actions = actions
+
+    def delete(self, index):
+        self.deleted.append(index)
+
+    def get_mapping(self, index):
+        names = []
+        for part in index.split(','):
+            if part.endswith('*'):
+                names += [i for i in self.indices if i.startswith(part.rstrip('*'))]
+            else:
+                names += self.aliases.get(part, [part])
+        return FakeResponse({i: {'mappings': {'_meta': self.meta[i]} if i in self.meta else {}} for i in names})
+
+    def put_mapping(self, index, meta):
+        self.meta[index] = meta
+
+class FakeClient():
+    def __init__(self, indices, aliases):
+        self.indices = FakeIndices(indices, aliases)
+
+def test_swap_alias_replaces_previous_versions():
+    client = FakeClient(['companies-20260101000000', 'companies-20260201000000', 'companies-20260301000000',
+                         'companies-backup'], {'companies': ['companies-20260201000000']})
+    indexer.swap_alias(client, 'companies', 'companies-20260301000000', retain=1)
+
+    assert client.indices.actions == [{'add': {'index': 'companies-20260301000000', 'alias': 'companies'}},
+                                      {'remove': {'index': 'companies-20260201000000', 'alias': 'companies'}}]
+    assert client.indices.deleted == ['companies-20260101000000']
+
+def test_swap_alias_only_retains_published_versions():
+    client = FakeClient(['companies-20260101000000', 'companies-20260201000000', 'companies-20260215000000',
+                         'companies-20260301000000', 'companies-20260401000000'],
+                        {'companies': ['companies-20260201000000']})
+    client.indices.meta['companies-20260101000000'] = {'published': '2026-01-01T00:00:00'}
+    indexer.swap_alias(client, 'companies', 'companies-20260301000000', retain=1)
+
+    # 20260215 crashed while loading, 20260401 is still being built
+    assert client.indices.deleted == ['companies-20260101000000', 'companies-20260215000000']
+    assert {'companies-20260201000000', 'companies-20260301000000'} <= {
+        i for i, meta in client.indices.meta.items() if meta.get('published')}
+
+def test_swap_alias_replaces_a_concrete_index():
+    client = FakeClient(['companies', 'companies-20260301000000'], {})
+    indexer.swap_alias(client, 'companies', 'companies-20260301000000')
+
+    assert client.indices.actions == [{'add': {'index': 'companies-20260301000000', 'alias': 'companies'}},
+                                      {'remove_index': {'index': 'companies'}}]
+    assert client.indices.deleted == []
+
+def test_delta_runs_bump_the_data_version():
+    client = FakeClient(['companies-20260301000000'], {'companies': ['companies-20260301000000']})
+    client.indices.meta['companies-20260301000000'] = {'published': True}
+    for _ in range(2):
+        indexer.bump_data_version(client, 'companies')
+    assert client.indices.meta == {'companies-20260301000000': {'published': True, 'data_version': 2}}
+
@@ -0,0 +1,46 @@
+import httpx
+import pytest
+from app.main import app
+from app.metrics import Histogram, Progress, server_timing, start_request, timed
+from app.searcher import AsyncSearchService
+from test.test_searcher import FakeElasticsearch, SOURCES
+
+def test_histogram_renders_cumulative_buckets():
+    histogram = Histogram('latency_seconds', 'Latency.', ('route',), buckets=(0.1, 1.0))
+    for value in [0.05, 0.1, 0.5, 2.0]:
+        histogram.observe('/a', value=value)
+    assert histogram.render()[2:] == [
+        'latency_seconds_bucket{route="/a",le="0.1"} 2',
+        'latency_seconds_bucket{route="/a",le="1.0"} 3',
+        'latency_seconds_bucket{route="/a",le="+Inf"} 4',
+        'latency_seconds_sum{route="/a"} 2.65',
+        'latency_seconds_count{route="/a"} 4',
+    ]
+
+def test_stages_add_up_per_request():
+    timings = start_request()
+    for _ in range(2):
+        with timed('es_search'):
+            pass
+    assert list(timings) == ['es_search']
+    assert server_timing({'es_search': 0.0012}) == 'es_search;dur=1.20'
+
+def test_progress_estimates_the_remaining_time():
+    progress = Progress('indexing', total=100, interval=3600)
+    progress.update(25, embedded=10)
+    report = progress.report()
+    assert report['done'] == 25 and report['docs_per_sec'] > 0
+    assert report['eta_seconds'] == pytest.approx(3 * report['seconds'], rel=0.01)
+
+@pytest.mark.asyncio
+async def test_requests_report_their_stages():
+    app.state.searcher = AsyncSearchService('companies', FakeElasticsearch(SOURCES))
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url='http://test') as client:
+        response = await client.get('/v1/semantic_similarity/1', params={'page': 2, 'size': 1})
+        assert response.status_code == 200
+        stages = [s.split(';')[0] for s in response.headers['server-timing'].split(', ')]
+        assert stages == ['es_get', 'es_search', 'serialize', 'total']
+
+        metrics = (await client.get('/v1/metrics')).text
+    assert 'similarity_request_seconds_count{route="/semantic_similarity/{company_id}",status="200"}' in metrics
+    assert 'similarity_es_requests_total{operation="get"}' in metrics
@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+from app.neighbours import NeighbourTable, NeighbourTableWriter, dense_neighbours, load_neighbour_tables, search_neighbours
+from app.searcher import AsyncSearchService
+from app.vectors import ExactVectorIndex
+from test.test_searcher import FakeElasticsearch, SOURCES
+from test.test_vectors import write_store
+
+def test_dense_neighbours_match_exact_search(tmp_path):
+    ids, _ = write_store(tmp_path / 'embeddings', count=300)
+    index = ExactVectorIndex(str(tmp_path / 'embeddings'), block_size=64)
+    dense_neighbours(index, str(tmp_path / 'dense'), top_n=20, scratch_bytes=100 * 300 * 4)
+    table = NeighbourTable(str(tmp_path / 'dense'))
+
+    for company_id in ids[:50].tolist():
+        expected_ids, expected_scores = index.search(index.vector(company_id), size=5, from_=10)
+        found_ids, found_scores, total = table.search(company_id, size=5, from_=10)
+        assert found_ids.tolist() == expected_ids.tolist() and total == 20
+        np.testing.assert_allclose(found_scores, expected_scores, rtol=1e-5)
+
+    assert table.search(int(ids[0]), size=10, from_=15) is None
+    assert table.search(-1) is None
+
+def test_short_neighbour_lists_are_complete(tmp_path):
+    with NeighbourTableWriter(str(tmp_path / 'table'), np.array([7, 3, 5]), top_n=4) as writer:
+        writer.set(int(writer.rows([3])[0]), writer.rows([3, 7]), np.array([1.0, 0.5]))
+    table = NeighbourTable(str(tmp_path / 'table'))
+
+    found_ids, found_scores, total = table.search(3, size=10)
+    assert found_ids.tolist() == [3, 7] and found_scores.tolist() == [1.0, 0.5] and total == 2
+    assert table.search(5) is None
+
+def test_failed_run_keeps_the_previous_table(tmp_path):
+    with NeighbourTableWriter(str(tmp_path / 'table'), np.array([7, 3]), top_n=2) as writer:
+        writer.set(0, writer.rows([7, 3]), np.array([1.0, 0.5]))
+    with pytest.raises(RuntimeError):
+        with NeighbourTableWriter(str(tmp_path / 'table'), np.array([7, 3, 5]), top_n=2) as writer:
+            raise RuntimeError('search failed')
+    assert len(NeighbourTable(str(tmp_path / 'table'))) == 2
+    assert [p.name for p in tmp_path.iterdir()] == ['table']
+
+def test_tables_of_other_index_versions_are_not_loaded(tmp_path):
+    for method, version in [('semantic_similarity', 'a:0'), ('tf_idf_similarity', 'a:1')]:
+        with NeighbourTableWriter(str(tmp_path / method), np.array([7, 3]), top_n=2, index_version=version) as writer:
+            writer.set(0, writer.rows([7, 3]), np.array([1.0, 0.5]))
+
+    assert list(load_neighbour_tables(str(tmp_path), 'a:1')) == ['tf_idf_similarity']
+    assert sorted(load_neighbour_tables(str(tmp_path))) == ['semantic_similarity', 'tf_idf_similarity']
+
+@pytest.mark.asyncio
+async def test_service_serves_precomputed_neighbours(tmp_path):
+    client = FakeElasticsearch(SOURCES)
+    await search_neighbours(AsyncSearchService('companies', client), 'semantic_similarity',
+                            np.array([1, 2]), str(tmp_path / 'semantic_similarity'), top_n=5)
+    client.calls.clear()
+
+    searcher = AsyncSearchService('companies', client,
+                                  neighbour_tables={'semantic_similarity': NeighbourTable(
+                                      str(tmp_path / 'semantic_similarity'))})
+    response = await searcher.semantic_similarity(2, size=1)
+    assert response == {'total': 2, 'max_score': 1.0, 'hits': [{'id': '1', 'score': 1.0, 'company_id': 1, 'name': 'Acme'}]}
+    assert client.calls == [('mget', ['1'])]
+
+    response = await searcher.semantic_similarity(2, size=1, fields=['industries', 'full_description_embedding'])
+    # Embeddings are left out like on the Elasticsearch path
+    assert response['hits'][0]['fields'] == {'industries': ['aviation']}
+
+    # Hits only the precomputed ranking found are named too
+    hybrid = await searcher.hybrid_similarity(2, size=2)
+    assert {h['company_id']: h['name'] for h in hybrid['hits']} == {1: 'Acme', 2: 'Globex'}
@@ -0,0 +1,91 @@
+import asyncio
+import numpy as np
+import pytest
+from app.embedding import QueryEncoder
+from app.searcher import AsyncSearchService
+from app.vectors import ExactVectorIndex
+from test.test_searcher import FakeElasticsearch, SOURCES
+from test.test_vectors import write_store
+
+class FakeModel():
+    """
+    Embeds a text as [len(text), 1], records the batches it is called with.
+    """
+
+    def __init__(self, fail: bool = False):
+        self.fail = fail
+        self.batches = []
+
+    def encode(self, texts, batch_size=32, convert_to_numpy=True):
+        self.batches.append(list(texts))
+        if self.fail:
+            raise RuntimeError('model failed')
+        return np.array([[len(t), 1.0] for t in texts], dtype=np.float32)
+
+def fake_encoder(model: FakeModel, **options) -> QueryEncoder:
+    encoder = QueryEncoder('fake-model', **options)
+    encoder.stage.model = model
+    encoder.stage.load = lambda: None
+    return encoder
+
+@pytest.mark.asyncio
+async def test_concurrent_queries_are_encoded_in_micro_batches():
+    model = FakeModel()
+    encoder = fake_encoder(model, max_batch_size=8, max_wait=0.05)
+    texts = [f'query {i}' for i in range(20)] + ['Query 0!']
+    vectors = await asyncio.gather(*(encoder.encode(t) for t in texts))
+    await encoder.close()
+
+    assert [v.tolist() for v in vectors[:2]] == [[7.0, 1.0], [7.0, 1.0]]
+    # Normalized like the indexed descriptions, so "Query 0!" is the same query as "query 0"
+    assert vectors[-1].tolist() == vectors[0].tolist()
+    assert [len(b) for b in model.batches] == [8, 8, 4]
+    assert encoder.stats()['coalesced'] == 1
+
+@pytest.mark.asyncio
+async def test_repeated_queries_are_served_from_the_lru():
+    model = FakeModel()
+    encoder = fake_encoder(model, max_wait=0, cache_size=2)
+    for text in ['a', 'b', 'a', 'c', 'a', 'b']:
+        await encoder.encode(text)
+    await encoder.close()
+    # "b" was evicted by "c" as the least recently used one
+    assert model.batches == [['a'], ['b'], ['c'], ['b']]
+
+@pytest.mark.asyncio
+async def test_encoding_errors_reach_every_query_of_the_batch():
+    encoder = fake_encoder(FakeModel(fail=True), max_wait=0.05)
+    results = await asyncio.gather(encoder.encode('a'), encoder.encode('b'), return_exceptions=True)
+    await encoder.close()
+    assert all(isinstance(r, RuntimeError) for r in results)
+    assert encoder.cache == {}
+
+@pytest.mark.asyncio
+async def test_text_search_fuses_lexical_semantic_and_dense_rankings():
+    client = FakeElasticsearch(SOURCES)
+    searcher = AsyncSearchService('companies', client, query_encoder=fake_encoder(FakeModel(), max_wait=0))
+    response = await searcher.text_search('rocket engines', size=1)
+    await searcher.query_encoder.close()
+
+    assert response['methods'] == {'lexical': 'ok', 'semantic': 'ok', 'dense_vector': 'ok'}
+    assert response['total'] == 2 and len(response['hits']) == 1
+    queries = [c[1] for c in client.calls]
+    assert queries[0]['query']['bool']['must']['multi_match']['query'] == 'rocket engines'
+    assert queries[1]['query']['bool']['must'] == {'semantic': {'field': 'full_description_semantic',
+                                                                'query': 'rocket engines'}}
+    assert queries[2]['knn']['query_vector'] == [14.0, 1.0]
+
+@pytest.mark.asyncio
+async def test_dense_text_search_is_served_by_the_local_vector_engine(tmp_path):
+    ids, _ = write_store(tmp_path / 'embeddings', count=20, dims=2)
+    client = FakeElasticsearch(SOURCES)
+    searcher = AsyncSearchService('companies', client, vector_index=ExactVectorIndex(str(tmp_path / 'embeddings')),
+                                  query_encoder=fake_encoder(FakeModel(), max_wait=0))
+    response = await searcher.text_search('rocket engines', size=3, method='dense_vector')
+    hybrid = await searcher.text_search('rocket engines', size=3)
+    await searcher.query_encoder.close()
+
+    assert len(response['hits']) == 3 and set(h['company_id'] for h in response['hits']) <= set(ids.tolist())
+    assert hybrid['methods']['dense_vector'] == 'ok'
+    # No knn search, the hits of the local engine only cost a multi GET for their names
+    assert [c[0] for c in client.calls] == ['mget', 'search', 'search', 'mget']
@@ -0,0 +1,293 @@
+import asyncio
+import httpx
+import numpy as np
+import pytest
+from fastapi import HTTPException
+from elasticsearch import NotFoundError
+from types import SimpleNamespace
+from app.main import app
+from app.searcher import AsyncSearchService, encode_cursor
+from app.cache import MemoryCacheBackend, ResponseCache
+from app.singleflight import SingleFlight
+from app.vectors import EmbeddingWriter, ExactVectorIndex, encode_vectors
+from test.test_vectors import write_store
+
+class FakeElasticsearch():
+    """
+    Records the calls made by the service and answers them from a dictionary of sources.
+    """
+
+    def __init__(self, sources: dict, latency: float = 0):
+        self.sources = sources
+        self.latency = latency
+        self.calls = []
+
+    async def get(self, index, id, source_includes=None):
+        self.calls.append(('get', id))
+        await asyncio.sleep(self.latency)
+        if id not in self.sources:
+            raise NotFoundError('not found', None, {})
+        return {'_id': id, '_source': {k: v for k, v in self.sources[id].items() if k in source_includes}}
+
+    async def search(self, index, size=10, from_=0, source=None, **body):
+        self.calls.append(('search', body))
+        await asyncio.sleep(self.latency)
+        hits = [{'_id': i, '_score': 1.0, '_source': {k: v for k, v in s.items()
+                                                      if k in source['includes'] and k not in source['excludes']}}
+                for i, s in self.sources.items()]
+        return {'hits': {'total': {'value': len(hits)}, 'hits': hits[from_:from_ + size]}}
+
+    async def mget(self, index, ids, source_includes=None, source_excludes=None):
+        self.calls.append(('mget', ids))
+        await asyncio.sleep(self.latency)
+        return {'docs': [{'_id': i, 'found': i in self.sources,
+                          '_source': {k: v for k, v in self.sources.get(i, {}).items()
+                                      if k in source_includes and k not in (source_excludes or [])}}
+                         for i in ids]}
+
+    async def msearch(self, searches):
+        self.calls.append(('msearch', searches))
+        responses = []
+        for body in searches[1::2]:
+            query = {k: v for k, v in body.items() if k not in ('size', 'from', '_source')}
+            responses.append(await self.search(None, body['size'], body['from'], body['_source'], **query))
+        return {'responses': responses}
+
+    async def close(self):
+        pass
+
+SOURCES = {
+    '1': {'company_id': '1', 'name': 'Acme', 'industries': ['aviation'], 'full_description': 'rockets',
+          'full_description_embedding': [1.0, 0.0]},
+    '2': {'company_id': '2', 'name': 'Globex', 'industries': ['software'], 'full_description': 'data',
+          'full_description_embedding': [0.0, 1.0]},
+}
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('method', ['tf_idf_similarity', 'semantic_similarity', 'dense_vector_similarity'])
+async def test_similarity_costs_one_search(method):
+    client = FakeElasticsearch(SOURCES)
+    searcher = AsyncSearchService('companies', client)
+    response = await getattr(searcher, method)(1, size=10, page=1)
+    assert len(response['hits']) == 2
+    assert [c[0] for c in client.calls].count('search') == 1
+
+@pytest.mark.asyncio
+async def test_seed_is_fetched_by_company_id():
+    client = FakeElasticsearch(SOURCES)
+    searcher = AsyncSearchService('companies', client)
+    await searcher.dense_vector_similarity(2)
+    assert client.calls[0] == ('get', '2')
+    assert client.calls[1][1]['knn']['query_vector'] == [0.0, 1.0]
+
+@pytest.mark.asyncio
+async def test_base64_seed_is_decoded():
+    sources = {'2': {**SOURCES['2'], 'full_description_embedding': encode_vectors(np.array([[0.0, 1.0]]), 'base64')[0]}}
+    client = FakeElasticsearch(sources)
+    await AsyncSearchService('companies', client).dense_vector_similarity(2)
+    assert client.calls[1][1]['knn']['query_vector'] == [0.0, 1.0]
+
+@pytest.mark.asyncio
+async def test_query_knobs_are_service_attributes():
+    client = FakeElasticsearch(SOURCES)
+    searcher = AsyncSearchService('companies', client)
+    searcher.knn_num_candidates, searcher.knn_k, searcher.mlt_max_query_terms = 500, 50, 25
+    await searcher.dense_vector_similarity(2)
+    await searcher.tf_idf_similarity(2)
+    assert {k: client.calls[1][1]['knn'][k] for k in ('k', 'num_candidates')} == {'k': 50, 'num_candidates': 500}
+    assert client.calls[2][1]['query']['more_like_this']['max_query_terms'] == 25
+    assert AsyncSearchService('companies', client).knn_num_candidates == 100
+
+@pytest.mark.asyncio
+async def test_index_version_follows_the_data_version():
+    meta = {}
+
+    async def get_settings(index, name):
+        return SimpleNamespace(body={'companies-1': {'settings': {'index': {'uuid': 'u1'}}}})
+
+    async def get_mapping(index, filter_path):
+        return SimpleNamespace(body={'companies-1': {'mappings': {'_meta': meta}}} if meta else {})
+
+    client = FakeElasticsearch(SOURCES)
+    client.indices = SimpleNamespace(get_settings=get_settings, get_mapping=get_mapping)
+    searcher = AsyncSearchService('companies', client)
+    assert await searcher.index_version() == 'u1:0'
+    meta['data_version'] = 3
+    assert await searcher.index_version() == 'u1:3'
+
+@pytest.mark.asyncio
+async def test_unknown_company_is_not_found():
+    searcher = AsyncSearchService('companies', FakeElasticsearch(SOURCES))
+    with pytest.raises(HTTPException) as e:
+        await searcher.semantic_similarity(3)
+    assert e.value.status_code == 404
+
+class NoMatchesElasticsearch(FakeElasticsearch):
+    async def search(self, index, size=10, from_=0, source=None, **body):
+        self.calls.append(('search', body))
+        return {'hits': {'total': {'value': 0}, 'hits': []}}
+
+@pytest.mark.asyncio
+async def test_existing_company_without_more_like_this_hits_is_found():
+    client = NoMatchesElasticsearch(SOURCES)
+    searcher = AsyncSearchService('companies', client)
+    assert (await searcher.tf_idf_similarity(1))['hits'] == []
+    with pytest.raises(HTTPException) as e:
+        await searcher.tf_idf_similarity(3)
+    assert e.value.status_code == 404
+
+    client.calls.clear()
+    lines = [line async for line in searcher.batch_similarity('tf_idf_similarity', [1, 3, 2])]
+    assert lines[0]['response']['hits'] == [] and lines[2]['response']['hits'] == []
+    assert lines[1] == {'company_id': 3, 'error': 'Company not found'}
+    assert [c for c in client.calls if c[0] == 'mget'] == [('mget', ['1', '3', '2'])]
+
+@pytest.mark.asyncio
+async def test_cached_similarity_skips_elasticsearch():
+    client = FakeElasticsearch(SOURCES)
+    searcher = AsyncSearchService('companies', client, cache=ResponseCache(MemoryCacheBackend()))
+    first = await searcher.semantic_similarity(1, 10, 1)
+    assert await searcher.semantic_similarity(1, 10, 1) == first
+    await searcher.semantic_similarity(1, 10, 2)
+    assert [c[0] for c in client.calls].count('search') == 2
+
+@pytest.mark.asyncio
+async def test_concurrent_identical_requests_are_coalesced():
+    client = FakeElasticsearch(SOURCES, latency=0.05)
+    searcher = AsyncSearchService('companies', client, single_flight=SingleFlight())
+    responses = await asyncio.gather(*(searcher.dense_vector_similarity(1, 10, 1) for _ in range(20)),
+                                     searcher.dense_vector_similarity(2, 10, 1))
+    assert all(r == responses[0] for r in responses[:20])
+    assert [c[0] for c in client.calls].count('search') == 2
+    assert searcher.single_flight.stats() == {'in_flight': 0, 'executed': 2, 'coalesced': 19}
+
+@pytest.mark.asyncio
+async def test_coalesced_requests_share_errors():
+    searcher = AsyncSearchService('companies', FakeElasticsearch(SOURCES, latency=0.01), single_flight=SingleFlight())
+    results = await asyncio.gather(*(searcher.semantic_similarity(3) for _ in range(5)), return_exceptions=True)
+    assert all(isinstance(r, HTTPException) and r.status_code == 404 for r in results)
+
+@pytest.mark.asyncio
+async def test_batch_similarity_uses_one_mget_and_one_msearch_per_chunk():
+    client = FakeElasticsearch(SOURCES)
+    searcher = AsyncSearchService('companies', client)
+    lines = [line async for line in searcher.batch_similarity('dense_vector_similarity', [2, 3, 1], size=5, chunk_size=2)]
+
+    assert [line['company_id'] for line in lines] == [2, 3, 1]
+    assert lines[1] == {'company_id': 3, 'error': 'Company not found'}
+    assert len(lines[0]['response']['hits']) == 2
+    calls = [c[0] for c in client.calls]
+    assert calls.count('mget') == 2 and calls.count('msearch') == 2
+
+@pytest.mark.asyncio
+async def test_batch_hits_of_the_local_engine_are_named_with_one_mget(tmp_path):
+    with EmbeddingWriter(str(tmp_path / 'embeddings')) as writer:
+        writer.append([1, 2], np.array([[1.0, 0.0], [0.0, 1.0]], dtype=np.float32))
+    client = FakeElasticsearch(SOURCES)
+    searcher = AsyncSearchService('companies', client, vector_index=ExactVectorIndex(str(tmp_path / 'embeddings')))
+    lines = [line async for line in searcher.batch_similarity('dense_vector_similarity', [1, 2], size=2)]
+
+    assert [[h['name'] for h in line['response']['hits']] for line in lines] == [['Acme', 'Globex'], ['Globex', 'Acme']]
+    assert client.calls == [('mget', ['1', '2'])]
+
+@pytest.mark.asyncio
+async def test_hybrid_shares_one_seed_fetch_and_fuses():
+    client = FakeElasticsearch(SOURCES)
+    searcher = AsyncSearchService('companies', client)
+    response = await searcher.hybrid_similarity(1, size=10)
+    calls = [c[0] for c in client.calls]
+    assert calls.count('get') == 1 and calls.count('search') == 3
+    assert response['methods'] == {'tf_idf_similarity': 'ok', 'semantic_similarity': 'ok',
+                                   'dense_vector_similarity': 'ok'}
+    assert [h['id'] for h in response['hits']] == ['1', '2']
+
+@pytest.mark.asyncio
+async def test_hybrid_leaves_out_slow_methods():
+    searcher = AsyncSearchService('companies', FakeElasticsearch(SOURCES, latency=0.05))
+    response = await searcher.hybrid_similarity(1, timeout=0.01)
+    assert set(response['methods'].values()) == {'timeout'}
+    assert response['hits'] == []
+
+@pytest.mark.asyncio
+async def test_hits_are_projected():
+    searcher = AsyncSearchService('companies', FakeElasticsearch(SOURCES))
+    response = await searcher.dense_vector_similarity(1, size=1)
+    assert response == {'total': 2, 'max_score': None,
+                        'hits': [{'id': '1', 'score': 1.0, 'company_id': 1, 'name': 'Acme'}]}
+
+    response = await searcher.semantic_similarity(1, size=1, fields=['industries', 'full_description_embedding'])
+    assert response['hits'][0]['fields'] == {'industries': ['aviation']}
+
+@pytest.mark.asyncio
+async def test_cursor_pages_slice_one_candidate_list():
+    sources = {str(i): {'company_id': str(i), 'name': f'company {i}', 'full_description_embedding': [1.0, 0.0]}
+               for i in range(1, 26)}
+    client = FakeElasticsearch(sources)
+    searcher = AsyncSearchService('companies', client, cache=ResponseCache(MemoryCacheBackend()))
+
+    pages = [await searcher.similarity_page('dense_vector_similarity', 1, size=10, window=20)]
+    while 'next_cursor' in pages[-1]:
+        pages.append(await searcher.similarity_page('dense_vector_similarity', 1, cursor=pages[-1]['next_cursor'],
+                                                    window=20))
+
+    assert [[h['company_id'] for h in p['hits']] for p in pages] == \
+        [list(range(1, 11)), list(range(11, 21)), list(range(21, 26))]
+    knn = [c[1]['knn'] for c in client.calls if c[0] == 'search']
+    assert [k['k'] for k in knn] == [20, 40]
+
+    with pytest.raises(HTTPException) as e:
+        await searcher.similarity_page('semantic_similarity', 1, cursor=pages[0]['next_cursor'])
+    assert e.value.status_code == 400
+
+@pytest.mark.asyncio
+async def test_malformed_cursors_are_rejected(monkeypatch):
+    searcher = AsyncSearchService('companies', FakeElasticsearch(SOURCES))
+    base = {'method': 'dense_vector_similarity', 'company_id': 1}
+    for state in [[1], {**base}, {**base, 'offset': 10, 'size': 0}, {**base, 'offset': '10', 'size': 10},
+                  {**base, 'offset': 10, 'size': 10, 'fields': 'city'},
+                  {**base, 'offset': 10, 'size': 10, 'filters': {'country': 'Netherlands'}},
+                  {**base, 'offset': 10, 'size': 10, 'filters': {'revenue': ['1M']}},
+                  {**base, 'offset': 10, 'size': 10, 'filters': [['country', ['Netherlands']]]}]:
+        with pytest.raises(HTTPException) as e:
+            await searcher.similarity_page('dense_vector_similarity', 1, cursor=encode_cursor(state))
+        assert e.value.status_code == 400
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url='http://test') as client:
+        monkeypatch.setattr(app.state, 'searcher', searcher, raising=False)
+        response = await client.get('/v1/dense_vector_similarity/1', params={'size': 0})
+        assert response.status_code == 422
+        for params in [{'size': 0}, {'page': 0}, {'page': -1}]:
+            response = await client.get('/v1/hybrid_similarity/1', params=params)
+            assert response.status_code == 422
+            response = await client.get('/v1/search', params={'q': 'rockets', **params})
+            assert response.status_code == 422
+
+@pytest.mark.asyncio
+async def test_batch_sizes_are_bounded(monkeypatch):
+    monkeypatch.setattr(app.state, 'searcher', AsyncSearchService('companies', FakeElasticsearch(SOURCES)), raising=False)
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url='http://test') as client:
+        for size, status in [(0, 422), (101, 422), (100, 200)]:
+            response = await client.post('/v1/semantic_similarity/batch', json={'company_ids': [1], 'size': size})
+            assert response.status_code == status
+
+@pytest.mark.asyncio
+async def test_filters_are_pushed_down_into_filter_context(tmp_path):
+    client = FakeElasticsearch(SOURCES)
+    write_store(tmp_path / 'embeddings', count=3)
+    searcher = AsyncSearchService('companies', client, vector_index=ExactVectorIndex(str(tmp_path / 'embeddings')))
+    filters = {'country': ['Netherlands'], 'industries': ['Oil & Energy']}
+    clauses = [{'terms': {'country.keyword': ['Netherlands']}}, {'terms': {'industries.keyword': ['oil energy']}}]
+
+    await searcher.dense_vector_similarity(1, filters=filters)
+    await searcher.tf_idf_similarity(1, filters=filters)
+    await searcher.semantic_similarity(1, filters=filters)
+    searches = [c[1] for c in client.calls if c[0] == 'search']
+    # The local vector engine cannot filter, so the knn search goes to Elasticsearch
+    assert searches[0]['knn']['filter'] == clauses and searches[0]['knn']['num_candidates'] == 100
+    assert searches[1]['query']['bool']['filter'] == clauses
+    assert searches[2]['query']['bool']['filter'] == clauses
+
+    pages = await searcher.similarity_page('dense_vector_similarity', 1, size=1, window=1, filters=filters)
+    client.calls.clear()
+    await searcher.similarity_page('dense_vector_similarity', 1, cursor=pages['next_cursor'], window=1)
+    assert client.calls[-1][1]['knn']['filter'] == clauses
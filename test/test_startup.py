@@ -0,0 +1,30 @@
+import asyncio
+import pytest
+import subprocess
+import sys
+from types import SimpleNamespace
+import app.main
+
+def test_api_does_not_import_the_ingestion_stack():
+    # A fresh interpreter, as the other tests may have imported anything already
+    code = 'import sys, app.main; print(sorted({"app.indexer", "sentence_transformers", "torch"} & set(sys.modules)))'
+    output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout
+    assert output.strip().splitlines()[-1] == '[]'
+
+
+@pytest.mark.asyncio
+async def test_local_engines_follow_the_index_version(monkeypatch, tmp_path):
+    versions = iter(['a:0', 'a:0', 'b:0'])
+    async def index_version():
+        return next(versions)
+    searcher = SimpleNamespace(index_version=index_version, vector_index='old', neighbour_tables={})
+    monkeypatch.setattr(app.main, 'neighbour_tables_path', str(tmp_path))
+    monkeypatch.setattr(app.main, 'load_vector_index', lambda: 'reopened')
+
+    reloader = asyncio.create_task(app.main.reload_local_engines(searcher, 'a:0', 0))
+    for _ in range(100):
+        if searcher.vector_index != 'old':
+            break
+        await asyncio.sleep(0.01)
+    reloader.cancel()
+    assert searcher.vector_index == 'reopened'
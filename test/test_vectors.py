@@ -0,0 +1,111 @@
+import numpy as np
+import orjson
+import pytest
+from app.vectors import EmbeddingWriter, ExactVectorIndex, IVFIndex, IdRows, decode_vector, encode_vectors
+
+def write_store(path_prefix, count=500, dims=16, dtype='float32', chunk=128):
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(size=(count, dims)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    ids = rng.permutation(10 * count)[:count]
+    with EmbeddingWriter(str(path_prefix), dtype) as writer:
+        for start in range(0, count, chunk):
+            writer.append(ids[start:start + chunk].tolist(), vectors[start:start + chunk])
+    return ids, vectors
+
+def test_exact_search_matches_brute_force(tmp_path):
+    ids, vectors = write_store(tmp_path / 'embeddings')
+    index = ExactVectorIndex(str(tmp_path / 'embeddings'), block_size=100)
+
+    query = index.vector(int(ids[42]))
+    np.testing.assert_array_equal(query, vectors[42])
+    expected = np.argsort(-(vectors @ query), kind='stable')
+
+    found, scores = index.search(query, size=10)
+    assert found.tolist() == ids[expected[:10]].tolist()
+    assert found[0] == ids[42] and abs(scores[0] - 1.0) < 1e-6
+
+    page, _ = index.search(query, size=10, from_=20)
+    assert page.tolist() == ids[expected[20:30]].tolist()
+
+def test_unknown_company_has_no_vector(tmp_path):
+    ids, _ = write_store(tmp_path / 'embeddings')
+    index = ExactVectorIndex(str(tmp_path / 'embeddings'))
+    assert index.vector(10 * len(ids) + 1) is None
+
+def test_id_rows_find_unsorted_ids():
+    id_rows = IdRows(np.array([30, 10, 20]))
+    assert [id_rows.row(c) for c in [10, 20, 30, 15, 40]] == [1, 2, 0, None, None]
+    assert id_rows.rows([20, 40, 30]).tolist() == [2, -1, 0]
+    assert IdRows(np.array([], dtype=np.int64)).rows([1]).tolist() == [-1]
+
+def test_float16_store(tmp_path):
+    ids, vectors = write_store(tmp_path / 'embeddings', dtype='float16')
+    index = ExactVectorIndex(str(tmp_path / 'embeddings'))
+    assert index.matrix.dtype == np.float16
+    found, _ = index.search(vectors[7], size=1)
+    assert found[0] == ids[7]
+
+def clustered_store(path_prefix, count=4000, dims=32, clusters=40):
+    rng = np.random.default_rng(1)
+    centers = rng.normal(size=(clusters, dims))
+    vectors = (centers[rng.integers(clusters, size=count)] + 0.3 * rng.normal(size=(count, dims))).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    with EmbeddingWriter(str(path_prefix), 'float32') as writer:
+        writer.append(list(range(count)), vectors)
+    return ExactVectorIndex(str(path_prefix))
+
+def recall(approximate, exact, queries, k=10):
+    found = 0
+    for company_id in queries:
+        query = exact.vector(company_id)
+        expected = set(exact.search(query, k)[0].tolist())
+        found += len(expected.intersection(approximate.search(query, k)[0].tolist()))
+    return found / (k * len(queries))
+
+def test_failed_run_keeps_the_published_store(tmp_path):
+    ids, vectors = write_store(tmp_path / 'embeddings', count=10)
+    with pytest.raises(RuntimeError):
+        with EmbeddingWriter(str(tmp_path / 'embeddings')) as writer:
+            writer.append([1, 2], vectors[:2])
+            raise RuntimeError('bulk failed')
+    assert len(ExactVectorIndex(str(tmp_path / 'embeddings')).ids) == 10
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['embeddings.ids.npy', 'embeddings.json', 'embeddings.vectors']
+
+def test_ivf_recall_against_exact(tmp_path):
+    exact = clustered_store(tmp_path / 'embeddings')
+    IVFIndex.build(exact, str(tmp_path / 'embeddings.ivf'), nlist=64)
+    queries = list(range(0, 4000, 40))
+
+    ivf = IVFIndex(str(tmp_path / 'embeddings.ivf'), nprobe=8)
+    assert len(ivf) == len(exact)
+    assert ivf.codes.dtype == np.int8
+    assert recall(ivf, exact, queries) > 0.8
+
+    reranked = IVFIndex(str(tmp_path / 'embeddings.ivf'), nprobe=8, rerank=4, exact=exact)
+    assert recall(reranked, exact, queries) >= recall(ivf, exact, queries)
+
+    everything = IVFIndex(str(tmp_path / 'embeddings.ivf'), nprobe=64, rerank=4, exact=exact)
+    assert recall(everything, exact, queries) == 1.0
+
+def test_ivf_vector_is_dequantized(tmp_path):
+    exact = clustered_store(tmp_path / 'embeddings', count=500)
+    IVFIndex.build(exact, str(tmp_path / 'embeddings.ivf'), nlist=8)
+    ivf = IVFIndex(str(tmp_path / 'embeddings.ivf'))
+    np.testing.assert_allclose(ivf.vector(123), exact.vector(123), atol=0.01)
+    assert ivf.vector(500) is None
+    assert sorted(p.name for p in (tmp_path / 'embeddings.ivf').iterdir()) == sorted(f'{n}.npy' for n in IVFIndex.FILES)
+
+def test_ivf_build_skips_an_empty_store(tmp_path):
+    write_store(tmp_path / 'embeddings', count=0)
+    IVFIndex.build(ExactVectorIndex(str(tmp_path / 'embeddings')), str(tmp_path / 'embeddings.ivf'))
+    assert not (tmp_path / 'embeddings.ivf').exists()
+
+def test_vector_encodings_round_trip():
+    vectors = np.random.default_rng(0).normal(size=(3, 8)).astype(np.float32)
+    for encoding in ['list', 'float', 'base64']:
+        encoded = encode_vectors(vectors, encoding)
+        # As the bulk helpers would write and Elasticsearch return the source
+        sources = orjson.loads(orjson.dumps(encoded, option=orjson.OPT_SERIALIZE_NUMPY))
+        np.testing.assert_array_equal(np.array([decode_vector(v) for v in sources], dtype=np.float32), vectors)
+    assert len(encode_vectors(vectors, 'base64')[0]) == 44